@@ -1,19 +1,40 @@
 # app.py
-from collections import defaultdict
+import asyncio
 import os
+import time
 import uuid
-from flask import Flask, request, jsonify, render_template, session, send_from_directory
+from urllib.parse import urljoin
+import requests
+from flask import Flask, g, request, jsonify, render_template, session, send_from_directory
 from flask_session import Session
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 import pandas_agent
 from sql_agent import SQLAgent  # Import the modified SQLAgent that uses MCP client
+from mcp_client import connection_key, mcp_server_url
 from utils.xml_parser import xml_str_to_df
-from langgraph.checkpoint.memory import MemorySaver
+from utils.datasets import file_version
+from utils.dataset_store import get_dataset_store
+from utils.cubes import get_cubes
+from utils.checkpointer import SQLiteSaver
+from utils.artifacts import ARTIFACT_TTL, artifact_path, is_artifact_id, remember_artifact, start_sweeper
+from utils.charts import CHART_DIR
+from utils.forecasting import forecast_batch as forecast_series_batch, get_forecast_model, refit_in_background
+from utils.regression import get_regression
+from utils.connection_cache import drop_connection_cache, find_connection_cache
+from utils.prefetch import aload_preview, start_prefetch
+from utils.single_flight import single_flight_stats
+from utils.intent_router import answer_csv, answer_sql, record, route_csv, route_sql, router_stats
+from utils.llm_usage import record_turn, usage_stats
+from utils.tracing import activate, deactivate, metrics_text, span, start_span
 from werkzeug.utils import secure_filename
 import logging
 
 UPLOAD_FOLDER = "uploads"
+# Conversations are checkpointed on disk and shared by all workers; the session
+# only keeps the id of the current conversation.
+CHECKPOINT_DB = os.getenv("CHECKPOINT_DB", "checkpoints.sqlite3")
 
 load_dotenv()
 app = Flask(__name__, template_folder="frontend/dist")
@@ -23,6 +44,9 @@ app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["SESSION_TYPE"] = "filesystem"
 app.config["MAX_CONTENT_LENGTH"] = 16 * 1000 * 1000
 Session(app)
+checkpointer = SQLiteSaver(CHECKPOINT_DB)
+# Deletes expired chart files in the background
+start_sweeper()
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
@@ -36,8 +60,78 @@ def get_extension(filename: str):
 def allowed_file(filename: str):
     return "." in filename and get_extension(filename) in ALLOWED_EXTENSIONS
 
-def defaultdictoverride():
-    return defaultdict(dict)
+def dataframe_rows(df: pd.DataFrame):
+    """DataFrame rows as JSON-serializable lists (NaN -> None, datetimes -> text)"""
+    with span("serialize.rows", rows=len(df), columns=len(df.columns)):
+        df = df.copy()
+        for column in df.columns:
+            if pd.api.types.is_datetime64_any_dtype(df[column]):
+                df[column] = df[column].dt.strftime("%Y-%m-%d %H:%M:%S")
+            elif df[column].dtype == object:
+                # e.g. describe(include="all"): numpy scalars the JSON encoder doesn't know
+                df[column] = df[column].map(lambda value: value.item() if isinstance(value, np.generic) else value)
+        return df.astype(object).where(df.notna(), None).values.tolist()
+
+def new_conversation():
+    session["conversation_id"] = uuid.uuid4().hex
+
+def session_connection_key():
+    """Identity of the session's database connection, as SQLAgent keys its caches"""
+    return connection_key(
+        mcp_server_url(),
+        session.get("sql_server", ""),
+        session.get("sql_database", ""),
+        session.get("sql_username", ""),
+        session.get("sql_password", ""),
+    )
+
+def usage_session() -> str:
+    # Stable across /clear (unlike conversation_id), so usage adds up per browser session
+    if not session.get("usage_id"):
+        session["usage_id"] = uuid.uuid4().hex[:12]
+    return session["usage_id"]
+
+def record_usage(agent, mode: str, dataset: str, question: str):
+    """Add the LLM calls and tokens of the agent's last turn to /llm_usage"""
+    if getattr(agent, "usage", None) is not None:
+        record_turn(agent.usage, mode, dataset, usage_session(), question)
+
+def conversation_thread(mode: str) -> str:
+    if not session.get("conversation_id"):
+        new_conversation()
+    return f"{session['conversation_id']}-{mode}"
+
+@app.before_request
+def start_request_trace():
+    # Root span of the request; agent, LLM, tool and MCP spans become its children
+    g.trace = start_span("http.request", **{
+        "http.method": request.method,
+        "http.route": request.url_rule.rule if request.url_rule is not None else "unmatched",
+    })
+    g.trace_token = activate(g.trace)
+
+@app.after_request
+def record_request_status(response):
+    trace = g.get("trace")
+    if trace is not None:
+        trace.set(**{"http.status_code": response.status_code})
+        if response.status_code >= 500:
+            trace.fail(f"HTTP {response.status_code}")
+    return response
+
+@app.teardown_request
+def end_request_trace(error):
+    trace = g.pop("trace", None)
+    if trace is None:
+        return
+    try:
+        deactivate(g.pop("trace_token"))
+    except ValueError:
+        # the token belongs to a context copied by the server; nothing to reset here
+        pass
+    if error is not None:
+        trace.fail(error)
+    trace.end()
 
 @app.route("/")
 def index():
@@ -45,8 +139,30 @@ def index():
 
 @app.route("/assets/<filename>")
 def serve_image(filename):
+    # Frontends built before /artifacts existed ask for charts here
+    if is_artifact_id(os.path.splitext(filename)[0]):
+        return serve_artifact(filename)
     return send_from_directory("frontend/dist/assets", filename)
 
+@app.route("/artifacts/<filename>")
+def serve_artifact(filename):
+    # The frontend always asks for "<id>.png", also when charts are SVGs
+    artifact_id = os.path.splitext(filename)[0]
+    path = artifact_path(artifact_id) if artifact_id in session.get("artifacts", []) else None
+    if path is None:
+        return jsonify({"error": "Not found"}), 404
+    # Ids are content hashes, so a chart never changes under its URL
+    response = send_from_directory(CHART_DIR, os.path.basename(path), max_age=ARTIFACT_TTL)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+def keep_artifact(artifact_id):
+    """Tie a chart to the current session, so only this session can open it"""
+    if artifact_id:
+        session["artifacts"] = remember_artifact(session.get("artifacts", []), artifact_id)
+
 @app.route("/upload", methods=["POST"])
 def upload_file():
     if "file" not in request.files:
@@ -69,9 +185,14 @@ def upload_file():
         elif file_ext == ".xml":
             session["dataframe"] = xml_str_to_df(file.stream.read())
 
-        agent_context = MemorySaver()
-        agent_context.storage.default_factory = defaultdictoverride
-        session["agent_context"] = agent_context
+        # Load the SQL copy of the dataset and precompute aggregates now rather than on the first question
+        version = file_version(file_path)
+        get_dataset_store(session["dataframe"], version)
+        get_cubes(session["dataframe"], version, file_path)
+        # Series forecast from the previous version of this file get refitted on the new data
+        refit_in_background(session["dataframe"], file_path)
+
+        new_conversation()
         session["mode"] = "csv"  # Set mode to CSV
 
         return jsonify({"message": "File uploaded successfully"}), 200
@@ -80,7 +201,7 @@ def upload_file():
         return jsonify({"error": "Failed to upload file"}), 500
 
 @app.route("/connect_db", methods=["POST"])
-def connect_database():
+async def connect_database():
     data = request.get_json()
     server = data.get("server")
     database = data.get("database")
@@ -92,16 +213,14 @@ def connect_database():
     
     try:
         # Create SQL agent with MCP client
-        agent_context = MemorySaver()
-        agent_context.storage.default_factory = defaultdictoverride
-        sql_agent = SQLAgent(server, database, username, password, agent_context)
+        sql_agent = await SQLAgent.acreate(server, database, username, password, checkpointer)
         
         # Store SQL agent connection info in session
         session["sql_server"] = server
         session["sql_database"] = database
         session["sql_username"] = username
         session["sql_password"] = password
-        session["agent_context"] = agent_context
+        new_conversation()
         session["mode"] = "sql"  # Explicitly set mode to SQL
         
         # Force session to save
@@ -110,6 +229,9 @@ def connect_database():
         # Get table list for confirmation
         tables = sql_agent.tables
         
+        # Warm schema and preview caches of the likely first tables in the background
+        start_prefetch(sql_agent.mcp_client, sql_agent.connection_cache, tables)
+        
         # Get token from MCP client if available
         token = None
         if hasattr(sql_agent, 'mcp_client') and hasattr(sql_agent.mcp_client, 'token'):
@@ -127,7 +249,7 @@ def connect_database():
 # Replace the get_table_preview route in app.py with this updated version
 
 @app.route("/get_table_preview", methods=["POST"])
-def get_table_preview():
+async def get_table_preview():
     """Get a preview of a table with simplified processing"""
     data = request.get_json()
     table_name = data.get("table")
@@ -156,21 +278,14 @@ def get_table_preview():
             token = auth_header.split(' ')[1]
             logging.info(f"Token received in request: {token[:10]}...")
         
-        # Create agent context if needed
-        agent_context = session.get("agent_context")
-        if agent_context is None:
-            agent_context = MemorySaver()
-            agent_context.storage.default_factory = defaultdictoverride
-            session["agent_context"] = agent_context
-        
         # Create SQL agent
         logging.info("Creating SQLAgent for table preview")
-        sql_agent = SQLAgent(
+        sql_agent = await SQLAgent.acreate(
             session.get("sql_server"),
             session.get("sql_database"),
             session.get("sql_username"),
             session.get("sql_password"),
-            agent_context
+            checkpointer
         )
         
         # If we received a token in the request, make sure the MCP client uses it
@@ -178,11 +293,11 @@ def get_table_preview():
             sql_agent.mcp_client.token = token
             logging.info("Updated MCP client with token from request")
         
-        # Execute a simple query to get table preview
+        # Get the table preview (served from the prefetched cache when warm)
         try:
-            logging.info(f"Executing direct SQL query for table preview: {table_name}")
-            query = f"SELECT TOP 10 * FROM [{table_name}]"
-            result, error = sql_agent.mcp_client.execute_query(query)
+            logging.info(f"Loading table preview: {table_name}")
+            sql_agent.connection_cache.record_usage(table_name)
+            result, error = await aload_preview(sql_agent.mcp_client, sql_agent.connection_cache, table_name)
             
             if error:
                 logging.error(f"Error executing preview query: {error}")
@@ -228,7 +343,7 @@ def get_table_preview():
         return jsonify({"error": f"Failed to get table preview: {str(e)}"}), 500
 
 @app.route("/check_connection_status", methods=["GET"])
-def check_connection_status():
+async def check_connection_status():
     """Check if there's an active database connection"""
     # Check if we have the essential connection parameters
     if all([
@@ -237,25 +352,28 @@ def check_connection_status():
         session.get("sql_username"),
         session.get("sql_password")
     ]):
+        # Polls are answered from the table catalog without contacting the MCP server
+        cache = find_connection_cache(session_connection_key())
+        if cache is not None and cache.tables is not None:
+            session["mode"] = "sql"
+            return jsonify({
+                "connected": True,
+                "database": session.get("sql_database"),
+                "tables": cache.tables
+            }), 200
+        
         try:
             # Update the mode to ensure it's set correctly
             session["mode"] = "sql"
             
-            # Create agent context if needed
-            agent_context = session.get("agent_context")
-            if agent_context is None:
-                agent_context = MemorySaver()
-                agent_context.storage.default_factory = defaultdictoverride
-                session["agent_context"] = agent_context
-            
             # Create SQL agent to verify connection
             logging.info("Creating SQL agent to verify connection")
-            sql_agent = SQLAgent(
+            sql_agent = await SQLAgent.acreate(
                 session.get("sql_server"),
                 session.get("sql_database"),
                 session.get("sql_username"),
                 session.get("sql_password"),
-                agent_context
+                checkpointer
             )
             
             # Store the MCP client token in a cookie for later use
@@ -316,7 +434,7 @@ def check_connection_status():
                 temp_client.token = token  # Set token first
                 
                 # Try to fetch tables as a validation method
-                tables, error = temp_client.get_tables()
+                tables, error = await temp_client.aget_tables()
                 
                 if not error and tables:
                     logging.info(f"Successfully validated token and retrieved {len(tables)} tables")
@@ -324,7 +442,8 @@ def check_connection_status():
                     connection_info = {}
                     try:
                         # Try the new validate-token endpoint if it exists
-                        validate_response = requests.post(
+                        validate_response = await asyncio.to_thread(
+                            requests.post,
                             urljoin(temp_client.base_url, "/api/validate-token"),
                             headers={"Authorization": f"Bearer {token}"}
                         )
@@ -336,12 +455,6 @@ def check_connection_status():
                     # Restore session mode
                     session["mode"] = "sql"
                     
-                    # Create agent context if not exists
-                    if not session.get("agent_context"):
-                        agent_context = MemorySaver()
-                        agent_context.storage.default_factory = defaultdictoverride
-                        session["agent_context"] = agent_context
-                    
                     # Store token in a cookie for future requests
                     response = jsonify({
                         "connected": True,
@@ -368,7 +481,7 @@ def check_connection_status():
     
 @app.route("/refresh_tables", methods=["POST"])
 def refresh_tables():
-    """Refresh the list of tables from the database"""
+    """Refresh the list of tables from the database, bypassing the catalog TTL"""
     if session.get("mode") != "sql":
         return jsonify({"error": "No database connection active"}), 400
     
@@ -379,47 +492,159 @@ def refresh_tables():
             session.get("sql_database"),
             session.get("sql_username"),
             session.get("sql_password"),
-            session.get("agent_context")
+            checkpointer
         )
+        changed, error = sql_agent.refresh_tables()
+        if error:
+            return jsonify({"error": f"Failed to refresh tables: {error}"}), 500
         
-        # SQLAgent's MCP client already handles table refreshing
         return jsonify({
             "message": "Tables refreshed successfully",
-            "tables": sql_agent.tables
+            "tables": sql_agent.tables,
+            "changed": changed
         }), 200
     except Exception as e:
         logging.error(f"Error refreshing tables: {str(e)}")
         return jsonify({"error": f"Failed to refresh tables: {str(e)}"}), 500
 
+@app.route("/filter_rows", methods=["POST"])
+def filter_rows():
+    """Rows of the uploaded dataset matching point/range filters, answered from its indexes"""
+    if session.get("dataframe") is None or not session.get("csv_filepath"):
+        return jsonify({"error": "No dataset uploaded"}), 400
+    
+    data = request.get_json() or {}
+    try:
+        store = get_dataset_store(session["dataframe"], file_version(session["csv_filepath"]))
+        result, truncated = store.filter_rows(
+            data.get("filters", []),
+            data.get("columns"),
+            min(int(data.get("limit", 100)), 1000),
+            int(data.get("offset", 0))
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error("Error filtering rows: %s", str(e))
+        return jsonify({"error": f"Failed to filter rows: {str(e)}"}), 500
+    
+    return jsonify({
+        "table": {
+            "headers": result.columns.tolist(),
+            "rows": dataframe_rows(result)
+        },
+        "truncated": truncated
+    }), 200
+
+@app.route("/aggregate", methods=["POST"])
+def aggregate():
+    """Precomputed "measure by dimension" aggregate of the uploaded dataset"""
+    if session.get("dataframe") is None or not session.get("csv_filepath"):
+        return jsonify({"error": "No dataset uploaded"}), 400
+    
+    data = request.get_json() or {}
+    cubes = get_cubes(session["dataframe"], file_version(session["csv_filepath"]), session["csv_filepath"])
+    if cubes is None:
+        return jsonify({"error": "Precomputed aggregates are disabled"}), 400
+    
+    group_by = data.get("group_by") or []
+    if isinstance(group_by, str):
+        group_by = [group_by]
+    result = cubes.lookup(group_by, data.get("measure", "*"), data.get("aggregation", "count"))
+    if result is None:
+        return jsonify({
+            "error": "No precomputed aggregate for this request",
+            "dimensions": list(cubes.dimensions),
+            "measures": cubes.measures
+        }), 404
+    
+    return jsonify({
+        "table": {
+            "headers": result.columns.tolist(),
+            "rows": dataframe_rows(result)
+        }
+    }), 200
+
+@app.route("/router_stats", methods=["GET"])
+def get_router_stats():
+    """Questions answered by the intent router vs. the LLM, routed latency and accuracy on the labeled examples"""
+    return jsonify(router_stats()), 200
+
+@app.route("/single_flight_stats", methods=["GET"])
+def get_single_flight_stats():
+    """How many MCP calls and agent connects were collapsed into a concurrent identical one"""
+    return jsonify(single_flight_stats()), 200
+
+@app.route("/llm_usage", methods=["GET"])
+def get_llm_usage():
+    """LLM calls, prompt/completion tokens and model latency per agent, and per dataset and recent turn of this session"""
+    return jsonify(usage_stats(session.get("usage_id"))), 200
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Latency histograms and error counts of HTTP requests, agent nodes, LLM/tool calls and MCP requests"""
+    return app.response_class(metrics_text(), mimetype="text/plain; version=0.0.4"), 200
+
 @app.route("/clear", methods=["POST"])
 def clear_chatlog():
-    if session.get("agent_context"):
-        agent_context = MemorySaver()
-        agent_context.storage.default_factory = defaultdictoverride
-        session["agent_context"] = agent_context
+    if session.get("conversation_id"):
+        for mode in ("csv", "sql"):
+            checkpointer.delete_thread(conversation_thread(mode))
+        new_conversation()
         return "cleared", 200
     else:
         return "no agent session, nothing to clear", 200
 
 @app.route("/ask", methods=["POST"])
-def ask_question():
+async def ask_question():
     data = request.get_json()
     question = data.get("question", "").strip()
     
     if not question:
         return jsonify({"answer": "Please provide a valid question."}), 400
     
+    # Approximate answers (sampled data) are opt-in; asking for an "exact" answer turns them off
+    approximate = bool(data.get("approximate")) and "exact" not in question.lower()
+    
     # Check if we're in SQL or CSV mode
     mode = session.get("mode", "csv")
     
     if mode == "csv":
-        return handle_csv_question(question)
+        return await handle_csv_question(question, approximate)
     elif mode == "sql":
-        return handle_sql_question(question)
+        return await handle_sql_question(question, approximate)
     else:
         return jsonify({"error": "Invalid mode. Please upload a file or connect to a database."}), 400
 
-def handle_csv_question(question):
+def route_question(question, intent, answer):
+    """JSON answer of a question the intent router could parse, None to let the agent answer it"""
+    start = time.perf_counter()
+    response = None
+    if intent is not None:
+        # Any failure, serialization included, falls back to the agent
+        try:
+            result = answer(intent)
+            if result is not None:
+                text, table = result
+                response = jsonify({
+                    "answer": text,
+                    "image": None,
+                    "table": {
+                        "headers": [str(column) for column in table.columns],
+                        "rows": dataframe_rows(table)
+                    } if table is not None else None,
+                    "routed": intent.name
+                })
+        except Exception as e:
+            logging.error("Routed answer to %r failed: %s", question, str(e))
+    if response is None:
+        record(None, 0.0)
+        return None
+    record(intent, time.perf_counter() - start)
+    logging.info(f"Answered {intent} without the LLM in {time.perf_counter() - start:.3f}s")
+    return response
+
+async def handle_csv_question(question, approximate=False):
     """Handle questions in CSV mode with support for last/bottom rows"""
     # Retrieve DataFrame from the session
     csv_filepath = session.get("csv_filepath")
@@ -427,79 +652,42 @@ def handle_csv_question(question):
         return jsonify({"error": "No file uploaded"}), 400
 
     try:
-        df = pd.read_csv(csv_filepath)
+        with span("csv.read"):
+            df = await asyncio.to_thread(pd.read_csv, csv_filepath)
         logging.info(f"Successfully read CSV with {len(df)} rows and {len(df.columns)} columns")
     except Exception as e:
         logging.error("Error reading CSV file: %s", str(e))
         return jsonify({"error": "Failed to process the uploaded file"}), 500
 
-    # Handle table-related questions
-    if any(term in question.lower() for term in ["table", "rows", "data", "show", "display"]):
-        # Check if the user wants the last rows instead of the first rows
-        want_last_rows = any(term in question.lower() for term in ["last", "bottom", "tail", "end"])
-        
-        # Extract the number of rows requested
-        import re
-        match = re.search(r"(\d+)\s*rows", question.lower())
-        num_rows = int(match.group(1)) if match else 10  # Default to 10 rows
-        
-        # Limit rows to the maximum available rows in the DataFrame
-        num_rows = min(num_rows, len(df))
-        
-        # Get either head or tail based on what was requested
-        if want_last_rows:
-            df_subset = df.tail(num_rows)
-            description = f"last {num_rows}"
-        else:
-            df_subset = df.head(num_rows)
-            description = f"first {num_rows}"
-        
-        # Convert DataFrame to lists for JSON serialization
-        data_rows = []
-        for _, row in df_subset.iterrows():
-            row_data = []
-            for item in row:
-                if pd.isna(item):
-                    row_data.append(None)
-                elif isinstance(item, (int, float, bool)):
-                    row_data.append(item)
-                else:
-                    row_data.append(str(item))
-            data_rows.append(row_data)
-        
-        # Ensure column names are strings
-        headers = [str(col) for col in df.columns.tolist()]
-        
-        # Log what we're sending
-        logging.info(f"Sending {description} rows as table with {len(headers)} columns and {len(data_rows)} rows")
-        
-        # Prepare table data
-        table_data = {
-            "headers": headers,
-            "rows": data_rows
-        }
-        
-        return jsonify({
-            "answer": f"Here are the {description} rows of the data:",
-            "table": table_data
-        })
+    # Trivial questions (first rows, shape, columns, simple aggregates) are answered without the LLM
+    routed = await asyncio.to_thread(route_question, question, route_csv(question, df.columns), lambda intent: answer_csv(
+        intent, df, get_cubes(df, file_version(csv_filepath), csv_filepath)
+    ))
+    if routed is not None:
+        return routed
 
     # General question handling (fallback to agent)
     try:
-        agent_context = session.get("agent_context")
-        if agent_context is None:
-            agent_context = MemorySaver()
-            agent_context.storage.default_factory = defaultdictoverride
-
-        agent = pandas_agent.PandasAgent(df, agent_context)
-        answer = agent.invoke(question)
-        session["agent_context"] = agent_context  # Save updated context
-        return jsonify({"answer": answer, "image": agent.extra_content, "table": None})
+        # Building the agent (profile, cubes) is CPU work and runs off the event loop
+        with span("agent.build", agent="pandas"):
+            agent = await asyncio.to_thread(
+                pandas_agent.PandasAgent,
+                df, checkpointer, file_version(csv_filepath), conversation_thread("csv"), approximate
+            )
+        answer = await agent.ainvoke(question)
+        record_usage(agent, "csv", f"csv:{os.path.basename(csv_filepath)}", question)
+        keep_artifact(agent.extra_content)
+        return jsonify({
+            "answer": answer,
+            "image": agent.extra_content,
+            "table": None,
+            "approximate": agent.approximate
+        })
     except Exception as e:
         logging.error("Error in /ask endpoint: %s", str(e))
         return jsonify({"error": "Failed to process the question."}), 500
 
-def handle_sql_question(question):
+async def handle_sql_question(question, approximate=False):
     """Handle questions in SQL mode with improved table data handling"""
     # Check if we have database connection info
     if not all([
@@ -514,30 +702,39 @@ def handle_sql_question(question):
     is_data_request = any(term in question.lower() for term in ["show", "display", "table", "rows", "data"])
     
     try:
-        agent_context = session.get("agent_context")
-        if agent_context is None:
-            agent_context = MemorySaver()
-            agent_context.storage.default_factory = defaultdictoverride
-        
         # Create SQL agent with MCP client
-        sql_agent = SQLAgent(
+        sql_agent = await SQLAgent.acreate(
             session.get("sql_server"),
             session.get("sql_database"),
             session.get("sql_username"),
             session.get("sql_password"),
-            agent_context
+            checkpointer,
+            conversation_thread("sql"),
+            approximate
         )
         
+        # Trivial questions (table list, first rows, row counts, columns) skip the LLM
+        routed = await asyncio.to_thread(route_question, question, route_sql(question, sql_agent.tables), lambda intent: answer_sql(
+            intent, sql_agent.mcp_client, sql_agent.connection_cache, sql_agent.tables
+        ))
+        if routed is not None:
+            return routed
+        
         # Process the question
-        answer = sql_agent.invoke(question)
-        session["agent_context"] = agent_context  # Save updated context
+        answer = await sql_agent.ainvoke(question)
+        record_usage(
+            sql_agent, "sql", f"sql:{session.get('sql_server')}/{session.get('sql_database')}", question
+        )
+        keep_artifact(sql_agent.extra_content)
         
-        # Check if a chart was generated
-        if sql_agent.extra_content:
+        # Check if a chart was generated (an image, a JSON spec for client-side rendering, or both)
+        if sql_agent.extra_content or sql_agent.chart_spec:
             return jsonify({
                 "answer": answer,
                 "image": sql_agent.extra_content,
-                "table": None
+                "chart": sql_agent.chart_spec,
+                "table": None,
+                "approximate": sql_agent.approximate_used
             })
         
         # Direct handling for table/data requests
@@ -598,7 +795,7 @@ def handle_sql_question(question):
                 logging.error(f"Error parsing table-like output: {str(parsing_error)}")
         
         # Return plain text answer if no table structure detected
-        return jsonify({"answer": answer, "image": None, "table": None})
+        return jsonify({"answer": answer, "image": None, "table": None, "approximate": sql_agent.approximate_used})
     except Exception as e:
         logging.error("Error in SQL question handling: %s", str(e))
         return jsonify({"error": f"Failed to process the SQL question: {str(e)}"}), 500
@@ -621,18 +818,100 @@ def forecast():
         return jsonify({"error": "No CSV file uploaded"}), 400
 
     try:
-        csv_data = pd.read_csv(csv_filepath)
-        agent = pandas_agent.PandasAgent(csv_data)
-        forecast = agent.forecast_time_series(date_column, value_column, periods)
-
-        if isinstance(forecast, str):
-            return jsonify({"error": forecast}), 400
-
-        return jsonify(forecast.to_dict(orient="records"))
+        # Pure computation: no agent, and the fitted model is reused for any horizon
+        df = session.get("dataframe")
+        if df is None:
+            df = pd.read_csv(csv_filepath)
+        model = get_forecast_model(
+            df, date_column, value_column, data.get("params"), csv_filepath, data.get("model")
+        )
+        response = jsonify(model.predict(periods).to_dict(orient="records"))
+        # The body stays a plain list of rows; which model answered is reported alongside
+        response.headers["X-Forecast-Model"] = model.name
+        return response
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logging.error("Error in /forecast endpoint: %s", str(e))
         return jsonify({"error": "Failed to generate forecast"}), 500
 
+@app.route("/forecast_batch", methods=["POST"])
+def forecast_batch():
+    """Forecast one series per value of `group_column` (e.g. per part or factory)"""
+    data = request.get_json()
+    group_column = data.get("group_column")
+    date_column = data.get("date_column")
+    value_column = data.get("value_column")
+
+    try:
+        periods = int(data.get("periods", 10))
+        if periods <= 0:
+            raise ValueError("Periods must be a positive integer.")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    csv_filepath = session.get("csv_filepath")
+    if not csv_filepath:
+        return jsonify({"error": "No CSV file uploaded"}), 400
+
+    try:
+        df = session.get("dataframe")
+        if df is None:
+            df = pd.read_csv(csv_filepath)
+        forecast, stats = forecast_series_batch(
+            df,
+            group_column,
+            date_column,
+            value_column,
+            periods,
+            data.get("params"),
+            bool(data.get("include_history")),
+            data.get("model"),
+        )
+        return jsonify({
+            "columns": forecast.columns.tolist(),
+            "rows": dataframe_rows(forecast),
+            "stats": stats
+        })
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error("Error in /forecast_batch endpoint: %s", str(e))
+        return jsonify({"error": "Failed to generate forecasts"}), 500
+
+@app.route("/regression", methods=["POST"])
+def regression():
+    """
+    Cross-validated linear regression of `target_column` on `feature_columns`;
+    optional `rows` (list of objects with the feature columns) get predictions.
+    """
+    data = request.get_json()
+    feature_columns = data.get("feature_columns") or []
+    target_column = data.get("target_column")
+    if isinstance(feature_columns, str):
+        feature_columns = [c.strip() for c in feature_columns.split(",") if c.strip()]
+    if not feature_columns or not target_column:
+        return jsonify({"error": "feature_columns and target_column are required"}), 400
+
+    csv_filepath = session.get("csv_filepath")
+    if not csv_filepath:
+        return jsonify({"error": "No CSV file uploaded"}), 400
+
+    try:
+        df = session.get("dataframe")
+        if df is None:
+            df = pd.read_csv(csv_filepath)
+        model = get_regression(df, feature_columns, target_column, file_version(csv_filepath))
+        result = dict(model.summary)
+        if data.get("rows"):
+            result["predictions"] = model.predict(pd.DataFrame(data["rows"])).tolist()
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error("Error in /regression endpoint: %s", str(e))
+        return jsonify({"error": "Failed to fit the regression"}), 500
+
 @app.route("/switch_mode", methods=["POST"])
 def switch_mode():
     """Switch between CSV and SQL modes"""
@@ -666,19 +945,15 @@ def disconnect_database():
     if session.get("mode") != "sql":
         return jsonify({"error": "No database connection active"}), 400
     
+    connection = session_connection_key()
     try:
         # Create SQL agent to access MCP client
-        agent_context = session.get("agent_context")
-        if agent_context is None:
-            agent_context = MemorySaver()
-            agent_context.storage.default_factory = defaultdictoverride
-        
         sql_agent = SQLAgent(
             session.get("sql_server"),
             session.get("sql_database"),
             session.get("sql_username"),
             session.get("sql_password"),
-            agent_context
+            checkpointer
         )
         
         # Use the MCP client to disconnect
@@ -704,6 +979,10 @@ def disconnect_database():
         session["mode"] = "csv"
         
         return jsonify({"error": f"Error during disconnect: {str(e)}"}), 500
+    finally:
+        # Stop warming caches for this connection and forget its catalog (after the
+        # agent above, which refills it), whatever happened
+        drop_connection_cache(connection)
 
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
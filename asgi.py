@@ -0,0 +1,149 @@
+# asgi.py - ASGI entry point, e.g. `uvicorn asgi:app --workers 2`
+import asyncio
+import inspect
+import io
+import sys
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+
+from app import app as flask_app
+from mcp_client import close_async_client, keep_async_client
+
+
+class AsyncViewsMiddleware:
+    """
+    Serves the Flask app over ASGI. Requests for async views (/ask,
+    /get_table_preview, /connect_db, /check_connection_status) are dispatched
+    on the event loop itself, so while they await the LLM or the MCP server
+    the worker keeps serving other requests; one worker holds as many
+    in-flight conversations as the LLM and MCP servers accept. Every other
+    route goes through asgiref's WsgiToAsgi (a thread per request, as with
+    gunicorn).
+
+    Flask's request context lives in context variables, so every request
+    (one asyncio task each) sees its own request and session.
+    """
+
+    def __init__(self, wsgi_app):
+        self.flask_app = wsgi_app
+        self.wsgi = WsgiToAsgi(wsgi_app)
+        self._loop = None
+
+    async def __call__(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # The server's loop lives as long as the worker, so MCP connections are pooled on it
+            # (also without lifespan events, e.g. uvicorn --lifespan off)
+            self._loop = loop
+            keep_async_client()
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http" or not self._is_async_view(scope):
+            return await self.wsgi(scope, receive, send)
+
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.extend(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        response = await self._dispatch(_environ(scope, bytes(body)))
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [
+                    (name.lower().encode("latin1"), value.encode("latin1"))
+                    for name, value in response.headers.items()
+                ],
+            })
+            await send({"type": "http.response.body", "body": b"".join(response.iter_encoded())})
+        finally:
+            response.close()
+
+    def _is_async_view(self, scope) -> bool:
+        adapter = self.flask_app.url_map.bind("localhost", script_name=scope.get("root_path") or None)
+        try:
+            endpoint, _ = adapter.match(scope["path"], method=scope["method"])
+        except (HTTPException, RequestRedirect):
+            # 404s, 405s and redirects are answered by Flask as usual
+            return False
+        return inspect.iscoroutinefunction(self.flask_app.view_functions.get(endpoint))
+
+    async def _dispatch(self, environ):
+        # Flask's full_dispatch_request, with the view awaited instead of run through async_to_sync
+        app = self.flask_app
+        ctx = app.request_context(environ)
+        ctx.push()
+        error = None
+        try:
+            try:
+                rv = app.preprocess_request()
+                if rv is None:
+                    req = ctx.request
+                    if req.routing_exception is not None:
+                        app.raise_routing_exception(req)
+                    rv = await app.view_functions[req.url_rule.endpoint](**req.view_args)
+            except Exception as e:
+                rv = app.handle_user_exception(e)
+            return app.finalize_request(rv)
+        except Exception as e:
+            error = e
+            return app.handle_exception(e)
+        finally:
+            ctx.pop(error)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await close_async_client()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+def _environ(scope, body: bytes):
+    """WSGI environ of an ASGI HTTP request (PEP 3333 names)"""
+    script_name = scope.get("root_path", "").encode("utf8").decode("latin1")
+    path_info = scope["path"].encode("utf8").decode("latin1")
+    if path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": script_name,
+        "PATH_INFO": path_info,
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client") is not None:
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1")
+        if name == "content-length":
+            key = "CONTENT_LENGTH"
+        elif name == "content-type":
+            key = "CONTENT_TYPE"
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        value = value.decode("latin1")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+app = AsyncViewsMiddleware(flask_app)
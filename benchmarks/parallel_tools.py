@@ -0,0 +1,79 @@
+# benchmarks/parallel_tools.py - tool turns run by ParallelToolNode vs one call at a time
+#
+#   python benchmarks/parallel_tools.py
+#   python benchmarks/parallel_tools.py --calls "describe_table*2,sql_query*2" --delay 0.3 --repeat 5
+#
+# Every tool sleeps --delay seconds (a stand-in for an MCP round trip). A turn
+# is one AI message asking for --calls; it runs once with the SQL agent's
+# PARALLEL_SAFE_TOOLS and once with none, which runs every call serially.
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TRACE_LOG", "")
+
+from langchain_core.messages import AIMessage
+from langchain_core.tools import StructuredTool
+
+from sql_agent import PARALLEL_SAFE_TOOLS
+from utils.tool_executor import TOOL_MAX_WORKERS, ParallelToolNode
+
+
+def slow_tool(name, delay):
+    def run(argument: str = "") -> str:
+        time.sleep(delay)
+        return f"{name}({argument}) done"
+
+    return StructuredTool.from_function(run, name=name, description=f"{name} stand-in")
+
+
+def tool_calls(spec):
+    """'describe_table*2,sql_query' -> tool calls of one AI message"""
+    calls = []
+    for item in spec.split(","):
+        name, _, count = item.strip().partition("*")
+        for _ in range(int(count or 1)):
+            calls.append({"name": name, "args": {"argument": str(len(calls))}, "id": f"call_{len(calls)}"})
+    return calls
+
+
+def run_turns(node, message, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = node({"messages": [message]}, {})
+        seconds.append(time.perf_counter() - start)
+        # Results must keep the order of the tool calls
+        assert [m.tool_call_id for m in result["messages"]] == [c["id"] for c in message.tool_calls]
+    return round(statistics.median(seconds), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ParallelToolNode vs serial tool execution")
+    parser.add_argument("--calls", default="describe_table*2,sql_query*2")
+    parser.add_argument("--delay", type=float, default=0.3, help="seconds per tool call")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    calls = tool_calls(args.calls)
+    tools = [slow_tool(name, args.delay) for name in sorted({c["name"] for c in calls})]
+    message = AIMessage(content="", tool_calls=calls)
+
+    parallel = run_turns(ParallelToolNode(tools, PARALLEL_SAFE_TOOLS), message, args.repeat)
+    serial = run_turns(ParallelToolNode(tools, ()), message, args.repeat)
+    print(json.dumps({
+        "calls": args.calls,
+        "delay_s": args.delay,
+        "max_workers": TOOL_MAX_WORKERS,
+        "serial_s": serial,
+        "parallel_s": parallel,
+        "speedup": round(serial / parallel, 2),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# benchmarks/schema_prompt.py - SQL agent schema prompt size and table selection time
+#
+#   python benchmarks/schema_prompt.py --tables 1000
+#   python benchmarks/schema_prompt.py --tables 1000 --question "monthly revenue by customer region"
+#
+# Builds a synthetic catalog (table names and schemas from a small business
+# vocabulary), lets SQLAgent pick the schemas for each question exactly as it
+# does before calling the LLM and prints its prompt_stats. The catalog is
+# served from memory, so selection time excludes MCP round trips.
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# The graph is built but the LLM is never called
+for name in ("AZURE_OPENAI_API_KEY", "AZURE_OPENAI_DEPLOYMENT", "AZURE_OPENAI_API_VERSION"):
+    os.environ.setdefault(name, "benchmark")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "https://benchmark.openai.azure.com")
+os.environ.setdefault("TRACE_LOG", "")
+
+import pandas
+from langchain_core.messages import HumanMessage
+
+from sql_agent import SQLAgent
+from utils.tokens import count_tokens
+
+AREAS = ["sales", "finance", "hr", "inventory", "logistics", "marketing", "support", "procurement", "billing", "crm"]
+ENTITIES = [
+    "order", "invoice", "customer", "employee", "product", "shipment", "warehouse", "campaign", "ticket",
+    "supplier", "payment", "contract", "region", "budget", "forecast", "return", "lead", "account",
+]
+COLUMNS = [
+    "amount", "quantity", "price", "status", "created_at", "updated_at", "region", "country", "email",
+    "name", "description", "category", "discount", "currency", "due_date", "priority", "owner", "score",
+]
+QUESTIONS = [
+    "total invoice amount per customer last month",
+    "which warehouses have the most delayed shipments",
+    "open support tickets by priority",
+    "average employee salary per department",
+    "revenue forecast vs budget by region",
+    "top suppliers by number of returns",
+]
+
+
+class SyntheticCatalog:
+    """Stands in for MCPClient: serves the schemas of the synthetic tables"""
+
+    def __init__(self, tables, seed):
+        rng = random.Random(seed)
+        self.schemas = {}
+        for table in tables:
+            entity = table.split("_")[1]
+            columns = [f"{entity}_id"] + rng.sample(COLUMNS, rng.randint(5, 14))
+            self.schemas[table] = pandas.DataFrame({
+                "COLUMN_NAME": columns,
+                "DATA_TYPE": [rng.choice(["int", "nvarchar", "decimal", "datetime2"]) for _ in columns],
+                "IS_PRIMARY_KEY": ["YES"] + ["NO"] * (len(columns) - 1),
+            })
+        self.base_url = "memory://catalog"
+
+    def get_table_schema(self, table):
+        return self.schemas[table], None
+
+
+def catalog_tables(count, seed):
+    rng = random.Random(seed)
+    tables = set()
+    while len(tables) < count:
+        tables.add(f"{rng.choice(AREAS)}_{rng.choice(ENTITIES)}_{rng.randint(1, 999):03d}")
+    return sorted(tables)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Schema prompt size and selection time on a synthetic catalog")
+    parser.add_argument("--tables", type=int, default=1000)
+    parser.add_argument("--question", action="append", default=None, help="defaults to a built-in set")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    tables = catalog_tables(args.tables, args.seed)
+    agent = SQLAgent("benchmark", f"catalog{args.tables}", "benchmark", "benchmark", connect=False)
+    agent.mcp_client = SyntheticCatalog(tables, args.seed)
+    agent.tables = tables
+    agent.connection_cache.set_tables(tables)
+    agent._setup()
+    agent._build_graph()
+    add_schema_info = agent.graph.nodes["schema_info"].bound
+
+    results = []
+    for question in args.question or QUESTIONS:
+        # Schemas are loaded again for every question (the index keeps the columns it has seen)
+        agent.connection_cache.schemas.clear()
+        add_schema_info.invoke({"messages": [HumanMessage(question)]})
+        results.append({"question": question, **agent.prompt_stats})
+
+    print(json.dumps({
+        "tables": len(tables),
+        "full_table_list_tokens": count_tokens("\n".join(f"- {table}" for table in tables)),
+        "prompt_tokens_mean": round(statistics.mean(r["prompt_tokens"] for r in results)),
+        "selection_ms_mean": round(statistics.mean(r["selection_ms"] for r in results), 1),
+        "questions": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
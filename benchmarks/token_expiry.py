@@ -0,0 +1,120 @@
+# benchmarks/token_expiry.py - MCP token expiry and re-authentication against a stub server
+#
+#   python benchmarks/token_expiry.py
+#
+# Starts a stub MCP server in-process that logs every request, then drives
+# MCPClient through: previews with a valid token, a token that expired
+# locally, a token the server revoked (also with concurrent callers) and a
+# connect answer with an ISO 8601 expiresIn. Prints the requests each step
+# sent, e.g. a revoked token costs preview, connect, preview.
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TRACE_LOG", "")
+
+import mcp_client
+from mcp_client import MCPClient
+
+
+class StubServer(ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.lock = threading.Lock()
+        self.log = []
+        self.valid_tokens = set()
+        self.issued = 0
+        # expiresIn of the next connect answers
+        self.expires_in = 3600
+
+    def take_log(self):
+        with self.lock:
+            log, self.log = self.log, []
+        return log
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _answer(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        with server.lock:
+            server.log.append(f"POST {self.path}")
+            if self.path != "/api/connect":
+                return self._answer(404, {"error": "not found"})
+            server.issued += 1
+            token = f"token-{server.issued}"
+            server.valid_tokens.add(token)
+            expires_in = server.expires_in
+        # a slow connect, so concurrent callers overlap
+        time.sleep(0.1)
+        self._answer(200, {"token": token, "connectionId": "stub", "expiresIn": expires_in})
+
+    def do_GET(self):
+        server = self.server
+        token = self.headers.get("Authorization", "").removeprefix("Bearer ")
+        with server.lock:
+            server.log.append(f"GET {self.path.split('?')[0]}")
+            valid = token in server.valid_tokens
+        if not valid:
+            return self._answer(401, {"error": "invalid token"})
+        self._answer(200, {"headers": ["id", "name"], "rows": [[1, "a"], [2, "b"]]})
+
+
+def step(server, title, action):
+    result = action()
+    print(json.dumps({"step": title, "result": result, "requests": server.take_log()}))
+
+
+def main():
+    server = StubServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = MCPClient(f"http://127.0.0.1:{server.server_address[1]}")
+
+    def preview():
+        df, error = client.get_table_preview("orders")
+        return error or f"{len(df)} rows"
+
+    step(server, "connect", lambda: client.connect("server", "db", "user", "password"))
+    step(server, "3 previews, valid token", lambda: [preview() for _ in range(3)])
+
+    # Expires within TOKEN_EXPIRY_MARGIN: renewed up front, no rejected request
+    server.expires_in = mcp_client.TOKEN_EXPIRY_MARGIN + 1
+    step(server, "connect, short-lived token", lambda: client.connect("server", "db", "user", "password"))
+    time.sleep(1.5)
+    server.expires_in = 3600
+    step(server, "preview, token expired locally", preview)
+
+    server.valid_tokens.clear()
+    step(server, "preview, token revoked by the server", preview)
+
+    server.valid_tokens.clear()
+    with ThreadPoolExecutor(5) as pool:
+        step(server, "5 concurrent previews, token revoked", lambda: list(pool.map(lambda _: preview(), range(5))))
+
+    server.expires_in = (datetime.now(timezone.utc) + timedelta(hours=1)).isoformat()
+    step(server, "connect, ISO 8601 expiresIn", lambda: [
+        client.connect("server", "db", "user", "password"),
+        round(client.token_expires_at - client.token_issued_at),
+    ])
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -71,7 +71,7 @@ function Chatbox({ updateMessages }) {
             minute: "2-digit",
           }),
           table: data.table || null,
-          image: data.image ? "/assets/" + data.image : null,
+          image: data.image ? "/artifacts/" + data.image : null,
         };
         setMessages((prevMessages) => [...prevMessages, botMessage]);
       })
@@ -289,7 +289,7 @@ function Chatbox({ updateMessages }) {
                     onClick={() => showImageFullScreen(`${message.image}.png`)}
                   >
                     <img
-                      src={`${message.image}.png?t=${Date.now()}`}
+                      src={`${message.image}.png`}
                       alt={message.content || "Message Attachment"}
                       onError={(e) => (e.target.src = "/assets/fallback-image.png")}
                     />
@@ -0,0 +1,86 @@
+# loadtest.py - concurrent requests against a running backend, to compare serving modes
+#
+#   python -m gunicorn app:app --workers 1 --threads 8 -b :5000
+#   python -m uvicorn asgi:app --workers 1 --port 5001
+#   python loadtest.py http://localhost:5000 --path /ask --json '{"question": "..."}' -c 200 -n 1000
+#   python loadtest.py http://localhost:5001 --path /ask --json '{"question": "..."}' -c 200 -n 1000
+#
+# Every simulated user gets its own session: it first sends --setup requests
+# (e.g. /connect_db) and keeps the session cookie for the measured ones.
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+import numpy
+
+
+async def run(base_url, method, path, body, concurrency, total, setup, timeout):
+    latencies, statuses = [], {}
+    remaining = iter(range(total))
+
+    async def user():
+        async with httpx.AsyncClient(base_url=base_url, timeout=timeout) as client:
+            for setup_path, setup_body in setup:
+                await client.post(setup_path, json=setup_body)
+            for _ in remaining:
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, path, json=body)
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies = numpy.array(latencies) * 1000
+    return {
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 2),
+        "requests_per_second": round(len(latencies) / elapsed, 2),
+        "latency_ms": {
+            "p50": round(float(numpy.percentile(latencies, 50)), 1),
+            "p95": round(float(numpy.percentile(latencies, 95)), 1),
+            "p99": round(float(numpy.percentile(latencies, 99)), 1),
+            "max": round(float(latencies.max()), 1),
+        },
+        "statuses": {str(k): v for k, v in statuses.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test one endpoint of a running backend")
+    parser.add_argument("base_url")
+    parser.add_argument("--path", default="/check_connection_status")
+    parser.add_argument("--method", default=None, help="GET without --json, POST with it")
+    parser.add_argument("--json", default=None, help="JSON body of every request")
+    parser.add_argument("-c", "--concurrency", type=int, default=50, help="simultaneous users")
+    parser.add_argument("-n", "--requests", type=int, default=500, help="requests in total")
+    parser.add_argument(
+        "--setup", action="append", default=[], metavar="PATH=JSON",
+        help="POST sent once by every user before the test, e.g. /connect_db='{...}'",
+    )
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    body = json.loads(args.json) if args.json else None
+    method = args.method or ("POST" if body is not None else "GET")
+    setup = []
+    for item in args.setup:
+        setup_path, _, setup_body = item.partition("=")
+        setup.append((setup_path, json.loads(setup_body) if setup_body else None))
+
+    result = asyncio.run(run(
+        args.base_url, method, args.path, body, args.concurrency, args.requests, setup, args.timeout
+    ))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,93 +1,269 @@
 # mcp_client.py - Client adapter for MCP server
+import asyncio
+import hashlib
+import math
 import os
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+import httpx
 import requests
 import json
 import pandas as pd
 import logging
 from dotenv import load_dotenv
 from urllib.parse import urljoin
+from utils.single_flight import SingleFlight
+from utils.sql_shaping import is_read_only
+from utils.tracing import span
 
 load_dotenv()
 
 logger = logging.getLogger("mcp-client")
 
+# Lifetime of an MCP token when the server doesn't report one (matches the mcp_token cookie)
+MCP_TOKEN_TTL = int(os.getenv("MCP_TOKEN_TTL", 28800))
+# Tokens this close to expiry are renewed before use instead of failing mid-request
+TOKEN_EXPIRY_MARGIN = 60
+# Seconds an async MCP request may take (the sync client has no timeout, like before)
+MCP_ASYNC_TIMEOUT = float(os.getenv("MCP_ASYNC_TIMEOUT", 120))
+
+# Identical read requests in flight at the same time on the same database share one round trip
+_shared_reads = SingleFlight("mcp_reads")
+
+def mcp_server_url():
+    """Base URL of the MCP server clients of this process talk to by default"""
+    return os.getenv("MCP_SERVER_URL", "http://localhost:3000")
+
+def connection_key(base_url, server, database, username, password):
+    """
+    Identity of a database connection (the password only as a digest), shared
+    by single-flight requests and the per-connection caches
+    """
+    return (
+        base_url,
+        str(server).lower(),
+        str(database).lower(),
+        username,
+        hashlib.sha256(str(password).encode()).hexdigest(),
+    )
+
+def _record_response(current, response):
+    current.set(status=response.status_code, bytes=len(response.content or b""))
+    if response.status_code >= 400:
+        current.fail(f"HTTP {response.status_code}")
+
+def _token_expiry(expires_in, issued_at):
+    """
+    Expiry time of a token from the server's expiresIn: seconds (number or
+    numeric string) or an ISO 8601 timestamp. Anything else means MCP_TOKEN_TTL.
+    """
+    if expires_in is None or isinstance(expires_in, bool):
+        return issued_at + MCP_TOKEN_TTL
+    try:
+        seconds = float(expires_in)
+        if math.isfinite(seconds):
+            return issued_at + seconds
+    except (TypeError, ValueError):
+        pass
+    try:
+        expires_at = datetime.fromisoformat(str(expires_in).strip().replace("Z", "+00:00"))
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        return expires_at.timestamp()
+    except ValueError:
+        logger.warning(f"Unrecognized token expiresIn {expires_in!r}, assuming {MCP_TOKEN_TTL}s")
+        return issued_at + MCP_TOKEN_TTL
+
+# One pooled httpx client per long-lived event loop (the ASGI server's), shared by all
+# MCPClient instances on it. Flask runs every async view on a new loop; there a client
+# per call is used and closed, since a pooled one would outlive its loop unclosed.
+_async_clients = weakref.WeakKeyDictionary()
+_long_lived_loops = weakref.WeakSet()
+
+def keep_async_client():
+    """Pool the async HTTP connections of the running event loop until close_async_client()"""
+    _long_lived_loops.add(asyncio.get_running_loop())
+
+async def close_async_client():
+    """Close the pooled client of the running event loop (server shutdown)"""
+    loop = asyncio.get_running_loop()
+    _long_lived_loops.discard(loop)
+    client = _async_clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
+
+@asynccontextmanager
+async def _async_client():
+    loop = asyncio.get_running_loop()
+    if loop not in _long_lived_loops:
+        async with httpx.AsyncClient(timeout=MCP_ASYNC_TIMEOUT) as client:
+            yield client
+        return
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = httpx.AsyncClient(timeout=MCP_ASYNC_TIMEOUT)
+    yield client
+
 class MCPClient:
     """Client for interacting with the MCP server"""
     
     def __init__(self, base_url=None):
         """Initialize the MCP client with the server base URL"""
-        self.base_url = base_url or os.getenv("MCP_SERVER_URL", "http://localhost:3000")
+        self.base_url = base_url or mcp_server_url()
         self.token = None
         self.connection_id = None
+        self._connection_info = None
+        # Token validity is tracked locally; the server is only asked again when it rejects a call
+        self.token_issued_at = None
+        self.token_expires_at = None
+        self.last_success_at = None
+        self._auth_lock = threading.Lock()
+        # Size of all response bodies received, for per-turn transfer reporting
+        self.bytes_received = 0
+        self._stats_lock = threading.Lock()
+    
+    def _set_token(self, data):
+        """Store the token of a connect/refresh response together with its lifetime"""
+        self.token = data.get("token")
+        self.connection_id = data.get("connectionId", self.connection_id)
+        self.token_issued_at = time.time()
+        self.token_expires_at = _token_expiry(data.get("expiresIn"), self.token_issued_at)
+    
+    def _clear_token(self):
+        self.token = None
+        self.connection_id = None
+        self.token_issued_at = None
+        self.token_expires_at = None
+    
+    def token_expired(self):
+        """True if the token is known to be expired (no network call)"""
+        return (
+            self.token_expires_at is not None
+            and time.time() > self.token_expires_at - TOKEN_EXPIRY_MARGIN
+        )
     
-    def connect(self, server, database, username, password):
-        """Connect to a database through the MCP server"""
-        url = urljoin(self.base_url, "/api/connect")
-        
-        try:
-            response = requests.post(
-                url,
-                json={
-                    "server": server,
-                    "database": database,
-                    "username": username,
-                    "password": password
-                }
-            )
-            
-            if response.status_code != 200:
-                error_msg = response.json().get("error", "Unknown error")
-                logger.error(f"Connection error: {error_msg}")
-                return False, error_msg
-            
-            data = response.json()
-            self.token = data.get("token")
-            self.connection_id = data.get("connectionId")
-            
-            return True, "Connected successfully"
-        except Exception as e:
-            logger.error(f"Error connecting to MCP server: {str(e)}")
-            return False, f"Error connecting to MCP server: {str(e)}"
-        
     def verify_token(self):
-        """Verify if the current token is valid and reconnect if needed"""
+        """Check the token locally and reconnect if it has expired"""
         if not self.token:
             return False, "No token available"
-
-        try:
-            # Try to get tables as a lightweight validation method
-            url = urljoin(self.base_url, "/api/tables")
-            
-            response = requests.get(
-                url,
-                headers={"Authorization": f"Bearer {self.token}"}
-            )
-            
-            # If unauthorized or forbidden, try to reconnect
-            if response.status_code in [401, 403]:
-                logger.warning(f"Token validation failed with status {response.status_code}, attempting to reconnect")
-                
-                # Try to reconnect if we have connection info
-                if hasattr(self, '_connection_info') and self._connection_info:
-                    return self.connect(
-                        self._connection_info.get('server'),
-                        self._connection_info.get('database'),
-                        self._connection_info.get('username'),
-                        self._connection_info.get('password')
-                    )
-                else:
-                    return False, "Token invalid and no connection info available for reconnection"
-            
-            # For all other status codes
-            if response.status_code != 200:
-                return False, f"Token validation failed with status {response.status_code}"
-                
-            # If we got here, token is valid
+        if not self.token_expired():
             return True, "Token is valid"
-            
-        except Exception as e:
-            logger.error(f"Error verifying token: {str(e)}")
-            return False, f"Error verifying token: {str(e)}"
+        
+        logger.info("Token expired, reconnecting")
+        if self._reauthenticate(self.token):
+            return True, "Token renewed"
+        return False, "Token expired and reconnection failed"
+    
+    def _reauthenticate(self, rejected_token):
+        """
+        Get a new token after `rejected_token` was refused or expired. Concurrent
+        callers that saw the same token share a single reconnection.
+        """
+        with self._auth_lock:
+            if self.token and self.token != rejected_token:
+                # Another thread already renewed it
+                return True
+            if not self._connection_info:
+                return False
+            success, message = self.connect(**self._connection_info)
+            if not success:
+                logger.error(f"Reconnection failed: {message}")
+            return success
+    
+    def adopt(self, other):
+        """Use the connection (token) of another client to the same database"""
+        self.base_url = other.base_url
+        self.token = other.token
+        self.connection_id = other.connection_id
+        self.token_issued_at = other.token_issued_at
+        self.token_expires_at = other.token_expires_at
+        self.last_success_at = other.last_success_at
+        self._connection_info = other._connection_info
+    
+    def _shared_key(self, method, path, kwargs):
+        """Single-flight key of a read request, None for requests which must run on their own"""
+        if method != "GET" and not (path == "/api/query" and is_read_only(kwargs.get("json", {}).get("query", ""))):
+            return None
+        if self._connection_info:
+            info = self._connection_info
+            identity = connection_key(self.base_url, info["server"], info["database"], info["username"], info["password"])
+        else:
+            identity = (self.base_url, self.token)
+        return identity, method, path, repr(sorted(kwargs.items()))
+    
+    def _request(self, method, path, **kwargs):
+        """
+        Send an authorized request to the MCP server. A token rejected with
+        401/403 is renewed and the request retried once. Concurrent identical
+        reads (same database, path and body) share one request.
+        """
+        key = self._shared_key(method, path, kwargs)
+        with span("mcp.request", method=method, path=path, shared=key is not None) as current:
+            if key is None:
+                response = self._send(method, path, **kwargs)
+            else:
+                response = _shared_reads.do(key, self._send, method, path, **kwargs)
+            _record_response(current, response)
+            return response
+    
+    def _send(self, method, path, **kwargs):
+        url = urljoin(self.base_url, path)
+        if self.token_expired():
+            self._reauthenticate(self.token)
+        
+        token = self.token
+        response = requests.request(method, url, headers={"Authorization": f"Bearer {token}"}, **kwargs)
+        if response.status_code in (401, 403):
+            logger.warning(f"Token rejected with status {response.status_code}, reconnecting and retrying")
+            if self._reauthenticate(token):
+                response = requests.request(
+                    method, url, headers={"Authorization": f"Bearer {self.token}"}, **kwargs
+                )
+        
+        with self._stats_lock:
+            self.bytes_received += len(response.content or b"")
+        if response.status_code < 400:
+            self.last_success_at = time.time()
+        return response
+    
+    async def _arequest(self, method, path, **kwargs):
+        """
+        Async version of _request for the ASGI serving mode: the request is
+        awaited on the event loop instead of holding a thread. Reconnecting
+        (rare) still runs the sync connect in a thread.
+        """
+        key = self._shared_key(method, path, kwargs)
+        with span("mcp.request", method=method, path=path, shared=key is not None) as current:
+            if key is None:
+                response = await self._asend(method, path, **kwargs)
+            else:
+                response = await _shared_reads.ado(key, self._asend, method, path, **kwargs)
+            _record_response(current, response)
+            return response
+    
+    async def _asend(self, method, path, **kwargs):
+        url = urljoin(self.base_url, path)
+        if self.token_expired():
+            await asyncio.to_thread(self._reauthenticate, self.token)
+        
+        token = self.token
+        async with _async_client() as client:
+            response = await client.request(method, url, headers={"Authorization": f"Bearer {token}"}, **kwargs)
+            if response.status_code in (401, 403):
+                logger.warning(f"Token rejected with status {response.status_code}, reconnecting and retrying")
+                if await asyncio.to_thread(self._reauthenticate, token):
+                    response = await client.request(
+                        method, url, headers={"Authorization": f"Bearer {self.token}"}, **kwargs
+                    )
+        
+        with self._stats_lock:
+            self.bytes_received += len(response.content or b"")
+        if response.status_code < 400:
+            self.last_success_at = time.time()
+        return response
     
     def validate_token(self, token):
         """Validate a token and return connection information"""
@@ -159,36 +335,38 @@ class MCPClient:
         if not self.token:
             return None, "Not connected to any database"
         
-        url = urljoin(self.base_url, "/api/tables")
+        try:
+            return self._tables_result(self._request("GET", "/api/tables"))
+        except Exception as e:
+            logger.error(f"Error fetching tables: {str(e)}")
+            return None, f"Error fetching tables: {str(e)}"
+    
+    async def aget_tables(self):
+        """Async version of get_tables"""
+        if not self.token:
+            return None, "Not connected to any database"
         
         try:
-            response = requests.get(
-                url,
-                headers={"Authorization": f"Bearer {self.token}"}
-            )
-            
-            if response.status_code != 200:
-                error_msg = response.json().get("error", "Unknown error")
-                logger.error(f"Error fetching tables: {error_msg}")
-                return None, error_msg
-            
-            return response.json().get("tables", []), None
+            return self._tables_result(await self._arequest("GET", "/api/tables"))
         except Exception as e:
             logger.error(f"Error fetching tables: {str(e)}")
             return None, f"Error fetching tables: {str(e)}"
     
+    def _tables_result(self, response):
+        if response.status_code != 200:
+            error_msg = response.json().get("error", "Unknown error")
+            logger.error(f"Error fetching tables: {error_msg}")
+            return None, error_msg
+        
+        return response.json().get("tables", []), None
+    
     def get_table_schema(self, table_name):
         """Get schema for a specific table"""
         if not self.token:
             return None, "Not connected to any database"
         
-        url = urljoin(self.base_url, f"/api/schema/{table_name}")
-        
         try:
-            response = requests.get(
-                url,
-                headers={"Authorization": f"Bearer {self.token}"}
-            )
+            response = self._request("GET", f"/api/schema/{table_name}")
             
             if response.status_code != 200:
                 error_msg = response.json().get("error", "Unknown error")
@@ -212,201 +390,174 @@ class MCPClient:
         if not self.token:
             return None, "Not connected to any database"
         
-        url = urljoin(self.base_url, "/api/query")
+        try:
+            return self._query_result(self._request("POST", "/api/query", json={"query": query}))
+        except Exception as e:
+            logger.error(f"Error executing query: {str(e)}")
+            return f"Error executing query: {str(e)}", None
+    
+    async def aexecute_query(self, query):
+        """Async version of execute_query"""
+        if not self.token:
+            return None, "Not connected to any database"
         
         try:
-            response = requests.post(
-                url,
-                json={"query": query},
-                headers={"Authorization": f"Bearer {self.token}"}
-            )
-            
-            if response.status_code != 200:
-                error_msg = response.json().get("error", "Unknown error")
-                logger.error(f"Error executing query: {error_msg}")
-                return error_msg, None
-            
-            data = response.json()
-            
-            # Convert to pandas DataFrame for compatibility with existing code
-            if data.get("rows"):
-                df = pd.DataFrame(data.get("rows"))
-                return df, None
-            elif data.get("rowCount") is not None:
-                return f"Query executed successfully. Affected rows: {data.get('rowCount')}", None
-            
-            return "Query executed successfully", None
+            return self._query_result(await self._arequest("POST", "/api/query", json={"query": query}))
         except Exception as e:
             logger.error(f"Error executing query: {str(e)}")
             return f"Error executing query: {str(e)}", None
     
-    # Replace the get_table_preview method in mcp_client.py with this updated version
-
-    # Enhanced token handling and reconnection functions for mcp_client.py
-
+    def _query_result(self, response):
+        if response.status_code != 200:
+            error_msg = response.json().get("error", "Unknown error")
+            logger.error(f"Error executing query: {error_msg}")
+            return error_msg, None
+        
+        data = response.json()
+        
+        # Convert to pandas DataFrame for compatibility with existing code
+        if data.get("rows"):
+            df = pd.DataFrame(data.get("rows"))
+            return df, None
+        elif data.get("rowCount") is not None:
+            return f"Query executed successfully. Affected rows: {data.get('rowCount')}", None
+        
+        return "Query executed successfully", None
+    
     def get_table_preview(self, table_name, limit=10):
         """Get a preview of the specified table with enhanced debugging and error handling"""
-        # First verify token is valid
-        token_valid, message = self.verify_token()
-        if not token_valid:
-            logger.warning(f"Token verification failed: {message}")
-            if not self.token and hasattr(self, '_connection_info') and self._connection_info:
-                # Try to reconnect
-                logger.info("Attempting to reconnect")
-                success, msg = self.connect(
-                    self._connection_info.get('server'),
-                    self._connection_info.get('database'),
-                    self._connection_info.get('username'),
-                    self._connection_info.get('password')
-                )
-                if not success:
-                    return None, f"Not connected to any database: {msg}"
-            elif not self.token:
-                return None, "Not connected to any database"
-        
-        url = urljoin(self.base_url, f"/api/preview/{table_name}")
+        if not self.token:
+            return None, "Not connected to any database"
         
         try:
-            # Log the request details for debugging
-            logger.info(f"Requesting preview for table {table_name} with token {self.token[:10] if self.token else 'None'}...")
+            logger.info(f"Requesting preview for table {table_name}")
             
-            # Make the request
-            response = requests.get(
-                url,
-                headers={"Authorization": f"Bearer {self.token}"},
-                params={"limit": limit}
-            )
+            # Expired or rejected tokens are renewed by _request (one retry)
+            response = self._request("GET", f"/api/preview/{table_name}", params={"limit": limit})
+            return self._preview_result(response)
+        except Exception as e:
+            logger.error(f"Error fetching preview: {str(e)}")
+            return None, f"Error fetching preview: {str(e)}"
+    
+    async def aget_table_preview(self, table_name, limit=10):
+        """Async version of get_table_preview"""
+        if not self.token:
+            return None, "Not connected to any database"
+        
+        try:
+            logger.info(f"Requesting preview for table {table_name}")
+            response = await self._arequest("GET", f"/api/preview/{table_name}", params={"limit": limit})
+            return self._preview_result(response)
+        except Exception as e:
+            logger.error(f"Error fetching preview: {str(e)}")
+            return None, f"Error fetching preview: {str(e)}"
+    
+    def _preview_result(self, response):
+        # Log the response status and content preview
+        logger.info(f"Preview response status: {response.status_code}")
+        logger.debug(f"Response content sample: {response.text[:200]}...")
+        
+        if response.status_code in (401, 403):
+            self._clear_token()
+            return None, "Authentication failed. Please reconnect to the database."
+        
+        if response.status_code != 200:
+            # Try to get detailed error message
+            try:
+                error_data = response.json()
+                error_msg = error_data.get("error", "Unknown error")
+            except:
+                error_msg = f"HTTP error {response.status_code}"
             
-            # Log the response status and content preview
-            logger.info(f"Preview response status: {response.status_code}")
-            logger.info(f"Response content sample: {response.text[:200]}...")
+            logger.error(f"Error fetching preview: {error_msg}")
+            return None, error_msg
+        
+        # Process response
+        try:
+            data = response.json()
             
-            # Handle authentication errors with reconnection attempt
-            if response.status_code == 401 or response.status_code == 403:
-                logger.warning("Authentication failed, token may have expired")
-                
-                # Try to reconnect if we have connection info
-                if hasattr(self, '_connection_info') and self._connection_info:
-                    logger.info("Attempting reconnection")
-                    success, message = self.connect(
-                        self._connection_info.get('server'),
-                        self._connection_info.get('database'),
-                        self._connection_info.get('username'),
-                        self._connection_info.get('password')
-                    )
-                    if success:
-                        logger.info("Reconnection successful, retrying preview request")
-                        # Retry the request with new token
-                        return self.get_table_preview(table_name, limit)
-                    else:
-                        self.token = None
-                        logger.error(f"Reconnection failed: {message}")
-                        return None, f"Authentication failed and reconnection attempt failed: {message}"
-                else:
-                    self.token = None
-                    return None, "Authentication failed. Please reconnect to the database."
+            # Log the response structure
+            logger.info(f"Preview response structure: {list(data.keys())}")
             
-            if response.status_code != 200:
-                # Try to get detailed error message
-                try:
-                    error_data = response.json()
-                    error_msg = error_data.get("error", "Unknown error")
-                except:
-                    error_msg = f"HTTP error {response.status_code}"
-                
-                logger.error(f"Error fetching preview: {error_msg}")
-                return None, error_msg
+            # Extract DataFrame from the response data
+            df = None
             
-            # Process response
-            try:
-                data = response.json()
-                
-                # Log the response structure
-                logger.info(f"Preview response structure: {list(data.keys())}")
+            # Case 1: Direct format with rows and headers at top level
+            if "rows" in data and "headers" in data:
+                rows = data["rows"]
+                headers = data["headers"]
                 
-                # Extract DataFrame from the response data
-                df = None
-                
-                # Case 1: Direct format with rows and headers at top level
-                if "rows" in data and "headers" in data:
-                    rows = data["rows"]
-                    headers = data["headers"]
+                if isinstance(rows, list) and isinstance(headers, list):
+                    logger.info(f"Creating DataFrame from direct rows ({len(rows)} rows) and headers ({len(headers)} columns)")
+                    df = pd.DataFrame(rows, columns=headers)
+            
+            # Case 2: Nested format with table containing rows and headers
+            elif "table" in data and isinstance(data["table"], dict):
+                table_data = data["table"]
+                if "rows" in table_data and "headers" in table_data:
+                    rows = table_data["rows"]
+                    headers = table_data["headers"]
                     
                     if isinstance(rows, list) and isinstance(headers, list):
-                        logger.info(f"Creating DataFrame from direct rows ({len(rows)} rows) and headers ({len(headers)} columns)")
+                        logger.info(f"Creating DataFrame from nested table data ({len(rows)} rows)")
                         df = pd.DataFrame(rows, columns=headers)
+            
+            # Case 3: Response contains recordset with objects
+            elif "recordset" in data and isinstance(data["recordset"], list) and len(data["recordset"]) > 0:
+                logger.info(f"Creating DataFrame from recordset ({len(data['recordset'])} rows)")
+                df = pd.DataFrame(data["recordset"])
+            
+            if df is not None:
+                # Add the original data structure to the DataFrame as an attribute
+                # This helps downstream functions that need the original format
+                df.raw_data = data
                 
-                # Case 2: Nested format with table containing rows and headers
-                elif "table" in data and isinstance(data["table"], dict):
-                    table_data = data["table"]
-                    if "rows" in table_data and "headers" in table_data:
-                        rows = table_data["rows"]
-                        headers = table_data["headers"]
-                        
-                        if isinstance(rows, list) and isinstance(headers, list):
-                            logger.info(f"Creating DataFrame from nested table data ({len(rows)} rows)")
-                            df = pd.DataFrame(rows, columns=headers)
-                
-                # Case 3: Response contains recordset with objects
-                elif "recordset" in data and isinstance(data["recordset"], list) and len(data["recordset"]) > 0:
-                    logger.info(f"Creating DataFrame from recordset ({len(data['recordset'])} rows)")
-                    df = pd.DataFrame(data["recordset"])
-                
-                if df is not None:
-                    # Add the original data structure to the DataFrame as an attribute
-                    # This helps downstream functions that need the original format
-                    df.raw_data = data
-                    
-                    # Create a formatted structure that's consistent
-                    formatted_data = {
-                        "headers": df.columns.tolist(),
-                        "rows": df.values.tolist()
-                    }
-                    
-                    # Store the formatted data on the DataFrame
-                    df.formatted_data = formatted_data
-                    
-                    logger.info(f"Successfully created DataFrame with shape {df.shape}")
-                    return df, None
-                
-                # Fallback: try to create a DataFrame from the entire response
-                logger.warning("Could not extract DataFrame with standard methods, attempting direct conversion")
-                try:
-                    df = pd.DataFrame(data)
-                    df.raw_data = data
-                    logger.info(f"Created DataFrame directly from response: {df.shape}")
-                    return df, None
-                except Exception as direct_error:
-                    logger.error(f"Direct conversion failed: {str(direct_error)}")
-                
-                # If we couldn't extract a DataFrame, provide detailed error
-                error_msg = "Could not convert response to DataFrame"
-                logger.error(error_msg)
-                
-                # Log detailed information about the response structure
-                if len(data) > 0:
-                    for key, value in data.items():
-                        logger.error(f"Key '{key}' has value of type '{type(value).__name__}'")
-                        if isinstance(value, (dict, list)) and value:
-                            sample = str(value)[:100] + "..." if len(str(value)) > 100 else str(value)
-                            logger.error(f"Sample of '{key}': {sample}")
-                
-                # Return the original data anyway as a last resort
-                logger.info("Returning original data as a last resort")
-                return data, None
+                # Create a formatted structure that's consistent
+                formatted_data = {
+                    "headers": df.columns.tolist(),
+                    "rows": df.values.tolist()
+                }
                 
-            except Exception as parse_error:
-                logger.error(f"Error parsing response: {str(parse_error)}")
-                # Log response content for debugging
-                try:
-                    logger.error(f"Response content: {response.text[:500]}...")  # Log first 500 chars
-                except:
-                    logger.error("Could not log response content")
-                return None, f"Error parsing response: {str(parse_error)}"
+                # Store the formatted data on the DataFrame
+                df.formatted_data = formatted_data
                 
-        except Exception as e:
-            logger.error(f"Error fetching preview: {str(e)}")
-            return None, f"Error fetching preview: {str(e)}"
+                logger.info(f"Successfully created DataFrame with shape {df.shape}")
+                return df, None
+            
+            # Fallback: try to create a DataFrame from the entire response
+            logger.warning("Could not extract DataFrame with standard methods, attempting direct conversion")
+            try:
+                df = pd.DataFrame(data)
+                df.raw_data = data
+                logger.info(f"Created DataFrame directly from response: {df.shape}")
+                return df, None
+            except Exception as direct_error:
+                logger.error(f"Direct conversion failed: {str(direct_error)}")
+            
+            # If we couldn't extract a DataFrame, provide detailed error
+            error_msg = "Could not convert response to DataFrame"
+            logger.error(error_msg)
+            
+            # Log detailed information about the response structure
+            if len(data) > 0:
+                for key, value in data.items():
+                    logger.error(f"Key '{key}' has value of type '{type(value).__name__}'")
+                    if isinstance(value, (dict, list)) and value:
+                        sample = str(value)[:100] + "..." if len(str(value)) > 100 else str(value)
+                        logger.error(f"Sample of '{key}': {sample}")
+            
+            # Return the original data anyway as a last resort
+            logger.info("Returning original data as a last resort")
+            return data, None
+            
+        except Exception as parse_error:
+            logger.error(f"Error parsing response: {str(parse_error)}")
+            # Log response content for debugging
+            try:
+                logger.error(f"Response content: {response.text[:500]}...")  # Log first 500 chars
+            except:
+                logger.error("Could not log response content")
+            return None, f"Error parsing response: {str(parse_error)}"
 
     def connect(self, server, database, username, password):
         """Connect to a database through the MCP server with connection info caching"""
@@ -421,43 +572,61 @@ class MCPClient:
         }
         
         try:
-            response = requests.post(
-                url,
-                json={
-                    "server": server,
-                    "database": database,
-                    "username": username,
-                    "password": password
-                }
-            )
-            
-            if response.status_code != 200:
-                error_msg = response.json().get("error", "Unknown error")
-                logger.error(f"Connection error: {error_msg}")
-                return False, error_msg
-            
-            data = response.json()
-            self.token = data.get("token")
-            self.connection_id = data.get("connectionId")
-            
-            return True, "Connected successfully"
+            with span("mcp.connect", server=server, database=database) as current:
+                response = requests.post(
+                    url,
+                    json={
+                        "server": server,
+                        "database": database,
+                        "username": username,
+                        "password": password
+                    }
+                )
+                _record_response(current, response)
+            return self._connect_result(response)
         except Exception as e:
             logger.error(f"Error connecting to MCP server: {str(e)}")
             return False, f"Error connecting to MCP server: {str(e)}"
     
+    async def aconnect(self, server, database, username, password):
+        """Async version of connect"""
+        self._connection_info = {
+            'server': server,
+            'database': database,
+            'username': username,
+            'password': password
+        }
+        
+        try:
+            with span("mcp.connect", server=server, database=database) as current:
+                async with _async_client() as client:
+                    response = await client.post(
+                        urljoin(self.base_url, "/api/connect"),
+                        json=self._connection_info
+                    )
+                _record_response(current, response)
+            return self._connect_result(response)
+        except Exception as e:
+            logger.error(f"Error connecting to MCP server: {str(e)}")
+            return False, f"Error connecting to MCP server: {str(e)}"
+    
+    def _connect_result(self, response):
+        if response.status_code != 200:
+            error_msg = response.json().get("error", "Unknown error")
+            logger.error(f"Connection error: {error_msg}")
+            return False, error_msg
+        
+        self._set_token(response.json())
+        
+        return True, "Connected successfully"
+    
     def analyze_question(self, question):
         """Send a natural language question to the MCP server for analysis"""
         if not self.token:
             return None, "Not connected to any database"
         
-        url = urljoin(self.base_url, "/api/analyze")
-        
         try:
-            response = requests.post(
-                url,
-                json={"question": question},
-                headers={"Authorization": f"Bearer {self.token}"}
-            )
+            response = self._request("POST", "/api/analyze", json={"question": question})
             
             if response.status_code != 200:
                 error_msg = response.json().get("error", "Unknown error")
@@ -474,13 +643,8 @@ class MCPClient:
         if not self.token:
             return None, "Not connected to any database"
         
-        url = urljoin(self.base_url, "/api/refresh-tables")
-        
         try:
-            response = requests.post(
-                url,
-                headers={"Authorization": f"Bearer {self.token}"}
-            )
+            response = self._request("POST", "/api/refresh-tables")
             
             if response.status_code != 200:
                 error_msg = response.json().get("error", "Unknown error")
@@ -510,9 +674,7 @@ class MCPClient:
                 logger.error(f"Token refresh error: {error_msg}")
                 return False, error_msg
             
-            data = response.json()
-            self.token = data.get("token")
-            self.connection_id = data.get("connectionId")
+            self._set_token(response.json())
             
             logger.info("Token refreshed successfully")
             return True, "Token refreshed successfully"
@@ -534,8 +696,7 @@ class MCPClient:
             )
             
             # Reset client state regardless of response
-            self.token = None
-            self.connection_id = None
+            self._clear_token()
             
             if response.status_code != 200:
                 error_msg = response.json().get("error", "Unknown error")
@@ -546,6 +707,5 @@ class MCPClient:
         except Exception as e:
             logger.error(f"Error disconnecting: {str(e)}")
             # Reset token and connection ID even if there was an error
-            self.token = None
-            self.connection_id = None
+            self._clear_token()
             return False, f"Error disconnecting: {str(e)}"
\ No newline at end of file
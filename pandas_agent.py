@@ -1,7 +1,6 @@
 import os
 import re
 import sqlite3
-import uuid
 import pandas
 import logging
 from typing import Any, Literal
@@ -11,26 +10,37 @@ from pandas_settings import (
     CRITICAL_FAILURE_FALLBACK_MESSAGE,
     GRAPHRECURSION_FALLBACK_MESSAGE,
     SYSTEM_PROMPT,
+    SYSTEM_PROMPT_APPROXIMATE,
+    SYSTEM_PROMPT_CUBES,
     SYSTEM_PROMPT_DATA,
+    SYSTEM_PROMPT_SQL,
+    SYSTEM_PROMPT_SQL_INDEXED,
 )
+from utils.charts import save_figure
+from utils.cubes import get_cubes
+from utils.dataset_profile import get_dataset_profile
+from utils.dataset_store import get_dataset_store
+from utils.forecasting import forecast
 from utils.extra import patch_langchain_openai_toolcall, show_graph
-from langchain_core.messages import HumanMessage, SystemMessage
+from utils.history import HistoryManager, with_system_prompt
+from utils.regression import get_regression
+from utils.sampling import get_stratified_sample
+from utils.tool_executor import ParallelToolNode
+from utils.llm_usage import UsageCallbackHandler
+from utils.tracing import TracingCallbackHandler
+from langchain_core.messages import HumanMessage, ToolMessage
 from langchain_openai import AzureChatOpenAI
 
-# from langchain_core.tools import tool
+from langchain_core.tools import tool
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import END, START, StateGraph, MessagesState
 from langgraph.graph.state import CompiledStateGraph
-from langgraph.prebuilt import ToolNode
 from langgraph.errors import GraphRecursionError
+from langgraph.utils.runnable import RunnableCallable
 
 # from langchain_experimental.utilities import PythonREPL
 from langchain_experimental.tools.python.tool import PythonAstREPLTool
 
-from sklearn.model_selection import train_test_split
-from sklearn.linear_model import LinearRegression
-from sklearn.metrics import mean_squared_error
-from prophet import Prophet
 
 load_dotenv()
 
@@ -40,6 +50,15 @@ logger = logging.getLogger("kinaxis-agent")
 SHOW_GRAPH = False
 # Liczba wierszy do pokazania w system prompcie
 DF_HEAD_NUM = 6
+# Toolsy bez efektów ubocznych, które mogą się wykonywać równolegle. python_repl_ast
+# współdzieli `df`/locals i stan matplotliba, więc zawsze idzie po kolei.
+# sql_query działa na osobnym, read-only połączeniu, aggregate tylko czyta kostki,
+# regression liczy na własnej kopii cech.
+PARALLEL_SAFE_TOOLS: set[str] = {"sql_query", "aggregate", "regression"}
+# Ile wierszy wyniku sql_query pokazujemy LLM-owi
+SQL_RESULT_ROWS = int(os.getenv("DATASET_SQL_RESULT_ROWS", 50))
+# Budżet tokenów na opis danych (profil kolumn + przykładowe wiersze) w system prompcie
+PROFILE_TOKEN_BUDGET = int(os.getenv("DATASET_PROFILE_TOKEN_BUDGET", 1500))
 
 patch_langchain_openai_toolcall()
 
@@ -51,7 +70,14 @@ class PandasAgent:
     dataframe: pandas.DataFrame
     extra_content: str | None
 
-    def __init__(self, df: pandas.DataFrame, context_memory: Any | None = None):
+    def __init__(
+        self,
+        df: pandas.DataFrame,
+        context_memory: Any | None = None,
+        dataset_version: str | None = None,
+        thread_id: str = "1",
+        approximate: bool = False,
+    ):
         self.memory = MemorySaver()
         if context_memory is not None:
             logger.debug("memory exists")
@@ -59,11 +85,33 @@ class PandasAgent:
         else:
             logger.warn("memory not provided")
         # logger.debug(self.memory.storage)
+        self.thread_id = thread_id
         self.extra_content = None
+        self.system_prompt = SYSTEM_PROMPT
+        self.history = HistoryManager()
         self.dataframe = df
-        df_locals = {"df": self.dataframe}
+        # Profil liczony raz na wersję danych i współdzielony między turami
+        self.profile = get_dataset_profile(df, dataset_version, DF_HEAD_NUM)
+        # Ten sam zbiór jako tabela `df` w bazie SQL (plik per wersja danych, ładowany raz)
+        # Tryb przybliżony: LLM pracuje na próbce warstwowej (None dla małych zbiorów -
+        # wtedy i tak odpowiadamy dokładnie)
+        self.sample = get_stratified_sample(df, self.profile.version) if approximate else None
+        self.approximate = self.sample is not None
+        data = self.sample.frame if self.approximate else df
+        self.store = get_dataset_store(data, self.sample.version if self.approximate else self.profile.version)
+        # Prekalkulowane agregaty "X by Y" (None jeśli wyłączone) - zawsze z pełnych danych,
+        # więc są dokładne także w trybie przybliżonym
+        self.cubes = get_cubes(df, self.profile.version)
+        # Backend Agg jest ustawiony przy imporcie utils.charts
+        df_locals = {"df": data, "save_chart": self._save_chart}
+        if self.approximate:
+            df_locals["estimate"] = self.sample.estimate
         # Toolsy do dyspozycji
-        tools = [PythonAstREPLTool(locals=df_locals)]
+        tools = [PythonAstREPLTool(locals=df_locals), self._create_sql_tool(), self._create_regression_tool()]
+        if self.cubes is not None:
+            tools.append(self._create_aggregate_tool())
+            # Te same agregaty jako DataFrame do wykresów w REPL-u
+            df_locals["aggregate"] = self._aggregate
         # Nasz model LLM
         model = AzureChatOpenAI(
             deployment_name=os.getenv(
@@ -75,26 +123,39 @@ class PandasAgent:
             temperature=0,
         ).bind_tools(tools)
 
-        # Wierzchołek przy początku który "dokleja" do promptów System Message i początek naszej
+        # Wierzchołek przy początku który przygotowuje System Message z opisem naszej
         # tabelki aby LLM wiedział z czym się je, zanim wykona zapytania.
+        # Prompt trzymamy poza historią (checkpointem) - inaczej co turę dokładalibyśmy
+        # kolejną kopię do zapisanej rozmowy.
         def get_dataframe_head(state: MessagesState):
             logger.info("Adding evaluated system prompt")
-            # TODO: zgrabniejszy df -> str, żeby na dużych komórkach w df nie
-            #       marnował tokenów
-            prepared_sysprompt = (
+            self.system_prompt = (
                 SYSTEM_PROMPT
-                + SYSTEM_PROMPT_DATA.format(dhc=DF_HEAD_NUM)
-                + self.dataframe.head(DF_HEAD_NUM).to_string()
+                + SYSTEM_PROMPT_DATA
+                + self.profile.render(PROFILE_TOKEN_BUDGET)
+                + SYSTEM_PROMPT_SQL.format(
+                    dialect=self.store.dialect,
+                    indexed=SYSTEM_PROMPT_SQL_INDEXED.format(
+                        columns=", ".join(f'"{c}"' for c in self.store.indexed_columns)
+                    )
+                    if self.store.indexed_columns
+                    else "",
+                )
             )
-            # logger.debug(prepared_sysprompt)
-            state["messages"].insert(0, SystemMessage(prepared_sysprompt))
+            if self.cubes is not None:
+                self.system_prompt += SYSTEM_PROMPT_CUBES.format(description=self.cubes.describe())
+            if self.approximate:
+                self.system_prompt += SYSTEM_PROMPT_APPROXIMATE.format(description=self.sample.describe())
+            # logger.debug(self.system_prompt)
 
         # Funkcja/wierzchołek która rzeczywiście wysyła zapytanie i obecny stan
         # do naszego modelu LLM.
-        def call_model(state: MessagesState):
-            messages = state["messages"]
+        def prepare_messages(state: MessagesState):
+            history, summary = self.history.compact(state["messages"])
             logger.info("Calling LLM")
-            response = model.invoke(messages)
+            return with_system_prompt(self.system_prompt + summary, history)
+
+        def model_response(response):
             if len(response.content) > 0 and not response.tool_calls:
                 logger.info("LLM Response:\n" + (response.content))
             elif not response.tool_calls:
@@ -102,12 +163,18 @@ class PandasAgent:
             # We return a list, because this will get added to the existing list
             return {"messages": [response]}
 
-        # Wierzchołek do procesowania naszego toola/tooli
-        # TODO: Można w przyszłości np. jednocześnie odpalić kod Pandas i kod SQL który
-        # AI stworzy i je wykonać równocześnie i wziąść lepszy wynik!
+        def call_model(state: MessagesState):
+            return model_response(model.invoke(prepare_messages(state)))
+
+        # Wersja dla ainvoke: na odpowiedź LLM czekamy w pętli zdarzeń, bez blokowania wątku
+        async def acall_model(state: MessagesState):
+            return model_response(await model.ainvoke(prepare_messages(state)))
+
+        # Wierzchołek do procesowania naszego toola/tooli. Toolsy z PARALLEL_SAFE_TOOLS
+        # wykonują się równolegle, reszta po kolei (w kolejności wywołań).
         #
         # Tu istnieją jeszcze dwa node'y do logowania bo nie wiem jak to lepiej zrobić :/
-        tool_node = ToolNode(tools)
+        tool_node = ParallelToolNode(tools, PARALLEL_SAFE_TOOLS)
 
         def tool_node_pre(state: MessagesState):
             available_tools = {tool.name for tool in tools}
@@ -132,14 +199,8 @@ class PandasAgent:
                         remove_extra_pattern = re.compile(r"(\S*)plt.savefig\(.*")
                         plt_pattern = re.compile(r"(\S*)(plt\.show\(\))")
                         code = remove_extra_pattern.sub("", code)
-                        self.extra_content = uuid.uuid4()
-                        code = plt_pattern.sub(
-                            f'\\1plt.savefig("./frontend/dist/assets/{self.extra_content}.png")',
-                            code,
-                        )
+                        code = plt_pattern.sub(r"\1save_chart()", code)
                         # TODO: import common things used by gpt, like "pd".
-                        # TODO: Tie this image to the session somehow.
-                        code = 'import matplotlib\nmatplotlib.use("agg")\n' + code
                         tc["extra"] = dict()
                         tc["extra"]["original_code"] = original_code
                         tc["extra"]["modified_code"] = code
@@ -150,14 +211,19 @@ class PandasAgent:
                     logger.debug(f"##### Code to be executed: #####\n{code}")
 
         def tool_node_post(state: MessagesState):
-            msg = state["messages"][-1]
-            # Azure OpenAI is stupid.
-            if isinstance(msg.content, str):
-                msg.content = [{"type": "text", "text": msg.content}]
-            logger.info("Tool call finished")
-            logger.debug(f"Tool call result:\n{msg.content}")
+            # Jedna wiadomość AI może zlecić kilka tool calli - każdy ma swój ToolMessage
+            n_results = 0
+            for msg in reversed(state["messages"]):
+                if not isinstance(msg, ToolMessage):
+                    break
+                n_results += 1
+                # Azure OpenAI is stupid.
+                if isinstance(msg.content, str):
+                    msg.content = [{"type": "text", "text": msg.content}]
+                logger.info("Tool call finished")
+                logger.debug(f"Tool call result:\n{msg.content}")
             # "Cicha" podmiana kodu - cofnięcie, żeby była... "cicha"
-            call_msg = state["messages"][-2]
+            call_msg = state["messages"][-1 - n_results]
             for tc in call_msg.tool_calls:
                 if "extra" not in tc:
                     continue
@@ -193,7 +259,7 @@ class PandasAgent:
 
         # Poszczególne wierzchołki
         graph.add_node("df_head", get_dataframe_head)
-        graph.add_node("agent", call_model)
+        graph.add_node("agent", RunnableCallable(call_model, acall_model, name="agent"))
         graph.add_node("tools_pre", tool_node_pre)
         graph.add_node("tools", tool_node)
         graph.add_node("tools_post", tool_node_post)
@@ -233,19 +299,69 @@ class PandasAgent:
         # TODO: Co jak wrzucimy kilka plików .csv? Kilka DF jak to jest w wbudowanym
         #       pandas agencie?
 
+    def _create_sql_tool(self):
+        store = self.store
+
+        @tool
+        def sql_query(query: str) -> str:
+            """Run a read-only SQL query against the table `df` (the uploaded dataset) and return the result."""
+            logger.info(f"Executing SQL on dataset {store.version}: {query}")
+            try:
+                result, truncated = store.query(query, SQL_RESULT_ROWS)
+            except Exception as e:
+                logger.info(f"Dataset SQL failed: {e}")
+                return f"Error executing query: {e}"
+            if truncated:
+                return (
+                    f"Query returned more than {SQL_RESULT_ROWS} rows. First {SQL_RESULT_ROWS} rows:\n"
+                    f"{result.to_string()}\nAggregate or filter in SQL to see the rest."
+                )
+            return result.to_string()
+
+        return sql_query
+
+    def _save_chart(self):
+        # Podmieniony plt.show(): zapis bieżącej figury (nazwa z hasza jej zawartości)
+        self.extra_content = save_figure()
+
+    def _aggregate(self, group_by, measure: str, aggregation: str) -> pandas.DataFrame:
+        if isinstance(group_by, str):
+            group_by = [g.strip() for g in group_by.split(",") if g.strip()]
+        result = self.cubes.lookup(group_by, measure, aggregation)
+        if result is None:
+            raise ValueError(
+                f"No precomputed aggregate for {aggregation}({measure}) by {group_by}. "
+                f"Available {self.cubes.describe()}"
+            )
+        return result
+
+    def _create_aggregate_tool(self):
+        @tool
+        def aggregate(group_by: str, measure: str, aggregation: str) -> str:
+            """
+            Precomputed aggregate of `df`: `aggregation` (sum, count, min, max, avg) of `measure`
+            grouped by one or two comma-separated dimensions in `group_by`.
+            """
+            try:
+                result = self._aggregate(group_by, measure, aggregation)
+            except ValueError as e:
+                return f"{e}. Use sql_query or python_repl_ast instead."
+            if len(result) > SQL_RESULT_ROWS:
+                return (
+                    f"{len(result)} groups. First {SQL_RESULT_ROWS}:\n"
+                    f"{result.head(SQL_RESULT_ROWS).to_string()}"
+                )
+            return result.to_string()
+
+        return aggregate
+
     def invoke(self, message, full_context=False):
-        config = {
-            "thread_id": "1",
-            # Increase this to, say, 50 or 100
-            "recursion_limit": 50,
-        }
+        config = self._turn_config()
         try:
             messages = self.graph.invoke(
                 {"messages": [HumanMessage(content=message)]}, config
             )
-            if full_context:
-                return messages
-            return messages["messages"][-1].content
+            return self._turn_result(messages, full_context)
         except GraphRecursionError as e:
             logger.exception(e)
             return GRAPHRECURSION_FALLBACK_MESSAGE
@@ -253,57 +369,85 @@ class PandasAgent:
             logger.exception(e)
             return CRITICAL_FAILURE_FALLBACK_MESSAGE
 
+    async def ainvoke(self, message, full_context=False):
+        """Async version of invoke (ASGI serving mode); tools still run in the loop's executor"""
+        config = self._turn_config()
+        try:
+            messages = await self.graph.ainvoke(
+                {"messages": [HumanMessage(content=message)]}, config
+            )
+            return self._turn_result(messages, full_context)
+        except GraphRecursionError as e:
+            logger.exception(e)
+            return GRAPHRECURSION_FALLBACK_MESSAGE
+        except Exception as e:
+            logger.exception(e)
+            return CRITICAL_FAILURE_FALLBACK_MESSAGE
+
+    def _turn_config(self):
+        self.history.reset_turn()
+        # Wywołania LLM i tokeny tej tury (app.record_usage dopisuje je do statystyk)
+        self.usage = UsageCallbackHandler()
+        return {
+            "thread_id": self.thread_id,
+            # Increase this to, say, 50 or 100
+            "recursion_limit": 50,
+            # Spany dla każdego węzła grafu, wywołania LLM i toola
+            "callbacks": [TracingCallbackHandler("pandas"), self.usage],
+        }
+
+    def _turn_result(self, messages, full_context):
+        logger.info(f"History tokens saved this turn: {self.history.turn_tokens_saved}")
+        if full_context:
+            return messages
+        return messages["messages"][-1].content
+
     def clear_memory(self):
         logger.info("Clearing chat context (storage/memory)")
-        self.memory.storage.clear()
-        logger.debug(self.memory.storage)
+        if hasattr(self.memory, "delete_thread"):
+            self.memory.delete_thread(self.thread_id)
+        else:
+            self.memory.storage.clear()
 
     def forecast_time_series(
-        self, date_column: str, value_column: str, periods: int = 10
+        self, date_column: str, value_column: str, periods: int = 10, model: str | None = None
     ):
-        # Ensure columns exist
-        if (
-            date_column not in self.dataframe.columns
-            or value_column not in self.dataframe.columns
-        ):
-            return "The specified columns do not exist in the dataframe."
-
-        # Prepare data for Prophet
-        df_prophet = self.dataframe[[date_column, value_column]].rename(
-            columns={date_column: "ds", value_column: "y"}
-        )
-
-        # Initialize and fit the Prophet model
-        model = Prophet()
-        model.fit(df_prophet)
-
-        # Create a dataframe for future predictions
-        future = model.make_future_dataframe(periods=periods)
-        forecast = model.predict(future)
-
-        # Return the forecast
-        return forecast[["ds", "yhat", "yhat_lower", "yhat_upper"]]
+        # Model dopasowany raz na zawartość szeregu (cache w utils.forecasting);
+        # "auto" wybiera model po błędzie na odłożonym końcu szeregu, Prophet tylko gdy wyraźnie wygrywa
+        try:
+            return forecast(self.dataframe, date_column, value_column, periods, model=model)
+        except ValueError as e:
+            return str(e)
 
     def predict_with_regression(self, feature_columns, target_column):
-        # Ensure columns exist
-        for col in feature_columns + [target_column]:
-            if col not in self.dataframe.columns:
-                return f"Column '{col}' does not exist in the dataframe."
-
-        X = self.dataframe[feature_columns]
-        y = self.dataframe[target_column]
-
-        X_train, X_test, y_train, y_test = train_test_split(
-            X, y, test_size=0.2, random_state=42
-        )
-
-        model = LinearRegression()
-        model.fit(X_train, y_train)
-
-        predictions = model.predict(X_test)
-        mse = mean_squared_error(y_test, predictions)
-
-        return {"mse": mse, "predictions": predictions.tolist()}
+        # Model (z walidacją krzyżową) liczony raz na wersję danych i zestaw cech, zapisywany na dysk
+        try:
+            return get_regression(self.dataframe, feature_columns, target_column, self.profile.version).summary
+        except ValueError as e:
+            return str(e)
+
+    def _create_regression_tool(self):
+        @tool
+        def regression(feature_columns: str, target_column: str) -> str:
+            """
+            Fit a linear regression of `target_column` on the comma-separated `feature_columns` of `df`
+            (text columns are one-hot encoded) and return its k-fold cross-validated MSE and R2 and its coefficients.
+            """
+            features = [c.strip() for c in feature_columns.split(",") if c.strip()]
+            result = self.predict_with_regression(features, target_column.strip())
+            if isinstance(result, str):
+                return result
+            coefficients = sorted(result["coefficients"].items(), key=lambda c: -abs(c[1]))
+            lines = [
+                f"Linear regression of {result['target']} on {', '.join(result['features'])} ({result['n_rows']} rows)",
+                f"{result['folds']}-fold CV: MSE {result['mse']:.6g} (std {result['mse_std']:.3g}), R2 {result['r2']:.4f}",
+                f"Intercept: {result['intercept']:.6g}",
+                "Coefficients (largest first):",
+            ]
+            lines.extend(f"  {name}: {value:.6g}" for name, value in coefficients[:SQL_RESULT_ROWS])
+            return "\n".join(lines)
+
+        return regression
 
 
 # Test
@@ -33,9 +33,37 @@ The image will be shown automatically to the user.
     + AZURE_OAI_SAFETY_MESSAGES
 )
 
-# the prompt that'll show up below the main system prompt showing a part of the dataframe.
+# the prompt that'll show up below the main system prompt, followed by a compact profile of the dataframe.
 SYSTEM_PROMPT_DATA = """
-Here are the first {dhc} rows of `df` (result of `df.head({dhc})`):
+Here is a summary of `df` (column names, dtypes, null counts, number of unique values, value ranges and sample values; long values are truncated with "…"):
+"""
+
+# the prompt describing the SQL tool; {dialect} is the SQL engine holding the dataset
+SYSTEM_PROMPT_SQL = """
+The same data is also available as the table `df` in a read-only {dialect} database, which you can query with the `sql_query` tool.
+Prefer `sql_query` for filtering, group-bys and aggregations (COUNT, SUM, AVG, MIN, MAX), especially on large data; use `python_repl_ast` for everything else (charts, forecasting, reshaping).
+Always quote column names with double quotes in SQL.{indexed}
+"""
+
+# appended to SYSTEM_PROMPT_SQL when the dataset has indexed columns
+SYSTEM_PROMPT_SQL_INDEXED = """
+These columns are indexed, filters on them (=, IN, <, >, BETWEEN) are fast: {columns}.
+Date and datetime columns are stored as 'YYYY-MM-DD HH:MM:SS' text (whatever their format in the file), so compare them with values in that format."""
+
+# the prompt describing the precomputed aggregates; {description} lists the dimensions and measures
+SYSTEM_PROMPT_CUBES = """
+Aggregates of `df` are precomputed ({description}). Dates are available truncated to a day or a month as "<column>:day" / "<column>:month".
+For "measure by dimension" questions (sum, count, min, max, avg of a measure grouped by one or two dimensions) call the `aggregate` tool first, it answers instantly; use `"*"` as the measure with `count` to count rows.
+Inside `python_repl_ast` the function `aggregate(group_by, measure, aggregation)` (group_by is a list of dimension names) returns the same result as a DataFrame - use it as the data for charts of such aggregates.
+"""
+
+# approximate mode; {description} says how big the sample is
+SYSTEM_PROMPT_APPROXIMATE = """
+APPROXIMATE MODE: the user asked for a fast, approximate first look. `df` (and the SQL table `df`) is a stratified random sample ({description}) of the full dataset, not the full data.
+Column `_weight` is the number of full-dataset rows each sample row stands for; `_stratum` is the sampling stratum. Never show these two columns to the user.
+For counts, sums and means use `estimate(column, agg, by=None)` in `python_repl_ast` (agg is "count", "sum" or "mean"; column is None for "count"; by is an optional column or list of columns).
+It returns the full-dataset estimate with a 95% confidence interval (`ci_low`, `ci_high`) and `relative_error`.
+Present the results as approximate with their margin of error, and mention that an exact answer can be requested.
 """
 
 GRAPHRECURSION_FALLBACK_MESSAGE = """
@@ -1,9 +1,10 @@
+import asyncio
 import os
 import logging
 from typing import Any, Literal, List, Dict
 import pandas as pd
 import re
-import uuid
+import threading
 
 import time
 
@@ -14,22 +15,62 @@ from pandas_settings import (
     SYSTEM_PROMPT_DATA,
 )
 
+from utils.charts import CHART_OUTPUT, chart_spec, render_chart
+from utils.connection_cache import get_connection_cache
+from utils.prefetch import load_preview, load_row_counts, load_schema
+from utils.sql_shaping import (
+    SQL_FULL_FETCH_MAX_ROWS,
+    SQL_RESULT_ROW_LIMIT,
+    aggregate_query,
+    count_query,
+    limit_query,
+    referenced_tables,
+    sample_query,
+)
 from utils.extra import patch_langchain_openai_toolcall, show_graph
+from utils.history import HistoryManager, with_system_prompt
+from utils.tokens import count_tokens
+from utils.single_flight import SingleFlight
+from utils.tool_executor import ParallelToolNode, current_call_order
+from utils.llm_usage import UsageCallbackHandler
+from utils.tracing import TracingCallbackHandler, span
 from dotenv import load_dotenv
-from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.messages import HumanMessage
 from langchain_openai import AzureChatOpenAI
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import END, START, StateGraph, MessagesState
-from langgraph.prebuilt import ToolNode
 from langgraph.errors import GraphRecursionError
+from langgraph.utils.runnable import RunnableCallable
 from langchain_core.tools import tool
 
 # Import the MCP client
-from mcp_client import MCPClient
+from mcp_client import MCPClient, connection_key
 
 load_dotenv()
 logger = logging.getLogger("kinaxis-sql-agent")
 
+# How many table schemas (at most) go into the system prompt
+SCHEMA_TOP_K = int(os.getenv("SQL_SCHEMA_TOP_K", 8))
+# Token budget for the table list + schemas part of the system prompt
+SCHEMA_TOKEN_BUDGET = int(os.getenv("SQL_SCHEMA_TOKEN_BUDGET", 2500))
+# Databases with at most this many tables get the full table list in the prompt
+FULL_TABLE_LIST_MAX = int(os.getenv("SQL_FULL_TABLE_LIST_MAX", 100))
+# Columns shown per table schema in the prompt
+SCHEMA_MAX_COLUMNS = 20
+# Read-only tools which can run concurrently when the LLM asks for several at once
+PARALLEL_SAFE_TOOLS = {"sql_query", "describe_table", "search_tables"}
+# Approximate mode: tables with at least this many rows are read through TABLESAMPLE
+SQL_APPROX_MIN_ROWS = int(os.getenv("SQL_APPROX_MIN_ROWS", 1000000))
+# Approximate mode: rows (roughly) read from a sampled table
+SQL_APPROX_SAMPLE_ROWS = int(os.getenv("SQL_APPROX_SAMPLE_ROWS", 100000))
+# Attempts at connecting and at loading the table list before an agent gives up
+CONNECT_RETRIES = 3
+# Agents created at the same time for the same connection (the frontend checks the
+# connection from several components at once) share one connect and table listing
+_agent_connects = SingleFlight("sql_agent_connect")
+# Answer of a turn that ran into the recursion limit of the graph
+GRAPH_RECURSION_MESSAGE = "I apologize, but I'm unable to process this request due to complexity limitations. Could you try simplifying your question?"
+
 SYSTEM_PROMPT_SQL = """
 You are an SQL expert assistant that converts natural language questions into SQL queries.
 Your primary task is to understand the user's question about their data and generate the appropriate SQL query to answer it.
@@ -37,14 +78,14 @@ Your primary task is to understand the user's question about their data and gene
 Here are the tables available in the database:
 {table_list}
 
-Here are the schemas for the most important tables:
+Here are the schemas for the tables most relevant to the question:
 {table_schemas}
 
 RULES:
 1. Always write SQL queries that are compatible with Microsoft SQL Server.
 2. When writing queries, focus on precision and clarity.
 3. For complex questions, break down your reasoning step by step.
-4. If you're unsure about a table schema, use the describe_table tool to check the schema before writing a query.
+4. If you're unsure about a table schema, use the describe_table tool to check the schema before writing a query. If the table you need is not listed, use the search_tables tool to find it.
 5. Always use proper SQL syntax and follow best practices.
 6. NEVER make up tables or columns that are not in the provided schema.
 7. If you cannot answer a question with the available schema, explain why.
@@ -70,11 +111,20 @@ create_chart(chart_type="bar", x_column="ProductName", y_column="TotalSales", ti
 
 """
 
+SYSTEM_PROMPT_APPROXIMATE = """
+APPROXIMATE MODE: the user asked for a fast, approximate first look. Large tables are sampled automatically by the sql_query tool (do not add TABLESAMPLE yourself).
+Follow the scaling instructions that come with sampled results, present the figures as approximate with their margin of error, and mention that an exact answer can be requested.
+"""
+
 class SQLAgent:
     """Agent for handling natural language to SQL queries using Azure OpenAI and MCP Server"""
     
-    def __init__(self, server, database, username, password, context_memory=None):
+    def __init__(self, server, database, username, password, context_memory=None, thread_id="sql_agent", approximate=False, connect=True):
         self.memory = MemorySaver() if context_memory is None else context_memory
+        self.thread_id = thread_id
+        # Approximate mode reads large tables through TABLESAMPLE; approximate_used tells if it happened
+        self.approximate = approximate
+        self.approximate_used = False
         self.server = server
         self.database = database
         self.username = username
@@ -82,80 +132,161 @@ class SQLAgent:
         
         # Initialize MCP client
         self.mcp_client = MCPClient()
+        # Table list, schemas and the schema index are shared by all requests on this connection
+        self.connection_cache = get_connection_cache(self._connection_key())
         
-        # Connect with retry logic
-        max_retries = 3
-        retry_count = 0
-        connection_success = False
+        # acreate connects with the async MCP client instead
+        if connect:
+            self._connect()
+            self._setup()
+    
+    @classmethod
+    async def acreate(cls, server, database, username, password, context_memory=None, thread_id="sql_agent", approximate=False):
+        """Async constructor for the ASGI serving mode: connecting and listing the tables are awaited"""
+        agent = cls(server, database, username, password, context_memory, thread_id, approximate, connect=False)
+        await agent._aconnect()
+        agent._setup()
+        return agent
+    
+    def _connection_key(self):
+        return connection_key(self.mcp_client.base_url, self.server, self.database, self.username, self.password)
+    
+    def _adopt(self, connected):
+        client, tables = connected
+        if client is not self.mcp_client:
+            self.mcp_client.adopt(client)
+        self.tables = tables
+    
+    def _connect(self):
+        """Connect to the MCP server and load the table list, or join a concurrent agent doing it"""
+        with span("sql.connect", database=self.database):
+            self._adopt(_agent_connects.do(self._connection_key(), self._connect_once))
+    
+    async def _aconnect(self):
+        """Async version of _connect"""
+        with span("sql.connect", database=self.database):
+            self._adopt(await _agent_connects.ado(self._connection_key(), self._aconnect_once))
+    
+    def _connect_once(self):
+        calls = {
+            "connect": lambda: self.mcp_client.connect(self.server, self.database, self.username, self.password),
+            "get_tables": self.mcp_client.get_tables,
+            "refresh_token": self.mcp_client.refresh_token,
+            "sleep": time.sleep,
+        }
+        steps = self._connect_steps()
+        result = None
+        try:
+            while True:
+                call, *args = steps.send(result)
+                result = calls[call](*args)
+        except StopIteration as done:
+            self.tables = done.value
+        return self.mcp_client, self.tables
+    
+    async def _aconnect_once(self):
+        calls = {
+            "connect": lambda: self.mcp_client.aconnect(self.server, self.database, self.username, self.password),
+            "get_tables": self.mcp_client.aget_tables,
+            "refresh_token": lambda: asyncio.to_thread(self.mcp_client.refresh_token),
+            "sleep": asyncio.sleep,
+        }
+        steps = self._connect_steps()
+        result = None
+        try:
+            while True:
+                call, *args = steps.send(result)
+                result = await calls[call](*args)
+        except StopIteration as done:
+            self.tables = done.value
+        return self.mcp_client, self.tables
+    
+    def _connect_steps(self):
+        """
+        Retry policy of connecting and loading the table list, shared by
+        _connect_once and _aconnect_once: yields the MCP calls (and pauses) to
+        make as ("connect" | "get_tables" | "refresh_token" | "sleep", *args),
+        receives their results and returns the table list.
+        """
         error_message = ""
-        
-        while retry_count < max_retries and not connection_success:
-            success, message = self.mcp_client.connect(server, database, username, password)
+        for attempt in range(1, CONNECT_RETRIES + 1):
+            success, message = yield ("connect",)
             if success:
-                connection_success = True
-                # Verify token works
-                token_valid, _ = self.mcp_client.verify_token()
-                if not token_valid:
-                    logger.warning("Token created but failed verification, retrying...")
-                    retry_count += 1
-                    time.sleep(1)
-                    continue
+                # The token is checked by the first real call (get_tables below)
                 break
-            else:
-                retry_count += 1
-                error_message = message
-                if retry_count < max_retries:
-                    logger.warning(f"Connection attempt {retry_count} failed: {message}. Retrying in 2 seconds...")
-                    time.sleep(2)  # Add a short delay between retries
-        
-        if not connection_success:
-            raise Exception(f"Failed to connect to database after {max_retries} attempts: {error_message}")
+            error_message = message
+            if attempt < CONNECT_RETRIES:
+                logger.warning(f"Connection attempt {attempt} failed: {message}. Retrying in 2 seconds...")
+                yield ("sleep", 2)
+        else:
+            raise Exception(f"Failed to connect to database after {CONNECT_RETRIES} attempts: {error_message}")
         
-        # Get tables via MCP with retry logic
-        retry_count = 0
-        tables_success = False
+        # Get tables via MCP with retry logic, unless the cached list is still fresh
+        if self.connection_cache.tables_fresh():
+            return self.connection_cache.tables
         
-        while retry_count < max_retries and not tables_success:
-            self.tables, error = self.mcp_client.get_tables()
+        for attempt in range(1, CONNECT_RETRIES + 1):
+            tables, error = yield ("get_tables",)
             if not error:
-                tables_success = True
-                break
-            else:
-                retry_count += 1
-                if retry_count < max_retries:
-                    logger.warning(f"Failed to get tables (attempt {retry_count}): {error}. Retrying...")
-                    # Try to refresh token before retrying
-                    refresh_success, _ = self.mcp_client.refresh_token()
-                    if not refresh_success:
-                        # If refresh fails, try to reconnect
-                        self.mcp_client.connect(server, database, username, password)
-                    time.sleep(1)
-        
-        if not tables_success:
-            raise Exception(f"Failed to get tables: {error}")
-        
-        # Initialize schema cache
-        self.schemas = {}
+                self.connection_cache.set_tables(tables)
+                return tables
+            if attempt < CONNECT_RETRIES:
+                logger.warning(f"Failed to get tables (attempt {attempt}): {error}. Retrying...")
+                # Try to refresh token before retrying
+                refresh_success, _ = yield ("refresh_token",)
+                if not refresh_success:
+                    # If refresh fails, try to reconnect
+                    yield ("connect",)
+                yield ("sleep", 1)
+        raise Exception(f"Failed to get tables: {error}")
+    
+    def _setup(self):
+        """Per-request state (after connecting)"""
+        self.schemas = self.connection_cache.schemas
+        self.schema_index = self.connection_cache.schema_index
+        self.prompt_stats = {}
+        self.system_prompt = ""
+        self.history = HistoryManager()
         
         # Track important tables (those mentioned in queries)
         self.important_tables = set()
         self.extra_content = None
+        # JSON chart for client-side rendering (CHART_OUTPUT "spec"/"both")
+        self.chart_spec = None
         self.last_query_result = None
+        # Query behind last_query_result and whether its rows were capped at SQL_RESULT_ROW_LIMIT
+        self.last_query = None
+        self.last_query_truncated = False
+        self.turn_stats = {}
+        # Order of the sql_query call that produced last_query_result, so concurrent
+        # queries leave the result of the last requested one
+        self._last_result_order = (-1, -1)
+        self._result_lock = threading.Lock()
+        # Built by the first invoke; previews and connection checks never need them
+        self.tools = None
+        self.model = None
+        self.graph = None
+    
+    def _build_graph(self):
+        """Tools, LLM and graph of the agent (about 0.1s of CPU, so only once a question is asked)"""
+        if self.graph is not None:
+            return
         
-        # Create tools first, before setting up the graph
-        self.tools = self._create_tools()
+        with span("agent.build", agent="sql"):
+            # Create tools first, before setting up the graph
+            self.tools = self._create_tools()
         
-        # Initialize LLM
-        self.model = AzureChatOpenAI(
-            deployment_name=os.getenv("AZURE_OPENAI_DEPLOYMENT"),
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            openai_api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-            temperature=0,
-        ).bind_tools(self.tools)
+            # Initialize LLM
+            self.model = AzureChatOpenAI(
+                deployment_name=os.getenv("AZURE_OPENAI_DEPLOYMENT"),
+                azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+                api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+                openai_api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+                temperature=0,
+            ).bind_tools(self.tools)
         
-        # Setup graph after tools and model are initialized
-        self._setup_graph()
+            # Setup graph after tools and model are initialized
+            self._setup_graph()
     
     def _create_tools(self):
         """Create and return the tools for the agent"""
@@ -172,18 +303,44 @@ class SQLAgent:
                         if table and table in self.tables:
                             self.important_tables.add(table)
                 
-                result, error = self.mcp_client.execute_query(query)
+                approximate_note = ""
+                if self.approximate:
+                    query, approximate_note = self._sample_large_table(query)
+                
+                # Fetch one row more than the cap to know whether the result was cut
+                shaped_query, limited = limit_query(query, SQL_RESULT_ROW_LIMIT + 1)
+                result, error = self.mcp_client.execute_query(shaped_query)
                 if error:
                     return f"Error executing query: {error}"
                 
                 if isinstance(result, pd.DataFrame):
+                    truncated = limited and len(result) > SQL_RESULT_ROW_LIMIT
+                    if truncated:
+                        result = result.head(SQL_RESULT_ROW_LIMIT)
+                        # sql_query runs on several ParallelToolNode threads at once
+                        with self._result_lock:
+                            self.turn_stats["queries_truncated"] = self.turn_stats.get("queries_truncated", 0) + 1
+                    
                     # Save the result for potential visualization
-                    self.last_query_result = result
+                    order = current_call_order()
+                    with self._result_lock:
+                        if order >= self._last_result_order:
+                            self.last_query_result = result
+                            self.last_query = query
+                            self.last_query_truncated = truncated
+                            self._last_result_order = order
                     
+                    if truncated:
+                        return (
+                            f"Query returned more than {SQL_RESULT_ROW_LIMIT} rows ({self._count_rows(query)} in total); "
+                            f"only the first {SQL_RESULT_ROW_LIMIT} were fetched. First 20 rows:\n{result.head(20).to_string()}\n"
+                            "Aggregate in SQL (GROUP BY with SUM/COUNT/AVG) or filter with WHERE rather than reading raw rows. "
+                            "create_chart fetches the complete result by itself."
+                        ) + approximate_note
                     if len(result) > 20:
-                        return f"Query returned {len(result)} rows. First 20 rows:\n{result.head(20).to_string()}"
+                        return f"Query returned {len(result)} rows. First 20 rows:\n{result.head(20).to_string()}" + approximate_note
                     else:
-                        return result.to_string()
+                        return result.to_string() + approximate_note
                 else:
                     return result
             except Exception as e:
@@ -198,25 +355,22 @@ class SQLAgent:
             
             # Add to important tables
             self.important_tables.add(table_name)
+            self.connection_cache.record_usage(table_name)
             
             # Get schema via MCP if not already cached
-            if table_name not in self.schemas:
-                schema_df, error = self.mcp_client.get_table_schema(table_name)
-                if error:
-                    return f"Error fetching schema: {error}"
-                self.schemas[table_name] = schema_df
-            
-            schema = self.schemas[table_name]
+            schema, error = self._load_schema(table_name)
+            if error:
+                return f"Error fetching schema: {error}"
             
-            # Get a sample of the data (first 5 rows)
+            # Get a sample of the data (first 5 rows), usually already prefetched
             try:
-                sample_data, error = self.mcp_client.get_table_preview(table_name, 5)
+                sample_data, error = load_preview(self.mcp_client, self.connection_cache, table_name)
                 if error:
                     # Return just the schema if we couldn't get sample data
                     return f"Schema for table {table_name}:\n{schema.to_string()}"
                 
                 if isinstance(sample_data, pd.DataFrame) and not sample_data.empty:
-                    sample_str = sample_data.to_string()
+                    sample_str = sample_data.head(5).to_string()
                     return f"Schema for table {table_name}:\n{schema.to_string()}\n\nSample data (first 5 rows):\n{sample_str}"
             except Exception as e:
                 logger.error(f"Error getting sample data: {str(e)}")
@@ -240,11 +394,6 @@ class SQLAgent:
             Returns:
             - Message indicating chart was created
             """
-            # Import and configure matplotlib to use a non-interactive backend
-            import matplotlib
-            matplotlib.use('Agg')  # Use the Agg backend which doesn't require a GUI
-            import matplotlib.pyplot as plt
-            
             logger.info(f"Creating {chart_type} chart with x={x_column}, y={y_column}")
             
             if not hasattr(self, 'last_query_result') or self.last_query_result is None:
@@ -261,8 +410,13 @@ class SQLAgent:
                 if col not in df.columns:
                     return f"Column '{col}' not found in the query result."
             
+            # The agent only saw the first rows; charts need the complete result
+            aggregated = False
+            if self.last_query_truncated:
+                df, aggregated = self._fetch_chart_data(x_column, y_columns, aggregation)
+            
             # Apply aggregation if specified and not empty
-            if aggregation and aggregation.strip():
+            if aggregation and aggregation.strip() and not aggregated:
                 valid_aggs = ['sum', 'avg', 'average', 'mean', 'min', 'max', 'count']
                 if aggregation.lower() not in valid_aggs:
                     return f"Invalid aggregation function. Choose from: {', '.join(valid_aggs)}"
@@ -276,124 +430,206 @@ class SQLAgent:
                 agg_dict = {col: agg_func for col in y_columns}
                 df = df.groupby(x_column).agg(agg_dict).reset_index()
             
-            # Create the chart
-            plt.figure(figsize=(10, 6))
-            
+            chart_type = chart_type.lower()
+            if not (title and title.strip()):
+                title = f"{chart_type.capitalize()} chart of {', '.join(y_columns)} by {x_column}"
             try:
-                chart_type = chart_type.lower()
-                if chart_type == 'bar':
-                    df.set_index(x_column)[y_columns].plot(kind='bar')
-                elif chart_type == 'line':
-                    df.set_index(x_column)[y_columns].plot(kind='line')
-                elif chart_type == 'scatter':
-                    # For scatter, we only use the first y column
-                    plt.scatter(df[x_column], df[y_columns[0]])
-                    plt.xlabel(x_column)
-                    plt.ylabel(y_columns[0])
-                elif chart_type == 'pie' and len(y_columns) == 1:
-                    # For pie charts, we need numeric values and labels
-                    df.set_index(x_column)[y_columns[0]].plot(kind='pie', autopct='%1.1f%%')
-                elif chart_type == 'histogram' and len(y_columns) == 1:
-                    df[y_columns[0]].plot(kind='hist', bins=10)
-                    plt.xlabel(y_columns[0])
-                else:
-                    return f"Unsupported chart type: {chart_type} with the given columns."
-                
-                # Set title
-                if title and title.strip():
-                    plt.title(title)
-                else:
-                    plt.title(f"{chart_type.capitalize()} chart of {', '.join(y_columns)} by {x_column}")
-                
-                # Generate a unique filename for the chart
-                chart_id = str(uuid.uuid4())
-                self.extra_content = chart_id
-                plt.tight_layout()
-                plt.savefig(f"./frontend/dist/assets/{chart_id}.png")
-                plt.close()  # Make sure to close the plot to prevent memory leaks
-                
+                if CHART_OUTPUT in ("spec", "both"):
+                    self.chart_spec = chart_spec(df, chart_type, x_column, y_columns, title)
+                if CHART_OUTPUT != "spec":
+                    self.extra_content = render_chart(df, chart_type, x_column, y_columns, title)
                 return f"Chart created successfully. The {chart_type} chart shows {', '.join(y_columns)} by {x_column}."
             except Exception as e:
                 logger.error(f"Error creating chart: {str(e)}")
-                plt.close()  # Make sure to close even if there's an error
                 return f"Error creating chart: {str(e)}"
         
+        @tool
+        def search_tables(keywords: str) -> str:
+            """Find tables whose names, columns or descriptions match the given keywords."""
+            ranked = self.schema_index.rank(keywords, 20, self.important_tables)
+            if not ranked:
+                return f"No tables matching '{keywords}' found."
+            return "Matching tables (best first):\n" + "\n".join(f"- {table}" for table, _ in ranked)
+        
         # Return the list of tools
-        return [sql_query, describe_table, create_chart]
+        return [sql_query, describe_table, create_chart, search_tables]
+    
+    def _load_schema(self, table):
+        """Return the (cached) schema DataFrame for a table and an error, if any"""
+        return load_schema(self.mcp_client, self.connection_cache, table)
+    
+    def _sample_large_table(self, query):
+        """
+        Approximate mode: read the largest table of the query through
+        TABLESAMPLE so roughly SQL_APPROX_SAMPLE_ROWS of its rows are scanned.
+        Returns the query and a note telling the model how to scale the result.
+        """
+        row_counts = load_row_counts(self.mcp_client, self.connection_cache)
+        by_name = {name.lower(): (name, rows) for name, rows in row_counts.items()}
+        candidates = [
+            by_name[name] for name in set(referenced_tables(query))
+            if name in by_name and by_name[name][1] >= SQL_APPROX_MIN_ROWS
+        ]
+        if not candidates:
+            return query, ""
+        # Only one table is sampled - sampling both sides of a join would lose most matches
+        table, rows = max(candidates, key=lambda candidate: candidate[1])
+        percent = round(min(100.0, max(0.01, 100.0 * SQL_APPROX_SAMPLE_ROWS / rows)), 2)
+        sampled, changed = sample_query(query, table, percent)
+        if not changed:
+            return query, ""
+        
+        self.approximate_used = True
+        scale = 100.0 / percent
+        logger.info(f"Approximate mode: sampling {table} ({rows} rows) at {percent:g}%")
+        return sampled, (
+            f"\nAPPROXIMATE RESULT: {table} was read through TABLESAMPLE at {percent:g}% "
+            f"(about {int(rows * percent / 100)} of {rows} rows). Multiply COUNT and SUM values by {scale:.1f}; "
+            "averages and ratios need no scaling, MIN/MAX are only bounds. "
+            f"The 95% margin of error of a scaled count c is about ±1.96*sqrt(c*{scale:.1f}), "
+            "of an average about ±1.96*STDEV/sqrt(COUNT) - query STDEV and COUNT_BIG to report it."
+        )
+    
+    def _count_rows(self, query):
+        """Total rows of a query, computed on the server ("unknown" if it can't be counted)"""
+        result, error = self.mcp_client.execute_query(count_query(query))
+        if error or not isinstance(result, pd.DataFrame) or result.empty:
+            return "unknown"
+        return int(result.iloc[0, 0])
+    
+    def _fetch_chart_data(self, x_column, y_columns, aggregation):
+        """
+        Complete data of the last (truncated) query for a chart: aggregated on the
+        server when an aggregation was asked for, otherwise up to
+        SQL_FULL_FETCH_MAX_ROWS raw rows. Returns the DataFrame and whether it is
+        already aggregated; falls back to the truncated result on errors.
+        """
+        if aggregation and aggregation.strip():
+            query = aggregate_query(self.last_query, x_column, y_columns, aggregation.strip())
+            if query:
+                result, error = self.mcp_client.execute_query(query)
+                if not error and isinstance(result, pd.DataFrame):
+                    logger.info(f"Chart data aggregated on the server: {len(result)} rows")
+                    return result, True
+                logger.warning(f"Server-side aggregation failed, fetching raw rows: {error or result}")
+        
+        query, _ = limit_query(self.last_query, SQL_FULL_FETCH_MAX_ROWS)
+        result, error = self.mcp_client.execute_query(query)
+        if not error and isinstance(result, pd.DataFrame):
+            logger.info(f"Fetched complete chart data: {len(result)} rows")
+            return result, False
+        logger.warning(f"Full fetch failed, charting the truncated result: {error or result}")
+        return self.last_query_result, False
+    
+    def _format_schema(self, table, schema_df):
+        """Render a table schema as compact prompt text"""
+        schema_text = f"\nTable: {table}\nColumns:\n"
+        # Only include the first columns to reduce context size
+        for _, row in schema_df.head(SCHEMA_MAX_COLUMNS).iterrows():
+            schema_text += f"- {row['COLUMN_NAME']} ({row['DATA_TYPE']})"
+            if row.get('IS_PRIMARY_KEY') == 'YES':
+                schema_text += " (PK)"
+            if 'FOREIGN_KEY_INFO' in row and row['FOREIGN_KEY_INFO']:
+                schema_text += f" ({row['FOREIGN_KEY_INFO']})"
+            schema_text += "\n"
+        if len(schema_df) > SCHEMA_MAX_COLUMNS:
+            schema_text += f"- ... {len(schema_df) - SCHEMA_MAX_COLUMNS} more columns (use describe_table for complete schema)\n"
+        return schema_text
+    
+    def _select_schema_tables(self, question):
+        """Pick the tables whose schemas go into the prompt, most relevant first"""
+        # First pass ranks mostly on table names, then schemas of the candidates are
+        # loaded so the second pass can also match on column names.
+        candidates = [t for t, _ in self.schema_index.rank(question, SCHEMA_TOP_K * 2, self.important_tables)]
+        for table in candidates:
+            if table not in self.schemas:
+                _, error = self._load_schema(table)
+                if error:
+                    logger.warning(f"Error loading schema for table {table}: {error}")
+        selected = [t for t, _ in self.schema_index.rank(question, SCHEMA_TOP_K, self.important_tables)]
+        
+        # Nothing matched the question - fall back to a few example tables
+        if not selected:
+            selected = list(self.important_tables)[:SCHEMA_TOP_K] or self.tables[:min(5, len(self.tables))]
+        return selected
     
     def _setup_graph(self):
         """Set up the LangGraph workflow for the SQL agent"""
         def add_schema_info(state: MessagesState):
-            """Add database schema information to the system prompt"""
-            # Create a list of all tables
-            table_list = "\n".join([f"- {table}" for table in self.tables])
+            """Prepare the system prompt with schema information for the tables relevant to the question.
             
-            # Only include schemas for important tables or up to 10 tables if none are marked important
-            schema_tables = self.important_tables.copy()
+            The prompt is kept outside of the checkpointed message log, so it isn't
+            duplicated in the stored conversation on every turn."""
+            started = time.perf_counter()
+            question = ""
+            for message in reversed(state["messages"]):
+                if isinstance(message, HumanMessage):
+                    question = message.content
+                    break
             
-            # If we don't have any important tables yet, include a few tables as examples
-            if not schema_tables and len(self.tables) > 0:
-                schema_tables = set(self.tables[:min(5, len(self.tables))])
+            selected = self._select_schema_tables(question)
             
-            # Generate schema text for the selected tables (limited number)
-            schema_text = ""
-            schema_tables_list = list(schema_tables)[:10]  # Limit to 10 important tables
+            # Small databases get the full table list, large ones only the relevant tables
+            if len(self.tables) <= FULL_TABLE_LIST_MAX:
+                table_list = "\n".join([f"- {table}" for table in self.tables])
+            else:
+                table_list = "\n".join([f"- {table}" for table in selected])
+                table_list += f"\n... and {len(self.tables) - len(selected)} more tables (use search_tables to find them)."
             
-            for table in schema_tables_list:
-                if table not in self.schemas:
-                    # Lazy load schema if not already loaded
-                    schema_df, error = self.mcp_client.get_table_schema(table)
-                    if error:
-                        schema_text += f"\nError loading schema for table {table}: {error}\n"
-                        continue
-                    self.schemas[table] = schema_df
-                
-                schema_df = self.schemas[table]
-                schema_text += f"\nTable: {table}\nColumns:\n"
-                
-                # Only include important columns to reduce context size
-                col_sample = schema_df.head(20)  # Limit to first 20 columns
-                for _, row in col_sample.iterrows():
-                    schema_text += f"- {row['COLUMN_NAME']} ({row['DATA_TYPE']})"
-                    if row.get('IS_PRIMARY_KEY') == 'YES':
-                        schema_text += " (PK)"
-                    if 'FOREIGN_KEY_INFO' in row and row['FOREIGN_KEY_INFO']:
-                        schema_text += f" ({row['FOREIGN_KEY_INFO']})"
-                    schema_text += "\n"
-                
-                if len(schema_df) > 20:
-                    schema_text += f"- ... {len(schema_df) - 20} more columns (use describe_table for complete schema)\n"
+            # Add schemas in order of relevance for as long as they fit the budget
+            budget = SCHEMA_TOKEN_BUDGET - count_tokens(table_list)
+            schema_text = ""
+            included = []
+            for table in selected:
+                schema_df, error = self._load_schema(table)
+                if error:
+                    continue
+                table_text = self._format_schema(table, schema_df)
+                table_tokens = count_tokens(table_text)
+                if table_tokens > budget:
+                    break
+                budget -= table_tokens
+                schema_text += table_text
+                included.append(table)
             
-            # Add note about additional tables
-            if len(self.tables) > len(schema_tables_list):
+            if len(self.tables) > len(included):
                 schema_text += f"\nThere are {len(self.tables)} tables in total. Use describe_table to see details for other tables.\n"
             
-            # For other tables not included in the schema text, add a note
-            for table in self.tables:
-                if table not in schema_tables_list:
-                    schema_text += f"\nTable: {table}\nUse describe_table tool to see the schema.\n"
-                    # Only add a few table names to avoid making the prompt too long
-                    if len(schema_text.split('\n')) > 100:
-                        schema_text += f"\n... and {len(self.tables) - len(schema_tables_list)} more tables.\n"
-                        break
-            
             prepared_sysprompt = SYSTEM_PROMPT_SQL.format(
                 table_list=table_list,
                 table_schemas=schema_text
             )
-            state["messages"].insert(0, SystemMessage(content=prepared_sysprompt))
+            self.prompt_stats = {
+                "tables_total": len(self.tables),
+                "schemas_included": len(included),
+                "prompt_tokens": count_tokens(prepared_sysprompt),
+                "selection_ms": round((time.perf_counter() - started) * 1000, 1),
+            }
+            logger.info(f"Schema prompt stats: {self.prompt_stats}")
+            if self.approximate:
+                prepared_sysprompt += SYSTEM_PROMPT_APPROXIMATE
+            self.system_prompt = prepared_sysprompt
         
-        def call_model(state: MessagesState):
-            """Call the LLM with the current state"""
-            messages = state["messages"]
+        def prepare_messages(state: MessagesState):
+            history, summary = self.history.compact(state["messages"])
             logger.info("Calling LLM for SQL generation")
-            response = self.model.invoke(messages)
+            return with_system_prompt(self.system_prompt + summary, history)
+        
+        def model_response(response):
             if len(response.content) > 0 and not response.tool_calls:
                 logger.info("LLM Response:\n" + (response.content))
             elif not response.tool_calls:
                 logger.warning("LLM didn't respond with any content!")
             return {"messages": [response]}
         
+        def call_model(state: MessagesState):
+            """Call the LLM with the current state"""
+            return model_response(self.model.invoke(prepare_messages(state)))
+        
+        async def acall_model(state: MessagesState):
+            # Used by ainvoke: the LLM request is awaited instead of blocking a thread
+            return model_response(await self.model.ainvoke(prepare_messages(state)))
+        
         def should_continue(state: MessagesState) -> Literal["tools", END]:
             """Decide whether to execute a tool or end the conversation"""
             messages = state["messages"]
@@ -404,14 +640,14 @@ class SQLAgent:
             logger.info("Last message was a natural response, finishing")
             return END
         
-        tool_node = ToolNode(self.tools)
+        tool_node = ParallelToolNode(self.tools, PARALLEL_SAFE_TOOLS)
         
         # Define graph
         graph = StateGraph(MessagesState)
         
         # Add nodes
         graph.add_node("schema_info", add_schema_info)
-        graph.add_node("agent", call_model)
+        graph.add_node("agent", RunnableCallable(call_model, acall_model, name="agent"))
         graph.add_node("tools", tool_node)
         
         # Add edges
@@ -426,24 +662,68 @@ class SQLAgent:
     
     def invoke(self, message, full_context=False):
         """Process a natural language question and return the SQL result"""
-        config = {
-            "thread_id": "sql_agent",
-            "recursion_limit": 50,
-        }
+        config = self._turn_config()
         try:
-            messages = self.graph.invoke(
-                {"messages": [HumanMessage(content=message)]}, config
-            )
-            if full_context:
-                return messages
-            return messages["messages"][-1].content
+            messages = self.graph.invoke({"messages": [HumanMessage(content=message)]}, config)
+            return self._turn_result(messages, full_context)
         except GraphRecursionError as e:
             logger.exception(e)
-            return "I apologize, but I'm unable to process this request due to complexity limitations. Could you try simplifying your question?"
+            return GRAPH_RECURSION_MESSAGE
         except Exception as e:
             logger.exception(e)
             return f"An error occurred: {str(e)}"
     
+    async def ainvoke(self, message, full_context=False):
+        """
+        Async version of invoke: LLM calls are awaited on the event loop, tool
+        calls run in the default executor of the loop.
+        """
+        config = self._turn_config()
+        try:
+            messages = await self.graph.ainvoke({"messages": [HumanMessage(content=message)]}, config)
+            return self._turn_result(messages, full_context)
+        except GraphRecursionError as e:
+            logger.exception(e)
+            return GRAPH_RECURSION_MESSAGE
+        except Exception as e:
+            logger.exception(e)
+            return f"An error occurred: {str(e)}"
+    
+    def _turn_config(self):
+        self._build_graph()
+        self.history.reset_turn()
+        self.turn_stats = {}
+        self._bytes_before = self.mcp_client.bytes_received
+        self.usage = UsageCallbackHandler()
+        return {
+            "thread_id": self.thread_id,
+            "recursion_limit": 50,
+            "callbacks": [TracingCallbackHandler("sql"), self.usage],
+        }
+    
+    def _turn_result(self, messages, full_context):
+        self.turn_stats["bytes_received"] = self.mcp_client.bytes_received - self._bytes_before
+        logger.info(f"History tokens saved this turn: {self.history.turn_tokens_saved}")
+        logger.info(f"SQL turn stats: {self.turn_stats}")
+        if full_context:
+            return messages
+        return messages["messages"][-1].content
+    
+    def refresh_tables(self):
+        """
+        Fetch the table list again, bypassing the catalog TTL.
+        Returns whether the list changed and an error, if any.
+        """
+        tables, error = self.mcp_client.refresh_tables()
+        if error:
+            logger.info(f"Server-side table refresh failed ({error}), fetching the table list")
+            tables, error = self.mcp_client.get_tables()
+        if error:
+            return False, error
+        changed = self.connection_cache.set_tables(tables)
+        self.tables = self.connection_cache.tables
+        return changed, None
+    
     # Replace the get_table_preview method in sql_agent.py with this updated version
 
     def get_table_preview(self, table_name, limit=10):
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# Keep stores, charts and traces written by the code under test out of the working tree
+_scratch = tempfile.mkdtemp(prefix="ai-analysis-tests-")
+os.environ.setdefault("DATASET_STORE_DIR", os.path.join(_scratch, "dataset_store"))
+os.environ.setdefault("CHART_DIR", os.path.join(_scratch, "artifacts"))
+os.environ.setdefault("TRACE_LOG", "")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
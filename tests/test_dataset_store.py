@@ -0,0 +1,31 @@
+import pandas
+import pytest
+
+import utils.dataset_store as dataset_store
+
+
+@pytest.fixture(params=["sqlite", "duckdb"])
+def engine(request, monkeypatch, tmp_path):
+    if request.param == "duckdb" and dataset_store.duckdb is None:
+        pytest.skip("duckdb is not installed")
+    if request.param == "sqlite":
+        monkeypatch.setattr(dataset_store, "duckdb", None)
+    monkeypatch.setattr(dataset_store, "DATASET_STORE_DIR", str(tmp_path))
+    return request.param
+
+
+@pytest.mark.parametrize("bounds", [["01/01/2024", "01/31/2024"], ["2024-01-01", "2024-01-31"]])
+def test_text_date_ranges_compare_as_dates(engine, bounds):
+    dates = pandas.date_range("2024-01-01", "2025-12-31", freq="D")
+    df = pandas.DataFrame({"day": dates.strftime("%m/%d/%Y"), "qty": range(len(dates))})
+    store = dataset_store.DatasetStore(df, f"text-dates-{engine}")
+    assert store.engine == engine
+
+    rows, truncated = store.filter_rows([{"column": "day", "op": "between", "value": bounds}], max_rows=1000)
+    assert not truncated
+    assert len(rows) == 31
+    assert rows["day"].min() == "2024-01-01 00:00:00"
+    assert rows["day"].max() == "2024-01-31 00:00:00"
+
+    later, _ = store.filter_rows([{"column": "day", "op": ">", "value": "12/29/2025"}])
+    assert len(later) == 2
@@ -0,0 +1,41 @@
+import threading
+
+import pandas
+
+from utils.forecasting import FittedForecast
+
+HISTORY = 100
+
+
+class StubModel:
+    def predict(self, periods):
+        return pandas.DataFrame({"ds": range(HISTORY + periods), "yhat": 0.0, "yhat_lower": 0.0, "yhat_upper": 0.0})
+
+
+class OvertakingLock:
+    """Runs `overtake` once, right after the first release, as a concurrent request would"""
+
+    def __init__(self, overtake):
+        self._lock = threading.Lock()
+        self._overtake = overtake
+
+    def __enter__(self):
+        self._lock.acquire()
+
+    def __exit__(self, *exc):
+        self._lock.release()
+        overtake, self._overtake = self._overtake, None
+        if overtake:
+            overtake()
+
+
+def test_predict_is_not_cut_short_by_a_longer_concurrent_horizon():
+    fitted = FittedForecast(StubModel(), "key", HISTORY, 0.0, name="linear_trend")
+    longer = []
+    fitted._lock = OvertakingLock(lambda: longer.append(fitted.predict(30)))
+
+    shorter = fitted.predict(10)
+
+    assert len(longer[0]) == HISTORY + 30
+    assert len(shorter) == HISTORY + 10
+    assert shorter["ds"].tolist() == list(range(HISTORY + 10))
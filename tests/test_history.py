@@ -0,0 +1,71 @@
+import sqlite3
+from typing import Any, List
+
+import pandas
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+import pandas_agent
+from utils.checkpointer import SQLiteSaver
+from utils.history import message_tokens
+
+TURNS = 20
+
+
+class StubChatModel(BaseChatModel):
+    """Answers every question without tool calls and records the LLM input"""
+
+    inputs: List[List[BaseMessage]] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def bind_tools(self, tools, **kwargs) -> "StubChatModel":
+        return self
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        self.inputs.append(list(messages))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=f"Answer {len(self.inputs)}."))])
+
+
+def checkpoint_bytes(path: str, thread_id: str) -> int:
+    with sqlite3.connect(path) as conn:
+        (size,) = conn.execute(
+            "SELECT length(checkpoint) FROM checkpoints WHERE thread_id = ? ORDER BY checkpoint_id DESC LIMIT 1",
+            (thread_id,),
+        ).fetchone()
+    return size
+
+
+def test_system_prompt_is_not_persisted_per_turn(tmp_path, monkeypatch):
+    model = StubChatModel()
+    monkeypatch.setattr(pandas_agent, "AzureChatOpenAI", lambda **kwargs: model)
+    checkpointer = SQLiteSaver(str(tmp_path / "checkpoints.sqlite3"))
+    df = pandas.DataFrame({"region": ["north", "south", "east"] * 20, "sales": range(60)})
+
+    input_tokens, stored_bytes = [], []
+    for turn in range(TURNS):
+        # A new agent per question, like app.py does
+        agent = pandas_agent.PandasAgent(df, checkpointer, "history-test", "thread")
+        agent.invoke(f"What is the total of sales in question {turn:02d}?")
+        llm_input = model.inputs[-1]
+        assert sum(isinstance(m, SystemMessage) for m in llm_input) == 1
+        input_tokens.append(sum(message_tokens(m) for m in llm_input))
+        stored_bytes.append(checkpoint_bytes(checkpointer.path, "thread"))
+
+    stored = checkpointer.get_tuple({"configurable": {"thread_id": "thread"}}).checkpoint
+    messages = stored["channel_values"]["messages"]
+    assert len(messages) == 2 * TURNS
+    assert not any(isinstance(m, SystemMessage) for m in messages)
+
+    # Every turn only adds its question and answer: the growth per turn stays flat
+    # and far below the size of the system prompt that used to be appended each turn
+    system_tokens = message_tokens(model.inputs[-1][0])
+    token_steps = [b - a for a, b in zip(input_tokens, input_tokens[1:])]
+    byte_steps = [b - a for a, b in zip(stored_bytes, stored_bytes[1:])]
+    assert max(token_steps) - min(token_steps) <= 2
+    assert max(token_steps) < system_tokens / 10
+    assert max(byte_steps) - min(byte_steps) <= 16
+    assert max(byte_steps) < len(model.inputs[-1][0].content) / 5
@@ -0,0 +1,31 @@
+from utils.llm_usage import _Ledger
+
+
+def usage(prompt_tokens):
+    return {"calls": 1, "errors": 0, "prompt_tokens": prompt_tokens, "completion_tokens": 10, "latency_s": 0.5}
+
+
+def test_stats_only_show_the_callers_turns_and_datasets():
+    ledger = _Ledger()
+    ledger.record(usage(100), "sql", "sql:prod-server/payroll", "alice", "salaries of the board members")
+    ledger.record(usage(50), "csv", "csv:orders.csv", "bob", "late orders per region")
+
+    stats = ledger.stats("bob")
+    assert stats["totals"]["prompt_tokens"] == 150
+    assert set(stats["agents"]) == {"sql", "csv"}
+    assert stats["sessions"] == 2
+    assert stats["session"]["prompt_tokens"] == 50
+    assert set(stats["datasets"]) == {"csv:orders.csv"}
+    assert [turn["question"] for turn in stats["recent_turns"]] == ["late orders per region"]
+    assert "payroll" not in str(stats) and "salaries" not in str(stats)
+
+
+def test_stats_without_a_session_are_anonymous():
+    ledger = _Ledger()
+    ledger.record(usage(100), "sql", "sql:prod-server/payroll", "alice", "salaries of the board members")
+
+    stats = ledger.stats(None)
+    assert stats["totals"]["turns"] == 1
+    assert stats["session"]["turns"] == 0
+    assert stats["datasets"] == {} and stats["recent_turns"] == []
+    assert "alice" not in str(stats)
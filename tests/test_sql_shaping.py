@@ -0,0 +1,116 @@
+import pytest
+
+from utils.sql_shaping import limit_query
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT TOP(10) * FROM t",
+    "SELECT TOP (10) * FROM t",
+    "select top 10 a FROM t",
+    "SELECT DISTINCT TOP(5) a FROM t",
+    "SELECT /* newest */ TOP (50) PERCENT a FROM t ORDER BY a",
+    "SELECT a FROM t ORDER BY a OFFSET 10 ROWS FETCH NEXT 5 ROWS ONLY",
+    "SELECT a FROM t ORDER BY a OFFSET 0 ROWS FETCH FIRST 1 ROW ONLY;",
+])
+def test_existing_limit_is_kept(query):
+    assert limit_query(query, 1000) == (query, False)
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("SELECT * FROM t", "SELECT TOP 1000 * FROM t"),
+    ("SELECT DISTINCT a FROM t;", "SELECT DISTINCT TOP 1000 a FROM t"),
+    ("SELECT topics FROM t", "SELECT TOP 1000 topics FROM t"),
+    ("SELECT a FROM (SELECT TOP(5) a FROM t) AS s", "SELECT TOP 1000 a FROM (SELECT TOP(5) a FROM t) AS s"),
+])
+def test_top_is_added(query, expected):
+    assert limit_query(query, 1000) == (expected, True)
+
+
+@pytest.mark.parametrize("query, expected", [
+    (
+        "SELECT a FROM t ORDER BY a OFFSET 10 ROWS",
+        "SELECT a FROM t ORDER BY a OFFSET 10 ROWS FETCH NEXT 1000 ROWS ONLY",
+    ),
+    (
+        "SELECT a FROM t ORDER BY a OFFSET (@page * 20) ROWS OPTION (RECOMPILE)",
+        "SELECT a FROM t ORDER BY a OFFSET (@page * 20) ROWS FETCH NEXT 1000 ROWS ONLY OPTION (RECOMPILE)",
+    ),
+    (
+        "select a from t order by a offset 1 row",
+        "select a from t order by a offset 1 row FETCH NEXT 1000 ROWS ONLY",
+    ),
+])
+def test_offset_without_fetch_gets_fetch_instead_of_top(query, expected):
+    limited, injected = limit_query(query, 1000)
+    assert injected
+    assert limited == expected
+    assert "TOP" not in limited
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("SELECT TOP 1000000 a FROM t", "SELECT TOP 1000 a FROM t"),
+    ("SELECT TOP(1000000) * FROM t", "SELECT TOP 1000 * FROM t"),
+    ("SELECT DISTINCT TOP (5000) WITH TIES a FROM t ORDER BY a", "SELECT DISTINCT TOP 1000 WITH TIES a FROM t ORDER BY a"),
+])
+def test_larger_top_is_lowered(query, expected):
+    assert limit_query(query, 1000) == (expected, True)
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT TOP 50 PERCENT a FROM t",
+    "SELECT TOP (@n) a FROM t",
+])
+def test_top_without_a_row_count_is_kept(query):
+    assert limit_query(query, 1000) == (query, False)
+
+
+@pytest.mark.parametrize("query, expected", [
+    (
+        "WITH c AS (SELECT a FROM t) SELECT a FROM c",
+        "WITH c AS (SELECT a FROM t) SELECT TOP 1000 a FROM c",
+    ),
+    (
+        "WITH c (a) AS (SELECT TOP 5 a FROM t), d AS (SELECT a FROM c) SELECT TOP 1000000 a FROM d",
+        "WITH c (a) AS (SELECT TOP 5 a FROM t), d AS (SELECT a FROM c) SELECT TOP 1000 a FROM d",
+    ),
+    (
+        "WITH c AS (SELECT a FROM t) SELECT a FROM c UNION SELECT a FROM u",
+        "WITH c AS (SELECT a FROM t) SELECT TOP 1000 * FROM (SELECT a FROM c UNION SELECT a FROM u) AS limited_q",
+    ),
+])
+def test_main_query_of_a_cte_is_limited(query, expected):
+    assert limit_query(query, 1000) == (expected, True)
+
+
+@pytest.mark.parametrize("query, expected", [
+    (
+        "SELECT a FROM t UNION SELECT a FROM u",
+        "SELECT TOP 1000 * FROM (SELECT a FROM t UNION SELECT a FROM u) AS limited_q",
+    ),
+    (
+        "SELECT TOP 10 a FROM t EXCEPT SELECT a FROM u OPTION (MAXDOP 1) -- old rows",
+        "SELECT TOP 1000 * FROM (SELECT TOP 10 a FROM t EXCEPT SELECT a FROM u) AS limited_q OPTION (MAXDOP 1) -- old rows",
+    ),
+    (
+        "SELECT a FROM t UNION ALL SELECT a FROM u ORDER BY a -- newest",
+        "SELECT a FROM t UNION ALL SELECT a FROM u ORDER BY a OFFSET 0 ROWS FETCH NEXT 1000 ROWS ONLY -- newest",
+    ),
+    (
+        "SELECT a FROM t INTERSECT SELECT a FROM u ORDER BY a OFFSET 5 ROWS",
+        "SELECT a FROM t INTERSECT SELECT a FROM u ORDER BY a OFFSET 5 ROWS FETCH NEXT 1000 ROWS ONLY",
+    ),
+])
+def test_set_operation_is_limited_as_a_whole(query, expected):
+    assert limit_query(query, 1000) == (expected, True)
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT a FROM t UNION SELECT a FROM u ORDER BY a OFFSET 0 ROWS FETCH NEXT 5 ROWS ONLY",
+    "WITH c AS (SELECT a FROM t) DELETE FROM u WHERE a IN (SELECT a FROM c)",
+    "WITH c AS (SELECT a FROM t) UPDATE u SET a = (SELECT MAX(a) FROM c)",
+    "SELECT a INTO u FROM t",
+    "SELECT 1; SELECT 2",
+    "DELETE FROM t",
+])
+def test_other_statements_are_unchanged(query):
+    assert limit_query(query, 1000) == (query, False)
@@ -0,0 +1,115 @@
+import logging
+import os
+import re
+import threading
+import time
+from typing import List, Optional
+
+from utils.charts import CHART_DIR, CHART_FORMAT
+
+logger = logging.getLogger("kinaxis-agent")
+
+# Seconds a chart is kept after it was last produced for any session
+ARTIFACT_TTL = int(os.getenv("ARTIFACT_TTL", 24 * 3600))
+# Charts a session can open; older ones are forgotten by the session (and swept once expired)
+ARTIFACT_SESSION_QUOTA = int(os.getenv("ARTIFACT_SESSION_QUOTA", 100))
+# Disk space of all charts together; the least recently used go first when it's exceeded
+ARTIFACT_MAX_BYTES = int(os.getenv("ARTIFACT_MAX_BYTES", 1024 ** 3))
+# Seconds between two sweeps of the chart directory
+ARTIFACT_SWEEP_INTERVAL = int(os.getenv("ARTIFACT_SWEEP_INTERVAL", 600))
+# Charts used to be written next to the frontend build; old ones there are swept as well
+LEGACY_ARTIFACT_DIR = "./frontend/dist/assets"
+
+# Content-hash ids from utils.charts and the uuid4 names of older charts; nothing else
+# in the directories (e.g. the frontend build) is ever touched
+ARTIFACT_NAME = re.compile(r"^(?:[0-9a-f]{32}|[0-9a-f]{8}-(?:[0-9a-f]{4}-){3}[0-9a-f]{12})\.(?:png|svg)$")
+
+_sweeper: Optional[threading.Thread] = None
+_sweeper_lock = threading.Lock()
+
+
+def is_artifact_id(artifact_id: str) -> bool:
+    return bool(ARTIFACT_NAME.match(f"{artifact_id}.{CHART_FORMAT}"))
+
+
+def artifact_path(artifact_id: str) -> Optional[str]:
+    """Path of a chart in CHART_DIR, None if it doesn't exist (anymore)"""
+    if not is_artifact_id(artifact_id):
+        return None
+    path = os.path.join(CHART_DIR, f"{artifact_id}.{CHART_FORMAT}")
+    return path if os.path.exists(path) else None
+
+
+def remember_artifact(artifacts: List[str], artifact_id: str) -> List[str]:
+    """
+    Add a chart to a session's list of charts (most recent last, at most
+    ARTIFACT_SESSION_QUOTA) and restart its TTL, also when it was an existing
+    chart reused from the cache.
+    """
+    path = artifact_path(artifact_id)
+    if path is not None:
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+    artifacts = [a for a in artifacts if a != artifact_id] + [artifact_id]
+    return artifacts[-ARTIFACT_SESSION_QUOTA:]
+
+
+def sweep(now: float | None = None) -> int:
+    """
+    Delete charts not used for ARTIFACT_TTL seconds, then the least recently
+    used ones while all charts take more than ARTIFACT_MAX_BYTES. Returns the
+    number of deleted files.
+    """
+    now = now or time.time()
+    files = []
+    for directory in {os.path.normpath(CHART_DIR), os.path.normpath(LEGACY_ARTIFACT_DIR)}:
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if not ARTIFACT_NAME.match(entry.name):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    deleted = 0
+    for mtime, size, path in files:
+        if mtime >= now - ARTIFACT_TTL and total <= ARTIFACT_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            deleted += 1
+        except FileNotFoundError:
+            # Another worker swept it first
+            pass
+        total -= size
+    if deleted:
+        logger.info(f"Swept {deleted} chart artifacts, {total} bytes left")
+    return deleted
+
+
+def _sweep_forever():
+    while True:
+        try:
+            sweep()
+        except Exception as e:
+            logger.error(f"Sweeping chart artifacts failed: {e}")
+        time.sleep(ARTIFACT_SWEEP_INTERVAL)
+
+
+def start_sweeper():
+    """Start the background sweeper of this process (once)"""
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is not None:
+            return
+        _sweeper = threading.Thread(target=_sweep_forever, name="artifact-sweeper", daemon=True)
+        _sweeper.start()
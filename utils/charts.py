@@ -0,0 +1,200 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List
+
+import matplotlib
+
+# Selected once at import, before pyplot is loaded anywhere (no GUI backend, no per-chart setup)
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt  # noqa: E402
+import numpy  # noqa: E402
+import pandas  # noqa: E402
+from matplotlib.backends.backend_agg import FigureCanvasAgg  # noqa: E402
+from matplotlib.figure import Figure  # noqa: E402
+
+logger = logging.getLogger("kinaxis-agent")
+
+# Where rendered charts are written (served by /artifacts, swept by utils.artifacts)
+CHART_DIR = os.getenv("CHART_DIR", "./artifacts")
+# Resolution of raster charts; lower DPI means smaller PNGs
+CHART_DPI = int(os.getenv("CHART_DPI", 100))
+# "png" or "svg" (usually much smaller for bar/line charts with few points)
+CHART_FORMAT = os.getenv("CHART_FORMAT", "png").lower()
+# "image" renders a file, "spec" returns only a JSON spec for client-side rendering, "both" does both
+CHART_OUTPUT = os.getenv("CHART_OUTPUT", "image").lower()
+# Line and scatter series with more points are downsampled before plotting
+CHART_MAX_POINTS = int(os.getenv("CHART_MAX_POINTS", 2000))
+CHART_SIZE = (10, 6)
+HISTOGRAM_BINS = 10
+
+CHART_TYPES = ("bar", "line", "scatter", "pie", "histogram")
+
+# Smaller, reproducible files: SVG text stays text and no timestamps end up in the output
+_SAVE_OPTIONS = {
+    "png": {"metadata": {"Software": None}},
+    "svg": {"metadata": {"Date": None, "Creator": None}},
+}
+matplotlib.rcParams["svg.fonttype"] = "none"
+matplotlib.rcParams["svg.hashsalt"] = "charts"
+
+
+def chart_key(*parts) -> str:
+    """Content hash naming a chart, so the same chart is only rendered once"""
+    digest = hashlib.sha1()
+    for part in (CHART_FORMAT, CHART_DPI, *parts):
+        digest.update(part if isinstance(part, bytes) else repr(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()[:32]
+
+
+def chart_path(chart_id: str) -> str:
+    return os.path.join(CHART_DIR, f"{chart_id}.{CHART_FORMAT}")
+
+
+def _frame_hash(df: pandas.DataFrame) -> bytes:
+    return pandas.util.hash_pandas_object(df, index=False).to_numpy().tobytes()
+
+
+def downsample(df: pandas.DataFrame, chart_type: str, x_column: str, y_columns: List[str]) -> pandas.DataFrame:
+    """
+    At most about CHART_MAX_POINTS rows for line and scatter charts. Lines keep
+    the minimum and maximum of every bucket so peaks stay visible; scatter
+    plots keep a fixed random subset.
+    """
+    if len(df) <= CHART_MAX_POINTS or chart_type not in ("line", "scatter"):
+        return df
+    if chart_type == "scatter":
+        return df.sample(CHART_MAX_POINTS, random_state=0).sort_index()
+    # Up to three rows per bucket (first, minimum, maximum)
+    buckets = numpy.arange(len(df)) * (CHART_MAX_POINTS // 3) // len(df)
+    values = df[y_columns].apply(pandas.to_numeric, errors="coerce").reset_index(drop=True)
+    grouped = values.groupby(buckets)
+    keep = set()
+    for column in y_columns:
+        keep.update(grouped[column].idxmin().dropna().astype(int))
+        keep.update(grouped[column].idxmax().dropna().astype(int))
+    # The first row of every bucket keeps the x axis covered where a series is all NaN
+    keep.update(numpy.flatnonzero(numpy.diff(buckets, prepend=-1)))
+    return df.iloc[sorted(keep)]
+
+
+def render_chart(df: pandas.DataFrame, chart_type: str, x_column: str, y_columns: List[str], title: str) -> str:
+    """
+    Render a chart of `df` into CHART_DIR and return its id (file name without
+    extension). Identical charts of identical data reuse the existing file.
+    Raises ValueError for unsupported chart types.
+    """
+    chart_type = chart_type.lower()
+    df = downsample(df, chart_type, x_column, y_columns)
+    chart_id = chart_key(chart_type, x_column, y_columns, title, _frame_hash(df[[x_column, *y_columns]]))
+    path = chart_path(chart_id)
+    if os.path.exists(path):
+        logger.debug(f"Chart {chart_id} already rendered")
+        return chart_id
+
+    start = time.perf_counter()
+    # A Figure of its own instead of pyplot's global state, safe with concurrent requests
+    fig = Figure(figsize=CHART_SIZE)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    if chart_type == "bar":
+        df.set_index(x_column)[y_columns].plot(kind="bar", ax=ax)
+    elif chart_type == "line":
+        df.set_index(x_column)[y_columns].plot(kind="line", ax=ax)
+    elif chart_type == "scatter":
+        # For scatter, we only use the first y column
+        ax.scatter(df[x_column], df[y_columns[0]], s=8)
+        ax.set_xlabel(x_column)
+        ax.set_ylabel(y_columns[0])
+    elif chart_type == "pie" and len(y_columns) == 1:
+        df.set_index(x_column)[y_columns[0]].plot(kind="pie", autopct="%1.1f%%", ax=ax)
+    elif chart_type == "histogram" and len(y_columns) == 1:
+        df[y_columns[0]].plot(kind="hist", bins=HISTOGRAM_BINS, ax=ax)
+        ax.set_xlabel(y_columns[0])
+    else:
+        raise ValueError(f"Unsupported chart type: {chart_type} with the given columns.")
+    ax.set_title(title)
+    fig.tight_layout()
+    _write(fig, path)
+    logger.info(f"Rendered {chart_type} chart {chart_id} ({len(df)} rows) in {time.perf_counter() - start:.2f}s")
+    return chart_id
+
+
+def save_figure(fig=None) -> str:
+    """
+    Save a pyplot figure (the current one by default) and close it. Returns the
+    chart id, a hash of what the figure shows, so a figure identical to an
+    already saved one isn't rendered again. Long lines are thinned out first.
+    """
+    fig = fig if fig is not None else plt.gcf()
+    try:
+        for ax in fig.get_axes():
+            for line in ax.get_lines():
+                x, y = line.get_xdata(), line.get_ydata()
+                if len(x) > CHART_MAX_POINTS:
+                    keep = numpy.linspace(0, len(x) - 1, CHART_MAX_POINTS).astype(int)
+                    line.set_data(numpy.asarray(x)[keep], numpy.asarray(y)[keep])
+        chart_id = chart_key(*_figure_content(fig))
+        path = chart_path(chart_id)
+        if os.path.exists(path):
+            logger.debug(f"Chart {chart_id} already rendered")
+        else:
+            _write(fig, path)
+        return chart_id
+    finally:
+        plt.close(fig)
+
+
+def _figure_content(fig):
+    """Data, texts and colors of everything drawn on the figure, as hashable parts"""
+    parts = [tuple(fig.get_size_inches()), fig.get_suptitle() if hasattr(fig, "get_suptitle") else ""]
+    for ax in fig.get_axes():
+        parts.append((ax.get_title(), ax.get_xlabel(), ax.get_ylabel(), ax.get_xscale(), ax.get_yscale()))
+        parts.extend(t.get_text() for t in [*ax.get_xticklabels(), *ax.get_yticklabels(), *ax.texts])
+        legend = ax.get_legend()
+        if legend is not None:
+            parts.extend(t.get_text() for t in legend.get_texts())
+        for line in ax.get_lines():
+            parts.append((line.get_color(), line.get_linestyle(), line.get_marker()))
+            parts.append(numpy.asarray(line.get_xydata(), dtype=float).tobytes())
+        for patch in ax.patches:
+            parts.append(str(patch.get_facecolor()))
+            parts.append(patch.get_patch_transform().transform(patch.get_path().vertices).tobytes())
+        for collection in ax.collections:
+            parts.append(numpy.asarray(collection.get_offsets(), dtype=float).tobytes())
+            parts.append(numpy.asarray(collection.get_facecolors(), dtype=float).tobytes())
+            parts.extend(path.vertices.tobytes() for path in collection.get_paths())
+        for image in ax.get_images():
+            parts.append(numpy.asarray(image.get_array()).tobytes())
+    return parts
+
+
+def _write(fig, path: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # Written under a temporary name so a request never serves a half-written file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    fig.savefig(tmp_path, format=CHART_FORMAT, dpi=CHART_DPI, **_SAVE_OPTIONS.get(CHART_FORMAT, {}))
+    os.replace(tmp_path, path)
+
+
+def chart_spec(df: pandas.DataFrame, chart_type: str, x_column: str, y_columns: List[str], title: str) -> Dict[str, Any]:
+    """
+    Compact JSON description of a chart for client-side rendering: the
+    (downsampled) rows of the x and y columns, or the bins of a histogram.
+    """
+    chart_type = chart_type.lower()
+    spec: Dict[str, Any] = {"type": chart_type, "title": title, "x": x_column, "y": y_columns}
+    if chart_type == "histogram":
+        values = pandas.to_numeric(df[y_columns[0]], errors="coerce").dropna()
+        counts, edges = numpy.histogram(values, bins=HISTOGRAM_BINS)
+        spec["bins"] = edges.tolist()
+        spec["counts"] = counts.tolist()
+        return spec
+    df = downsample(df, chart_type, x_column, y_columns)
+    # to_json takes care of NaN (null) and timestamps (ISO strings)
+    spec["data"] = json.loads(df[[x_column, *y_columns]].to_json(orient="values", date_format="iso"))
+    return spec
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import pandas
+
+from utils.schema_index import SchemaIndex
+
+# Seconds a cached 10-row table preview is served before it is fetched again
+PREVIEW_CACHE_TTL = int(os.getenv("PREVIEW_CACHE_TTL", 300))
+# Seconds the table list is trusted before an agent build fetches it again
+TABLE_CATALOG_TTL = int(os.getenv("TABLE_CATALOG_TTL", 300))
+
+
+class ConnectionCache:
+    """
+    State shared by every request that talks to the same database connection.
+    SQLAgent is rebuilt for each request, so anything worth keeping between
+    requests (table list, schemas, previews, the schema index) lives here.
+    """
+
+    def __init__(self, key: Tuple):
+        self.key = key
+        self.lock = threading.Lock()
+        self.schemas: Dict[str, pandas.DataFrame] = dict()
+        self.schema_index = SchemaIndex()
+        self.tables: Optional[List[str]] = None
+        self.tables_version: Optional[str] = None
+        self.tables_fetched_at = 0.0
+        self.previews: Dict[str, Tuple[float, pandas.DataFrame]] = dict()
+        # Approximate row count per table (from sys.partitions), None until loaded
+        self.row_counts: Optional[Dict[str, int]] = None
+        # How often each table was previewed or described, used to pick what to prefetch
+        self.usage: Counter = Counter()
+        self.prefetcher = None
+
+    def tables_fresh(self) -> bool:
+        return self.tables is not None and time.monotonic() - self.tables_fetched_at <= TABLE_CATALOG_TTL
+
+    def set_tables(self, tables: List[str]) -> bool:
+        """
+        Store a freshly fetched table list. Returns True if it differs from the
+        cached one; cached schemas and previews of dropped tables are discarded.
+        """
+        version = hashlib.sha1("\n".join(sorted(tables)).encode()).hexdigest()[:16]
+        with self.lock:
+            self.tables_fetched_at = time.monotonic()
+            if version == self.tables_version:
+                return False
+            self.tables = list(tables)
+            self.tables_version = version
+            for table in set(self.schemas) - set(tables):
+                del self.schemas[table]
+            for table in set(self.previews) - set(tables):
+                del self.previews[table]
+            self.schema_index.set_tables(self.tables)
+        return True
+
+    def set_schema(self, table: str, schema_df: pandas.DataFrame):
+        with self.lock:
+            self.schemas[table] = schema_df
+            self.schema_index.add_schema(table, schema_df)
+
+    def get_preview(self, table: str) -> Optional[pandas.DataFrame]:
+        entry = self.previews.get(table)
+        if entry is None or time.monotonic() - entry[0] > PREVIEW_CACHE_TTL:
+            return None
+        return entry[1]
+
+    def set_preview(self, table: str, preview_df: pandas.DataFrame):
+        with self.lock:
+            self.previews[table] = (time.monotonic(), preview_df)
+
+    def record_usage(self, table: str):
+        with self.lock:
+            self.usage[table] += 1
+
+
+# Keyed by mcp_client.connection_key: MCP server, database, user and password digest
+_caches: Dict[Tuple, ConnectionCache] = dict()
+_caches_lock = threading.Lock()
+
+
+def get_connection_cache(key: Tuple) -> ConnectionCache:
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = ConnectionCache(key)
+            _caches[key] = cache
+        return cache
+
+
+def find_connection_cache(key: Tuple) -> Optional[ConnectionCache]:
+    """The cache of a connection if one was already made in this process"""
+    with _caches_lock:
+        return _caches.get(key)
+
+
+def drop_connection_cache(key: Tuple):
+    """Forget a connection's catalog and stop warming it"""
+    with _caches_lock:
+        cache = _caches.pop(key, None)
+    if cache is not None and cache.prefetcher is not None:
+        cache.prefetcher.cancel()
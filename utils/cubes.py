@@ -0,0 +1,263 @@
+import hashlib
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import pandas
+
+from utils.datasets import dataset_version, looks_like_dates
+
+logger = logging.getLogger("kinaxis-agent")
+
+# Pre-aggregation at upload time can be switched off (it costs a few groupbys per dataset)
+CUBES_ENABLED = os.getenv("CUBES_ENABLED", "1") == "1"
+# Text/categorical columns with more distinct values than this aren't used as dimensions
+CUBE_MAX_DIM_CARDINALITY = int(os.getenv("CUBE_MAX_DIM_CARDINALITY", 100))
+# At most this many dimensions per dataset
+CUBE_MAX_DIMENSIONS = int(os.getenv("CUBE_MAX_DIMENSIONS", 6))
+# Two-dimensional cubes are only built when they have at most this many cells
+CUBE_MAX_CELLS = int(os.getenv("CUBE_MAX_CELLS", 50000))
+# How many datasets' cubes are kept in memory
+CUBE_CACHE_SIZE = 8
+
+STATS = ("sum", "count", "min", "max")
+AGGREGATIONS = {"sum": "sum", "count": "count", "min": "min", "max": "max", "avg": "avg", "mean": "avg", "average": "avg"}
+# Pseudo-measure for counting rows
+ROWS = "*"
+# Date dimensions are named "<column>:<grain>"
+DATE_GRAINS = ("day", "month")
+
+
+class AggregateCubes:
+    """
+    Precomputed sum/count/min/max of every numeric measure grouped by each
+    likely dimension (low-cardinality categoricals, dates truncated to day and
+    month) and by small pairs of them, so "X by Y" questions and charts don't
+    need to scan the dataset.
+
+    Each cube maps a dimension tuple to {stat: DataFrame(index=dimensions,
+    columns=measures)} plus the row count per group.
+    """
+
+    def __init__(self, version: str, dimensions: Dict[str, str], measures: List[str]):
+        self.version = version
+        # dimension name -> source column
+        self.dimensions = dimensions
+        self.measures = measures
+        self.cubes: Dict[Tuple[str, ...], Dict[str, pandas.DataFrame]] = dict()
+        self.n_rows = 0
+        # Running hash of the rows the cubes were built from, extended on appends
+        self._rows_hash = hashlib.sha1()
+        self._columns: List[str] = []
+
+    @classmethod
+    def from_dataframe(cls, df: pandas.DataFrame, version: str) -> "AggregateCubes":
+        start = time.perf_counter()
+        dimensions, measures = _detect_fields(df)
+        cubes = cls(version, dimensions, measures)
+        cubes._columns = [str(c) for c in df.columns]
+        cubes.n_rows = len(df)
+        _update_rows_hash(cubes._rows_hash, df)
+
+        dim_values = _dimension_values(df, dimensions)
+        for key in cubes._cube_keys(dim_values):
+            cubes.cubes[key] = _aggregate(df, measures, [dim_values[d] for d in key], key)
+        logger.info(
+            f"Built {len(cubes.cubes)} aggregate cubes for dataset {version} "
+            f"({len(dimensions)} dimensions, {len(measures)} measures) in {time.perf_counter() - start:.2f}s"
+        )
+        return cubes
+
+    def _cube_keys(self, dim_values: Dict[str, pandas.Series]) -> List[Tuple[str, ...]]:
+        keys = [(d,) for d in dim_values]
+        cardinality = {d: values.nunique() for d, values in dim_values.items()}
+        for a, b in itertools.combinations(dim_values, 2):
+            # The day and month of the same date aren't a useful pair
+            if self.dimensions[a] == self.dimensions[b]:
+                continue
+            if cardinality[a] * cardinality[b] <= CUBE_MAX_CELLS:
+                keys.append((a, b))
+        return keys
+
+    def is_prefix_of(self, df: pandas.DataFrame) -> bool:
+        """True if `df` is this dataset with rows appended at the end."""
+        return (
+            [str(c) for c in df.columns] == self._columns
+            and len(df) >= self.n_rows
+            and _update_rows_hash(hashlib.sha1(), df.iloc[: self.n_rows]).digest() == self._rows_hash.digest()
+        )
+
+    def extended(self, df: pandas.DataFrame, version: str) -> "AggregateCubes":
+        """
+        Cubes of `df`, which extends this dataset with appended rows: only the
+        new rows are aggregated and merged into copies of the existing cubes.
+        """
+        start = time.perf_counter()
+        delta = df.iloc[self.n_rows:]
+        cubes = AggregateCubes(version, self.dimensions, self.measures)
+        cubes._columns = self._columns
+        cubes.n_rows = len(df)
+        cubes._rows_hash = _update_rows_hash(self._rows_hash.copy(), delta)
+
+        dim_values = _dimension_values(delta, self.dimensions)
+        for key, cube in self.cubes.items():
+            added = _aggregate(delta, self.measures, [dim_values[d] for d in key], key)
+            cubes.cubes[key] = _merge(cube, added)
+        logger.info(
+            f"Updated aggregate cubes with {len(delta)} appended rows in {time.perf_counter() - start:.2f}s"
+        )
+        return cubes
+
+    def lookup(self, group_by: List[str], measure: str, aggregation: str) -> Optional[pandas.DataFrame]:
+        """
+        Aggregated `measure` grouped by the given dimensions, or None if no
+        precomputed cube can answer it. `measure` "*" with "count" counts rows.
+        """
+        agg = AGGREGATIONS.get(aggregation.lower())
+        if agg is None or (measure != ROWS and measure not in self.measures):
+            return None
+        if measure == ROWS and agg != "count":
+            return None
+        group_by = list(group_by)
+
+        cube = self.cubes.get(tuple(group_by))
+        if cube is None and len(group_by) == 2:
+            cube = self.cubes.get(tuple(reversed(group_by)))
+            if cube is not None:
+                cube = {stat: table.reorder_levels(group_by) for stat, table in cube.items()}
+        if cube is None and len(group_by) == 1:
+            cube = self._roll_up(group_by[0])
+        if cube is None:
+            return None
+
+        if measure == ROWS:
+            values = cube["rows"]
+        elif agg == "avg":
+            values = cube["sum"][measure] / cube["count"][measure]
+        else:
+            values = cube[agg][measure]
+        name = "count" if measure == ROWS else measure
+        return values.rename(name).reset_index().sort_values(group_by, ignore_index=True)
+
+    def _roll_up(self, dimension: str) -> Optional[Dict[str, pandas.DataFrame]]:
+        # Any pair containing the dimension can be aggregated down to it
+        for key, cube in self.cubes.items():
+            if len(key) == 2 and dimension in key:
+                return _merge(cube, None, level=dimension)
+        return None
+
+    def describe(self) -> str:
+        dims = ", ".join(f'"{d}"' for d in self.dimensions)
+        measures = ", ".join(f'"{m}"' for m in self.measures)
+        return f"dimensions: {dims}; measures: {measures}"
+
+
+def _detect_fields(df: pandas.DataFrame) -> Tuple[Dict[str, str], List[str]]:
+    dates, categories, measures = {}, [], []
+    for column in df.columns:
+        series = df[column]
+        name = str(column)
+        if pandas.api.types.is_datetime64_any_dtype(series) or (
+            series.dtype == object and looks_like_dates(series)
+        ):
+            for grain in DATE_GRAINS:
+                dates[f"{name}:{grain}"] = column
+        elif pandas.api.types.is_bool_dtype(series) or series.dtype == object or isinstance(
+            series.dtype, pandas.CategoricalDtype
+        ):
+            distinct = series.nunique()
+            if 1 < distinct <= CUBE_MAX_DIM_CARDINALITY:
+                categories.append((distinct, name, column))
+        elif pandas.api.types.is_numeric_dtype(series):
+            measures.append(name)
+    # Coarse dimensions first, they make the smallest (and most used) cubes
+    dimensions = {name: column for _, name, column in sorted(categories, key=lambda c: c[0])}
+    dimensions.update(dates)
+    dimensions = dict(list(dimensions.items())[:CUBE_MAX_DIMENSIONS])
+    return dimensions, measures
+
+
+def _dimension_values(df: pandas.DataFrame, dimensions: Dict[str, str]) -> Dict[str, pandas.Series]:
+    values = {}
+    for name, column in dimensions.items():
+        series = df[column]
+        if ":" in name and name.rsplit(":", 1)[1] in DATE_GRAINS:
+            dates = series if pandas.api.types.is_datetime64_any_dtype(series) else pandas.to_datetime(
+                series, errors="coerce", format="mixed"
+            )
+            grain = name.rsplit(":", 1)[1]
+            series = dates.dt.floor("D") if grain == "day" else dates.dt.to_period("M").dt.to_timestamp()
+        values[name] = series.rename(name)
+    return values
+
+
+def _aggregate(df: pandas.DataFrame, measures: List[str], keys: List[pandas.Series], names) -> Dict[str, pandas.DataFrame]:
+    grouped = df.groupby(keys, observed=True, sort=False)
+    cube = {"rows": grouped.size()}
+    if measures:
+        stats = grouped[[c for c in df.columns if str(c) in measures]].agg(list(STATS))
+        for stat in STATS:
+            table = stats.xs(stat, axis=1, level=1)
+            table.columns = [str(c) for c in table.columns]
+            cube[stat] = table
+    for stat, table in cube.items():
+        table.index = table.index.set_names(list(names)) if table.index.nlevels > 1 else table.index.rename(names[0])
+    return cube
+
+
+def _merge(cube: Dict[str, pandas.DataFrame], other: Optional[Dict[str, pandas.DataFrame]], level=None):
+    """
+    Combine two cubes over the same dimensions (or roll one cube up to `level`):
+    sums and counts add up, minima and maxima are taken again.
+    """
+    merged = {}
+    for stat, table in cube.items():
+        combined = table if other is None else pandas.concat([table, other[stat]])
+        group_level = level if level is not None else list(range(combined.index.nlevels))
+        grouped = combined.groupby(level=group_level, sort=False)
+        merged[stat] = grouped.min() if stat == "min" else grouped.max() if stat == "max" else grouped.sum()
+    return merged
+
+
+def _update_rows_hash(rows_hash, df: pandas.DataFrame):
+    rows_hash.update(pandas.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return rows_hash
+
+
+_cube_cache: "OrderedDict[str, AggregateCubes]" = OrderedDict()
+# Latest cubes per dataset source (e.g. upload path), the base for incremental updates
+_latest_by_source: Dict[str, AggregateCubes] = dict()
+_cube_cache_lock = threading.Lock()
+
+
+def get_cubes(df: pandas.DataFrame, version: str | None = None, source: str | None = None) -> Optional[AggregateCubes]:
+    """
+    Return the cubes of this dataset version, building them once. When the
+    previous version of the same `source` is a prefix of `df` (rows were
+    appended), only the new rows are aggregated. None if cubes are disabled.
+    """
+    if not CUBES_ENABLED:
+        return None
+    version = version or dataset_version(df)
+    with _cube_cache_lock:
+        cubes = _cube_cache.get(version)
+        if cubes is not None:
+            _cube_cache.move_to_end(version)
+            return cubes
+        previous = _latest_by_source.get(source) if source else None
+
+    if previous is not None and previous.is_prefix_of(df):
+        cubes = previous.extended(df, version)
+    else:
+        cubes = AggregateCubes.from_dataframe(df, version)
+    with _cube_cache_lock:
+        _cube_cache[version] = cubes
+        if source:
+            _latest_by_source[source] = cubes
+        while len(_cube_cache) > CUBE_CACHE_SIZE:
+            _cube_cache.popitem(last=False)
+    return cubes
@@ -0,0 +1,151 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List
+
+import pandas
+
+from utils.datasets import dataset_version
+from utils.tokens import count_tokens, truncate_text
+
+logger = logging.getLogger("kinaxis-agent")
+
+# How many rows are scanned for sample values (unique() over a full column is O(n))
+SAMPLE_SCAN_ROWS = 1000
+# Sample values shown per column
+SAMPLE_VALUES = 3
+# Longest rendering of a single cell/sample value
+MAX_VALUE_CHARS = 24
+# How many profiles (dataset versions) are kept in memory
+PROFILE_CACHE_SIZE = 16
+
+# Detail levels, from the most verbose to the most compact.
+_DETAIL_LEVELS = ("full", "no_samples", "no_stats", "names")
+
+
+class DatasetProfile:
+    """Compact, precomputed description of a DataFrame for use in prompts."""
+
+    def __init__(self, version: str, n_rows: int, columns: List[Dict[str, Any]], head: pandas.DataFrame):
+        self.version = version
+        self.n_rows = n_rows
+        self.columns = columns
+        self.head = head
+        self._rendered: Dict[tuple, str] = dict()
+
+    @classmethod
+    def from_dataframe(cls, df: pandas.DataFrame, version: str | None = None, head_rows: int = 6):
+        version = version or dataset_version(df)
+        nulls = df.isna().sum()
+        cardinality = df.nunique(dropna=True)
+
+        # min/max only make sense (and are cheap) for numeric and datetime columns
+        ranged = df.select_dtypes(include=["number", "datetime", "datetimetz"])
+        ranged = ranged.select_dtypes(exclude=["bool"])
+        mins = ranged.min() if not ranged.empty else pandas.Series(dtype=object)
+        maxs = ranged.max() if not ranged.empty else pandas.Series(dtype=object)
+
+        scan = df.head(SAMPLE_SCAN_ROWS)
+        columns = []
+        for col in df.columns:
+            samples = scan[col].dropna().drop_duplicates().head(SAMPLE_VALUES)
+            columns.append(
+                {
+                    "name": str(col),
+                    "dtype": str(df[col].dtype),
+                    "nulls": int(nulls[col]),
+                    "unique": int(cardinality[col]),
+                    "min": mins.get(col) if col in mins.index else None,
+                    "max": maxs.get(col) if col in maxs.index else None,
+                    "samples": [_short(v) for v in samples.tolist()],
+                }
+            )
+        head = df.head(head_rows).apply(lambda s: s.map(_short) if s.dtype == object else s)
+        logger.debug(f"Profiled dataset {version}: {len(df)} rows, {len(columns)} columns")
+        return cls(version, len(df), columns, head)
+
+    def render(self, token_budget: int) -> str:
+        """
+        Render the profile as prompt text that fits in `token_budget` tokens,
+        dropping detail (and eventually columns) until it does.
+        """
+        key = (token_budget,)
+        if key in self._rendered:
+            return self._rendered[key]
+
+        text = None
+        for level in _DETAIL_LEVELS:
+            candidate = self._render_columns(level, len(self.columns))
+            if count_tokens(candidate) <= token_budget:
+                text = candidate
+                break
+        if text is None:
+            text = self._fit_columns(token_budget)
+        else:
+            # Spend what's left of the budget on a few example rows
+            with_head = text + "\n\nExample rows:\n" + self.head.to_string(max_colwidth=MAX_VALUE_CHARS)
+            if count_tokens(with_head) <= token_budget:
+                text = with_head
+
+        self._rendered[key] = text
+        return text
+
+    def _fit_columns(self, token_budget: int) -> str:
+        # Binary search for the largest number of columns that still fits
+        lo, hi = 0, len(self.columns)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if count_tokens(self._render_columns("names", mid)) <= token_budget:
+                lo = mid
+            else:
+                hi = mid - 1
+        return self._render_columns("names", lo)
+
+    def _render_columns(self, level: str, limit: int) -> str:
+        lines = [f"`df` has {self.n_rows} rows and {len(self.columns)} columns:"]
+        for col in self.columns[:limit]:
+            line = f"- {col['name']} ({col['dtype']})"
+            if level in ("full", "no_samples"):
+                stats = [f"nulls={col['nulls']}", f"unique={col['unique']}"]
+                if col["min"] is not None and not pandas.isna(col["min"]):
+                    stats.append(f"range=[{_short(col['min'])}, {_short(col['max'])}]")
+                line += ": " + ", ".join(stats)
+            if level == "full" and col["samples"]:
+                line += "; e.g. " + ", ".join(repr(s) for s in col["samples"])
+            lines.append(line)
+        if limit < len(self.columns):
+            lines.append(
+                f"- ... {len(self.columns) - limit} more columns (inspect `df.columns` to see them)"
+            )
+        return "\n".join(lines)
+
+
+def _short(value: Any) -> Any:
+    if isinstance(value, str):
+        return truncate_text(value, MAX_VALUE_CHARS)
+    if isinstance(value, float):
+        return round(value, 4)
+    if isinstance(value, pandas.Timestamp):
+        return str(value)
+    return value
+
+
+_profile_cache: "OrderedDict[str, DatasetProfile]" = OrderedDict()
+_profile_cache_lock = threading.Lock()
+
+
+def get_dataset_profile(df: pandas.DataFrame, version: str | None = None, head_rows: int = 6) -> DatasetProfile:
+    """Return the cached profile for this dataset version, computing it once."""
+    version = version or dataset_version(df)
+    with _profile_cache_lock:
+        profile = _profile_cache.get(version)
+        if profile is not None:
+            _profile_cache.move_to_end(version)
+            return profile
+
+    profile = DatasetProfile.from_dataframe(df, version, head_rows)
+    with _profile_cache_lock:
+        _profile_cache[version] = profile
+        while len(_profile_cache) > PROFILE_CACHE_SIZE:
+            _profile_cache.popitem(last=False)
+    return profile
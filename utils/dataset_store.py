@@ -0,0 +1,310 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Sequence, Tuple
+
+import pandas
+
+try:
+    import duckdb
+except ImportError:  # optional, SQLite from the stdlib is always available
+    duckdb = None
+
+from utils.datasets import dataset_version, looks_like_dates
+from utils.sql_shaping import is_read_only
+
+logger = logging.getLogger("kinaxis-agent")
+
+# Where the SQLite copies of uploaded datasets are kept (one file per dataset version)
+DATASET_STORE_DIR = os.getenv("DATASET_STORE_DIR", "dataset_store")
+# Seconds a single SQL query on a dataset may run
+DATASET_SQL_TIMEOUT = float(os.getenv("DATASET_SQL_TIMEOUT", 30))
+# Name of the table holding the dataset, same as the DataFrame variable in the REPL
+TABLE_NAME = "df"
+# How many stores (dataset versions) are kept open in memory
+STORE_CACHE_SIZE = 8
+# Rows written per INSERT batch while loading
+LOAD_CHUNK_ROWS = 50000
+# Columns with at most this share of distinct values get a secondary index
+INDEX_MAX_DISTINCT_RATIO = float(os.getenv("DATASET_INDEX_MAX_DISTINCT_RATIO", 0.5))
+# At most this many indexes per dataset (each one costs load time and disk)
+INDEX_MAX_COLUMNS = int(os.getenv("DATASET_INDEX_MAX_COLUMNS", 8))
+# Bumped whenever the layout of the SQLite files changes, so older files get rebuilt
+STORE_FORMAT = 2
+# Dates are stored (and filter values compared) in this format, so text comparison orders them by time
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+FILTER_OPERATORS = {"=": "=", "==": "=", "!=": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">=", "in": "IN", "between": "BETWEEN"}
+
+
+class DatasetStore:
+    """
+    Read-only SQL access to an uploaded dataset.
+
+    The dataset is registered as table `df` in DuckDB when it is installed
+    (vectorized, works on the DataFrame in place), otherwise it is copied once
+    per dataset version into an SQLite file that later requests reuse.
+
+    SQLite files are opened read-only. DuckDB runs in memory without file
+    access and only accepts single SELECT statements. Both engines abort
+    queries running longer than DATASET_SQL_TIMEOUT.
+    """
+
+    def __init__(self, df: pandas.DataFrame, version: str):
+        self.version = version
+        self.columns = [str(column) for column in df.columns]
+        self.datetime_columns = {
+            str(column) for column in df.columns if pandas.api.types.is_datetime64_any_dtype(df[column])
+        }
+        # Text columns holding dates (e.g. MM/DD/YYYY) are stored as ISO text in both engines
+        self.text_date_columns = {
+            str(column) for column in df.columns if df[column].dtype == object and looks_like_dates(df[column])
+        }
+        self.indexed_columns: List[str] = []
+        if duckdb is not None:
+            # Columnar scans are fast enough that DuckDB doesn't need secondary indexes
+            self.engine = "duckdb"
+            # No file or network access (read_csv('/etc/...'), COPY, ATTACH), and queries can't turn it back on
+            self._duckdb = duckdb.connect(config={"enable_external_access": False, "lock_configuration": True})
+            self._frame = _with_iso_dates(df, self.text_date_columns)
+        else:
+            self.engine = "sqlite"
+            self.path = os.path.join(DATASET_STORE_DIR, f"{version}.sqlite3")
+            if not os.path.exists(self.path) or self._file_format() < STORE_FORMAT:
+                self._load_sqlite(df)
+            self.indexed_columns = self._read_indexed_columns()
+
+    @property
+    def dialect(self) -> str:
+        return "DuckDB" if self.engine == "duckdb" else "SQLite"
+
+    def _load_sqlite(self, df: pandas.DataFrame):
+        start = time.perf_counter()
+        os.makedirs(DATASET_STORE_DIR, exist_ok=True)
+        # Written under a temporary name so a concurrent request never opens a half-loaded file
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        index_columns = _index_columns(df)
+        with sqlite3.connect(tmp_path) as conn:
+            _sqlite_frame(_with_iso_dates(df, self.text_date_columns)).to_sql(TABLE_NAME, conn, index=False, chunksize=LOAD_CHUNK_ROWS)
+            for i, column in enumerate(index_columns):
+                conn.execute(f"CREATE INDEX idx_{TABLE_NAME}_{i} ON {TABLE_NAME} ({_quote(column)})")
+            # Statistics let the planner choose between indexes and a full scan
+            conn.execute("ANALYZE")
+            conn.execute(f"PRAGMA user_version = {STORE_FORMAT}")
+        conn.close()
+        os.replace(tmp_path, self.path)
+        logger.info(
+            f"Dataset {self.version} loaded into SQLite in {time.perf_counter() - start:.2f}s, "
+            f"indexed columns: {index_columns}"
+        )
+
+    def _file_format(self) -> int:
+        with sqlite3.connect(f"file:{self.path}?mode=ro", uri=True) as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+        conn.close()
+        return version
+
+    def _read_indexed_columns(self) -> List[str]:
+        conn = self.connect()
+        try:
+            indexes = conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (TABLE_NAME,)
+            ).fetchall()
+            return [
+                info[2] for (name,) in indexes for info in conn.execute(f"PRAGMA index_info({_quote(name)})")
+            ]
+        finally:
+            conn.close()
+
+    def connect(self) -> sqlite3.Connection:
+        """Read-only connection to the SQLite copy of the dataset"""
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def query(self, sql: str, max_rows: int) -> Tuple[pandas.DataFrame, bool]:
+        """
+        Run a read-only query. Returns at most `max_rows` rows and whether the
+        result had more.
+        """
+        return self._execute(sql, (), max_rows)
+
+    def filter_rows(
+        self,
+        filters: Sequence[Dict[str, Any]],
+        columns: Sequence[str] | None = None,
+        max_rows: int = 100,
+        offset: int = 0,
+    ) -> Tuple[pandas.DataFrame, bool]:
+        """
+        Point and range filters, e.g. [{"column": "factory", "op": "=", "value": "F1"},
+        {"column": "date", "op": "between", "value": ["2024-01-01", "2024-03-31"]}].
+        Filters on indexed columns are answered from the index instead of a scan.
+        Raises ValueError for unknown columns or operators.
+        """
+        selected = ", ".join(_quote(self._column(c)) for c in columns) if columns else "*"
+        conditions, params = [], []
+        for f in filters:
+            column = self._column(f.get("column"))
+            op = FILTER_OPERATORS.get(str(f.get("op", "=")).lower())
+            if op is None:
+                raise ValueError(f"Unsupported filter operator: {f.get('op')}")
+            values = f.get("value")
+            if op in ("IN", "BETWEEN"):
+                values = list(values) if isinstance(values, (list, tuple)) else [values]
+                if op == "BETWEEN" and len(values) != 2:
+                    raise ValueError("between needs exactly two values")
+                if not values:
+                    raise ValueError("in needs at least one value")
+            else:
+                values = [values]
+            params.extend(self._sql_value(column, value) for value in values)
+            if op == "IN":
+                conditions.append(f"{_quote(column)} IN ({', '.join('?' * len(values))})")
+            elif op == "BETWEEN":
+                conditions.append(f"{_quote(column)} BETWEEN ? AND ?")
+            else:
+                conditions.append(f"{_quote(column)} {op} ?")
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        sql = f"SELECT {selected} FROM {TABLE_NAME}{where} LIMIT {int(max_rows) + 1} OFFSET {int(offset)}"
+        return self._execute(sql, params, max_rows)
+
+    def _column(self, column) -> str:
+        if column not in self.columns:
+            raise ValueError(f"Unknown column: {column}")
+        return column
+
+    def _sql_value(self, column: str, value):
+        # Dates stored as ISO text are compared against the same format
+        # (DuckDB keeps real datetime columns as TIMESTAMP)
+        if value is None:
+            return value
+        if column in self.text_date_columns or (column in self.datetime_columns and self.engine == "sqlite"):
+            try:
+                return pandas.Timestamp(value).strftime(DATE_FORMAT)
+            except (TypeError, ValueError):
+                raise ValueError(f"Not a date for column {column}: {value!r}")
+        return value
+
+    def _execute(self, sql: str, params: Sequence, max_rows: int) -> Tuple[pandas.DataFrame, bool]:
+        if self.engine == "duckdb":
+            # The in-memory database isn't read-only like the SQLite file, so writes are refused up front
+            if not is_read_only(sql):
+                raise ValueError("Only a single read-only SELECT statement can run on the dataset")
+            cursor = self._duckdb.cursor()
+            # Registered per cursor: without external access a cursor doesn't see the connection's DataFrames
+            cursor.register(TABLE_NAME, self._frame)
+            timer = threading.Timer(DATASET_SQL_TIMEOUT, cursor.interrupt)
+            timer.start()
+            try:
+                cursor.execute(sql, list(params))
+                rows = cursor.fetchmany(max_rows + 1)
+                columns = [d[0] for d in cursor.description]
+            except duckdb.InterruptException:
+                raise TimeoutError(f"Query took longer than {DATASET_SQL_TIMEOUT:g}s and was aborted")
+            finally:
+                timer.cancel()
+                cursor.close()
+        else:
+            conn = self.connect()
+            deadline = time.monotonic() + DATASET_SQL_TIMEOUT
+            # Returning non-zero from the progress handler aborts the query
+            conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+            try:
+                cursor = conn.execute(sql, params)
+                rows = cursor.fetchmany(max_rows + 1)
+                columns = [d[0] for d in cursor.description or []]
+            finally:
+                conn.close()
+        return pandas.DataFrame(rows[:max_rows], columns=columns), len(rows) > max_rows
+
+
+def _quote(identifier: str) -> str:
+    return '"' + str(identifier).replace('"', '""') + '"'
+
+
+def _index_columns(df: pandas.DataFrame) -> List[str]:
+    """
+    Columns worth a secondary index: dates (real or ISO-like text) and
+    low/medium-cardinality keys such as factory or part number. Measures
+    (floats) and near-unique columns are left out.
+    """
+    n_rows = len(df)
+    if n_rows == 0:
+        return []
+    dates, keys = [], []
+    for column in df.columns:
+        series = df[column]
+        if pandas.api.types.is_datetime64_any_dtype(series) or (
+            series.dtype == object and looks_like_dates(series)
+        ):
+            dates.append(str(column))
+        elif series.dtype == object or pandas.api.types.is_integer_dtype(series) or isinstance(
+            series.dtype, pandas.CategoricalDtype
+        ):
+            distinct = series.nunique()
+            if 1 < distinct <= n_rows * INDEX_MAX_DISTINCT_RATIO:
+                keys.append((distinct, str(column)))
+    # Most selective keys first
+    keys = [column for _, column in sorted(keys, reverse=True)]
+    return (dates + keys)[:INDEX_MAX_COLUMNS]
+
+
+def _iso_dates(series: pandas.Series) -> pandas.Series:
+    """Text dates as 'YYYY-MM-DD HH:MM:SS'; values that don't parse are kept as they are"""
+    parsed = pandas.to_datetime(series, errors="coerce")
+    if parsed.isna().sum() > series.isna().sum():
+        # No single format fits the whole column, parse every value on its own
+        parsed = pandas.to_datetime(series, errors="coerce", format="mixed")
+    return parsed.dt.strftime(DATE_FORMAT).where(parsed.notna(), series)
+
+
+def _with_iso_dates(df: pandas.DataFrame, columns) -> pandas.DataFrame:
+    if not columns:
+        return df
+    df = df.copy(deep=False)
+    for column in df.columns:
+        if str(column) in columns:
+            df[column] = _iso_dates(df[column])
+    return df
+
+
+def _sqlite_frame(df: pandas.DataFrame) -> pandas.DataFrame:
+    """Column types SQLite can't store (mixed objects, timedeltas, ...) are written as text."""
+    converted = {}
+    for column in df.columns:
+        series = df[column]
+        if series.dtype == object and not series.map(lambda v: v is None or isinstance(v, (str, int, float))).all():
+            converted[column] = series.astype(str)
+        elif pandas.api.types.is_timedelta64_dtype(series):
+            converted[column] = series.astype(str)
+    if not converted:
+        return df
+    df = df.copy(deep=False)
+    for column, series in converted.items():
+        df[column] = series
+    return df
+
+
+_store_cache: "OrderedDict[str, DatasetStore]" = OrderedDict()
+_store_cache_lock = threading.Lock()
+
+
+def get_dataset_store(df: pandas.DataFrame, version: str | None = None) -> DatasetStore:
+    """Return the store for this dataset version, loading it once."""
+    version = version or dataset_version(df)
+    with _store_cache_lock:
+        store = _store_cache.get(version)
+        if store is not None:
+            _store_cache.move_to_end(version)
+            return store
+
+    store = DatasetStore(df, version)
+    with _store_cache_lock:
+        _store_cache[version] = store
+        while len(_store_cache) > STORE_CACHE_SIZE:
+            _store_cache.popitem(last=False)
+    return store
@@ -0,0 +1,38 @@
+import os
+import hashlib
+
+import pandas
+
+# Rows checked when guessing whether a text column holds dates
+DATE_SNIFF_ROWS = 200
+
+
+def dataset_version(df: pandas.DataFrame) -> str:
+    """
+    Content hash of a DataFrame, used as a cache key for anything derived from
+    the dataset. Vectorized, so it stays cheap even for large uploads.
+    """
+    row_hashes = pandas.util.hash_pandas_object(df, index=True).to_numpy()
+    digest = hashlib.sha1(row_hashes.tobytes())
+    digest.update("\x1f".join(map(str, df.columns)).encode())
+    digest.update("\x1f".join(map(str, df.dtypes)).encode())
+    return digest.hexdigest()[:16]
+
+
+def file_version(path: str) -> str:
+    """
+    Cheap version key for a dataset file (path, size and mtime), so we don't need
+    to hash the whole DataFrame on every request.
+    """
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def looks_like_dates(series: pandas.Series) -> bool:
+    """True if a text column holds (mostly) parseable dates, judged on a sample."""
+    sample = series.dropna().head(DATE_SNIFF_ROWS)
+    if sample.empty or not sample.map(lambda v: isinstance(v, str)).all():
+        return False
+    parsed = pandas.to_datetime(sample, errors="coerce", format="mixed")
+    return parsed.notna().mean() > 0.9
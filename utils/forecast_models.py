@@ -0,0 +1,177 @@
+import logging
+from typing import Callable, Dict
+
+import numpy
+import pandas
+from scipy.signal import lfilter
+
+logger = logging.getLogger("kinaxis-agent")
+
+# z-score of the reported prediction intervals (80%, same as Prophet's default interval_width)
+INTERVAL_Z = 1.2816
+# Smoothing factors tried by exponential smoothing
+SMOOTHING_GRID = numpy.linspace(0.05, 0.95, 19)
+
+
+def infer_frequency(ds: pandas.Series):
+    """Frequency of a sorted date series: a pandas alias when regular, else the median step"""
+    if len(ds) >= 3:
+        freq = pandas.infer_freq(ds.tail(100))
+        if freq is not None:
+            return freq
+    if len(ds) < 2:
+        return "D"
+    return ds.diff().median()
+
+
+def season_length(ds: pandas.Series) -> int:
+    """Length of the seasonal cycle implied by the spacing of the dates (1 if none)"""
+    if len(ds) < 2:
+        return 1
+    step = ds.diff().median()
+    if step <= pandas.Timedelta(hours=1):
+        return 24
+    if step <= pandas.Timedelta(days=1):
+        return 7
+    if step <= pandas.Timedelta(days=7):
+        return 52
+    if step <= pandas.Timedelta(days=31):
+        return 12
+    if step <= pandas.Timedelta(days=92):
+        return 4
+    return 1
+
+
+class FastModel:
+    """
+    Vectorized baseline forecaster. `fit` takes the ds/y history (sorted by
+    date); `predict` returns ds, yhat, yhat_lower and yhat_upper for the
+    history and `periods` future steps, like a Prophet forecast.
+    """
+
+    name = "fast"
+
+    def __init__(self, season: int):
+        self.season = season
+
+    def fit(self, history: pandas.DataFrame) -> "FastModel":
+        self.ds = history["ds"].reset_index(drop=True)
+        self.y = history["y"].to_numpy(dtype=float)
+        self.freq = infer_frequency(self.ds)
+        self._fit()
+        return self
+
+    def predict(self, periods: int) -> pandas.DataFrame:
+        steps = numpy.arange(1, periods + 1)
+        future, spread = self._forecast(steps)
+        future_ds = pandas.date_range(self.ds.iloc[-1], periods=periods + 1, freq=self.freq)[1:]
+        fitted = numpy.where(numpy.isnan(self.fitted), self.y, self.fitted)
+        margin = INTERVAL_Z * self.sigma
+        return pandas.DataFrame({
+            "ds": numpy.concatenate([self.ds.to_numpy(), future_ds.to_numpy()]),
+            "yhat": numpy.concatenate([fitted, future]),
+            "yhat_lower": numpy.concatenate([fitted - margin, future - spread]),
+            "yhat_upper": numpy.concatenate([fitted + margin, future + spread]),
+        })
+
+    def _residual_sigma(self) -> float:
+        residuals = self.y - self.fitted
+        residuals = residuals[~numpy.isnan(residuals)]
+        return float(numpy.sqrt(numpy.mean(residuals ** 2))) if len(residuals) else 0.0
+
+    def _fit(self):
+        raise NotImplementedError
+
+    def _forecast(self, steps: numpy.ndarray):
+        raise NotImplementedError
+
+
+class SeasonalNaive(FastModel):
+    """Repeats the last seasonal cycle (the last value when there's no season)"""
+
+    name = "seasonal_naive"
+
+    def _fit(self):
+        if len(self.y) < 2 * self.season:
+            self.season = 1
+        m = self.season
+        self.fitted = numpy.concatenate([numpy.full(m, numpy.nan), self.y[:-m]])
+        self.sigma = self._residual_sigma()
+
+    def _forecast(self, steps):
+        m = self.season
+        last_cycle = self.y[-m:]
+        future = last_cycle[(steps - 1) % m]
+        # The error grows with every cycle repeated
+        spread = INTERVAL_Z * self.sigma * numpy.sqrt((steps - 1) // m + 1)
+        return future, spread
+
+
+class ExponentialSmoothing(FastModel):
+    """Simple exponential smoothing, smoothing factor chosen by one-step-ahead error"""
+
+    name = "exponential_smoothing"
+
+    def _fit(self):
+        best = None
+        for alpha in SMOOTHING_GRID:
+            level = _smooth(self.y, alpha)
+            errors = self.y[1:] - level[:-1]
+            sse = float(numpy.dot(errors, errors))
+            if best is None or sse < best[0]:
+                best = (sse, alpha, level)
+        _, self.alpha, level = best
+        self.level = level[-1]
+        self.fitted = numpy.concatenate([[numpy.nan], level[:-1]])
+        self.sigma = self._residual_sigma()
+
+    def _forecast(self, steps):
+        future = numpy.full(len(steps), self.level)
+        spread = INTERVAL_Z * self.sigma * numpy.sqrt(1 + (steps - 1) * self.alpha ** 2)
+        return future, spread
+
+
+class LinearTrend(FastModel):
+    """Least-squares linear trend plus one additive offset per position in the seasonal cycle"""
+
+    name = "linear_trend"
+
+    def _fit(self):
+        if len(self.y) < 2 * self.season:
+            self.season = 1
+        n = len(self.y)
+        coefficients, *_ = numpy.linalg.lstsq(self._design(numpy.arange(n)), self.y, rcond=None)
+        self.coefficients = coefficients
+        self.fitted = self._design(numpy.arange(n)) @ coefficients
+        self.sigma = self._residual_sigma()
+
+    def _design(self, t: numpy.ndarray) -> numpy.ndarray:
+        scale = max(len(self.y) - 1, 1)
+        columns = [numpy.ones(len(t)), t / scale]
+        if self.season > 1:
+            position = t % self.season
+            columns.extend((position == p).astype(float) for p in range(1, self.season))
+        return numpy.column_stack(columns)
+
+    def _forecast(self, steps):
+        future = self._design(len(self.y) - 1 + steps) @ self.coefficients
+        return future, numpy.full(len(steps), INTERVAL_Z * self.sigma)
+
+
+def _smooth(y: numpy.ndarray, alpha: float) -> numpy.ndarray:
+    """Levels l_t = alpha * y_t + (1 - alpha) * l_(t-1), starting at y_0, as one linear filter"""
+    level, _ = lfilter([alpha], [1, -(1 - alpha)], y, zi=[(1 - alpha) * y[0]])
+    return level
+
+
+# Fast models by name; further models can be added with register_model
+FAST_MODELS: Dict[str, Callable[[int], FastModel]] = {
+    SeasonalNaive.name: SeasonalNaive,
+    ExponentialSmoothing.name: ExponentialSmoothing,
+    LinearTrend.name: LinearTrend,
+}
+
+
+def register_model(name: str, factory: Callable[[int], FastModel]):
+    """Make a model (a FastModel subclass taking the season length) available by name"""
+    FAST_MODELS[name] = factory
@@ -0,0 +1,461 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Dict, Optional, Tuple
+
+import numpy
+import pandas
+from prophet import Prophet
+
+from utils.forecast_models import FAST_MODELS, infer_frequency, season_length
+
+logger = logging.getLogger("kinaxis-agent")
+
+# How many fitted models are kept in memory
+FORECAST_CACHE_SIZE = int(os.getenv("FORECAST_CACHE_SIZE", 32))
+# Threads refitting models in the background after a dataset changed
+FORECAST_REFIT_WORKERS = int(os.getenv("FORECAST_REFIT_WORKERS", 1))
+# Processes fitting the series of a batch forecast in parallel
+FORECAST_BATCH_WORKERS = int(os.getenv("FORECAST_BATCH_WORKERS", os.cpu_count() or 1))
+# Seconds a single series of a batch may take to fit before it's reported as timed out
+FORECAST_SERIES_TIMEOUT = float(os.getenv("FORECAST_SERIES_TIMEOUT", 60))
+# Upper bound of series in one batch request
+FORECAST_BATCH_MAX_SERIES = int(os.getenv("FORECAST_BATCH_MAX_SERIES", 1000))
+# Model used when a request doesn't name one: "auto" backtests the candidates on a holdout
+FORECAST_DEFAULT_MODEL = os.getenv("FORECAST_DEFAULT_MODEL", "auto")
+# In auto mode Prophet is only chosen when its holdout error is this much lower than the best fast model's
+PROPHET_WIN_MARGIN = float(os.getenv("PROPHET_WIN_MARGIN", 0.1))
+# Auto mode can skip Prophet altogether (fast models only)
+FORECAST_AUTO_PROPHET = os.getenv("FORECAST_AUTO_PROPHET", "1") == "1"
+# Holdout of the auto-mode backtest: a fifth of the series, at most this many steps
+BACKTEST_MAX_STEPS = 60
+# Prophet constructor arguments a request may set; everything else is Prophet's default
+PROPHET_PARAMS = {
+    "growth",
+    "n_changepoints",
+    "changepoint_range",
+    "changepoint_prior_scale",
+    "seasonality_mode",
+    "seasonality_prior_scale",
+    "yearly_seasonality",
+    "weekly_seasonality",
+    "daily_seasonality",
+    "interval_width",
+}
+
+FORECAST_COLUMNS = ["ds", "yhat", "yhat_lower", "yhat_upper"]
+
+
+class FittedForecast:
+    """
+    A model (Prophet or one of the fast models) fitted on one series.
+    Predictions are cached for the longest horizon asked so far; shorter
+    horizons are a slice of it. `backtest` holds the holdout error of every
+    candidate when the model was picked in auto mode.
+    """
+
+    def __init__(self, model, key: str, n_rows: int, fit_seconds: float, name: str = "prophet", freq="D"):
+        self.model = model
+        self.key = key
+        self.n_rows = n_rows
+        self.fit_seconds = fit_seconds
+        self.name = name
+        self.freq = freq
+        self.backtest: Dict[str, float] = dict()
+        self._lock = threading.Lock()
+        self._periods = -1
+        self._prediction: Optional[pandas.DataFrame] = None
+
+    def predict(self, periods: int) -> pandas.DataFrame:
+        with self._lock:
+            if periods > self._periods:
+                if self.name == "prophet":
+                    future = self.model.make_future_dataframe(periods=periods, freq=self.freq)
+                    self._prediction = self.model.predict(future)[FORECAST_COLUMNS]
+                else:
+                    self._prediction = self.model.predict(periods)
+                self._periods = periods
+            prediction, total = self._prediction, self._periods
+        return prediction.iloc[: len(prediction) - (total - periods)].reset_index(drop=True)
+
+
+def series_frame(df: pandas.DataFrame, date_column: str, value_column: str) -> pandas.DataFrame:
+    """The ds/y frame Prophet is fitted on. Raises ValueError for unknown columns."""
+    if date_column not in df.columns or value_column not in df.columns:
+        raise ValueError("The specified columns do not exist in the dataframe.")
+    history = df[[date_column, value_column]].rename(columns={date_column: "ds", value_column: "y"})
+    if not pandas.api.types.is_datetime64_any_dtype(history["ds"]):
+        history["ds"] = pandas.to_datetime(history["ds"], errors="coerce", format="mixed")
+    history["y"] = pandas.to_numeric(history["y"], errors="coerce")
+    return history.dropna().sort_values("ds", kind="stable").reset_index(drop=True)
+
+
+def forecast_model_name(model: str | None) -> str:
+    """Validated model name. Raises ValueError for unknown models."""
+    model = (model or FORECAST_DEFAULT_MODEL).lower()
+    if model not in ("auto", "prophet", *FAST_MODELS):
+        raise ValueError(f"Unknown model: {model}. Choose from: auto, prophet, {', '.join(FAST_MODELS)}")
+    return model
+
+
+def prophet_params(params: Dict[str, Any] | None, model: str = "prophet") -> Dict[str, Any]:
+    """Validated Prophet arguments. Raises ValueError for unsupported ones."""
+    params = dict(params or {})
+    if params and model not in ("auto", "prophet"):
+        raise ValueError(f"Model parameters only apply to Prophet, not to {model}")
+    unknown = set(params) - PROPHET_PARAMS
+    if unknown:
+        raise ValueError(f"Unsupported model parameters: {', '.join(sorted(unknown))}")
+    return params
+
+
+def model_key(history: pandas.DataFrame, params: Dict[str, Any], model: str = "prophet") -> str:
+    """Content hash of the fitted series, the model and its parameters"""
+    digest = hashlib.sha1(pandas.util.hash_pandas_object(history, index=False).to_numpy().tobytes())
+    digest.update(repr((model, sorted(params.items()))).encode())
+    return digest.hexdigest()[:16]
+
+
+def _warm_start(model: Prophet) -> Dict[str, Any]:
+    """Fitted parameters of a model, used to initialize the fit of a newer version of its series"""
+    params = {name: model.params[name][0][0] for name in ("k", "m", "sigma_obs")}
+    params.update({name: model.params[name][0] for name in ("delta", "beta")})
+    return params
+
+
+def _fit(
+    history: pandas.DataFrame,
+    params: Dict[str, Any],
+    key: str,
+    previous: Optional[FittedForecast],
+    timeout: float | None = None,
+    model: str = "prophet",
+) -> FittedForecast:
+    if model == "auto":
+        return _fit_auto(history, params, key, previous, timeout)
+    if model != "prophet":
+        return _fit_fast(history, key, model)
+    if previous is not None and previous.name != "prophet":
+        previous = None
+    return _fit_prophet(history, params, key, previous, timeout)
+
+
+def _fit_fast(history: pandas.DataFrame, key: str, model: str) -> FittedForecast:
+    start = time.perf_counter()
+    # Fast models need one value per date; repeated dates are averaged, as Prophet's fit effectively does
+    series = history.groupby("ds", as_index=False)["y"].mean()
+    fitted = FAST_MODELS[model](season_length(series["ds"])).fit(series)
+    seconds = time.perf_counter() - start
+    logger.info(f"Fitted {model} forecast model {key} on {len(series)} rows in {seconds:.3f}s")
+    return FittedForecast(fitted, key, len(series), seconds, model, fitted.freq)
+
+
+def _fit_prophet(
+    history: pandas.DataFrame,
+    params: Dict[str, Any],
+    key: str,
+    previous: Optional[FittedForecast],
+    timeout: float | None = None,
+) -> FittedForecast:
+    start = time.perf_counter()
+    # Passed on to cmdstanpy, which stops the optimizer process after `timeout` seconds
+    fit_args = {"timeout": timeout} if timeout else {}
+    model = Prophet(**params)
+    fitted = False
+    if previous is not None:
+        # Starting from the previous optimum converges faster; shapes differ when the
+        # number of changepoints or seasonality terms changed, then we fit from scratch
+        try:
+            model.fit(history, init=_warm_start(previous.model), **fit_args)
+            fitted = True
+        except Exception as e:
+            logger.info(f"Warm start of forecast model {key} failed ({e}), fitting from scratch")
+            model = Prophet(**params)
+    if not fitted:
+        model.fit(history, **fit_args)
+    seconds = time.perf_counter() - start
+    logger.info(
+        f"Fitted forecast model {key} on {len(history)} rows in {seconds:.2f}s"
+        + (" (warm start)" if fitted else "")
+    )
+    return FittedForecast(model, key, len(history), seconds, "prophet", infer_frequency(history["ds"].drop_duplicates()))
+
+
+def _fit_auto(
+    history: pandas.DataFrame,
+    params: Dict[str, Any],
+    key: str,
+    previous: Optional[FittedForecast],
+    timeout: float | None = None,
+) -> FittedForecast:
+    """
+    Backtest every fast model (and Prophet) on the last part of the series,
+    then fit the winner on all of it. Prophet has to beat the best fast model
+    by PROPHET_WIN_MARGIN, since it is orders of magnitude slower.
+    """
+    series = history.groupby("ds", as_index=False)["y"].mean()
+    steps = min(len(series) // 5, BACKTEST_MAX_STEPS)
+    if steps < 1:
+        return _fit_fast(history, key, "linear_trend")
+    train, test = series.iloc[:-steps], series.iloc[-steps:]
+    actual = test["y"].to_numpy()
+
+    errors = dict()
+    for name, factory in FAST_MODELS.items():
+        try:
+            predicted = factory(season_length(train["ds"])).fit(train).predict(steps)["yhat"].to_numpy()[-steps:]
+            errors[name] = float(numpy.mean(numpy.abs(predicted - actual)))
+        except Exception as e:
+            logger.info(f"Backtest of {name} failed: {e}")
+    # None if every fast backtest failed (e.g. a degenerate holdout)
+    best_fast = min(errors, key=errors.get) if errors else None
+    if FORECAST_AUTO_PROPHET:
+        try:
+            model = Prophet(**params)
+            model.fit(train, **({"timeout": timeout} if timeout else {}))
+            predicted = model.predict(test[["ds"]])["yhat"].to_numpy()
+            errors["prophet"] = float(numpy.mean(numpy.abs(predicted - actual)))
+        except Exception as e:
+            logger.info(f"Backtest of prophet failed: {e}")
+
+    if best_fast is None:
+        # Nothing to compare against: Prophet if its backtest worked, else the simplest fast model
+        chosen = "prophet" if "prophet" in errors else "linear_trend"
+    else:
+        prophet_wins = errors.get("prophet", numpy.inf) < errors[best_fast] * (1 - PROPHET_WIN_MARGIN)
+        chosen = "prophet" if prophet_wins else best_fast
+    logger.info(f"Auto forecast model {key}: holdout MAE over {steps} steps {errors}, chose {chosen}")
+    if chosen == "prophet":
+        previous = previous if previous is not None and previous.name == "prophet" else None
+        fitted = _fit_prophet(history, params, key, previous, timeout)
+    else:
+        fitted = _fit_fast(history, key, chosen)
+    fitted.backtest = errors
+    return fitted
+
+
+_model_cache: "OrderedDict[str, FittedForecast]" = OrderedDict()
+# Fits in progress, so concurrent requests for the same model wait for one fit
+_fits_in_flight: Dict[str, Future] = dict()
+# Latest model per (source, date column, value column, params, model): warm starts and background refits
+_latest_by_source: Dict[Tuple[str, str, str, str, str], Tuple[FittedForecast, Dict[str, Any]]] = dict()
+_model_cache_lock = threading.Lock()
+_refit_executor = ThreadPoolExecutor(max_workers=FORECAST_REFIT_WORKERS, thread_name_prefix="forecast-refit")
+
+
+def get_forecast_model(
+    df: pandas.DataFrame,
+    date_column: str,
+    value_column: str,
+    params: Dict[str, Any] | None = None,
+    source: str | None = None,
+    model: str | None = None,
+) -> FittedForecast:
+    """
+    The model of a series, fitted once per series content, model and
+    parameters. `model` is "auto" (pick by backtest), "prophet" or the name of
+    a fast model, FORECAST_DEFAULT_MODEL when not given. Raises ValueError for
+    unknown columns, models or parameters.
+    """
+    model = forecast_model_name(model)
+    params = prophet_params(params, model)
+    history = series_frame(df, date_column, value_column)
+    if len(history) < 2:
+        raise ValueError("Not enough data points to fit a forecast.")
+    key = model_key(history, params, model)
+    source_key = (source, date_column, value_column, repr(sorted(params.items())), model) if source else None
+
+    with _model_cache_lock:
+        fitted = _model_cache.get(key)
+        if fitted is not None:
+            _model_cache.move_to_end(key)
+            return fitted
+        in_flight = _fits_in_flight.get(key)
+        if in_flight is None:
+            in_flight = _fits_in_flight[key] = Future()
+            owner = True
+        else:
+            owner = False
+        previous = _latest_by_source.get(source_key, (None, None))[0] if source_key else None
+
+    if not owner:
+        return in_flight.result()
+    try:
+        fitted = _fit(history, params, key, previous, model=model)
+    except BaseException as e:
+        with _model_cache_lock:
+            del _fits_in_flight[key]
+        in_flight.set_exception(e)
+        raise
+    with _model_cache_lock:
+        _model_cache[key] = fitted
+        while len(_model_cache) > FORECAST_CACHE_SIZE:
+            _model_cache.popitem(last=False)
+        if source_key:
+            _latest_by_source[source_key] = (fitted, params)
+        del _fits_in_flight[key]
+    in_flight.set_result(fitted)
+    return fitted
+
+
+def forecast(
+    df: pandas.DataFrame,
+    date_column: str,
+    value_column: str,
+    periods: int = 10,
+    params: Dict[str, Any] | None = None,
+    source: str | None = None,
+    model: str | None = None,
+) -> pandas.DataFrame:
+    """History and `periods` future steps of yhat with its uncertainty interval"""
+    return get_forecast_model(df, date_column, value_column, params, source, model).predict(periods)
+
+
+def refit_in_background(df: pandas.DataFrame, source: str):
+    """
+    The dataset behind `source` changed: refit every series forecast from it
+    before, in the background, so the next request finds the model ready.
+    """
+    with _model_cache_lock:
+        targets = [(key, params) for key, (_, params) in _latest_by_source.items() if key[0] == source]
+    for (_, date_column, value_column, _, model), params in targets:
+        if date_column not in df.columns or value_column not in df.columns:
+            continue
+        future = _refit_executor.submit(get_forecast_model, df, date_column, value_column, params, source, model)
+        future.add_done_callback(_log_refit_error)
+
+
+def _log_refit_error(future: Future):
+    if future.exception() is not None:
+        logger.error(f"Background refit of a forecast model failed: {future.exception()}")
+
+
+def _cached_model(key: str) -> Optional[FittedForecast]:
+    with _model_cache_lock:
+        return _model_cache.get(key)
+
+
+def _forecast_series(
+    name, history: pandas.DataFrame, params: Dict[str, Any], key: str, periods: int, timeout: float, model: str
+):
+    """Fit and predict one series of a batch (in a worker process unless the model is a fast one)"""
+    start = time.perf_counter()
+    try:
+        prediction = _fit(history, params, key, None, timeout, model).predict(periods)
+        return name, prediction, "ok", time.perf_counter() - start
+    except Exception as e:
+        status = "timeout" if isinstance(e, TimeoutError) else f"error: {e}"
+        return name, None, status, time.perf_counter() - start
+
+
+_batch_executor: Optional[ProcessPoolExecutor] = None
+_batch_executor_lock = threading.Lock()
+
+
+def _get_batch_executor() -> ProcessPoolExecutor:
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is None:
+            # Spawned rather than forked: the web process runs threads (prefetch, sweeper, refits)
+            _batch_executor = ProcessPoolExecutor(
+                max_workers=FORECAST_BATCH_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _batch_executor
+
+
+def forecast_batch(
+    df: pandas.DataFrame,
+    group_column: str,
+    date_column: str,
+    value_column: str,
+    periods: int = 10,
+    params: Dict[str, Any] | None = None,
+    include_history: bool = False,
+    model: str | None = None,
+) -> Tuple[pandas.DataFrame, Dict[str, Any]]:
+    """
+    Forecast every series of `df` (one per value of `group_column`, e.g. per
+    part or factory), fitting them in parallel across a process pool. Series
+    already fitted in this process are reused. Returns one long-format frame
+    (`group_column` plus the forecast columns, only future rows unless
+    `include_history`) and the batch statistics, with the status of every
+    series that couldn't be forecast. Raises ValueError for unknown columns or
+    parameters and for batches with too many series.
+    """
+    start = time.perf_counter()
+    model = forecast_model_name(model)
+    params = prophet_params(params, model)
+    if group_column not in df.columns:
+        raise ValueError(f"Column '{group_column}' does not exist in the dataframe.")
+    series = {name: series_frame(group, date_column, value_column) for name, group in df.groupby(group_column, sort=True)}
+    if len(series) > FORECAST_BATCH_MAX_SERIES:
+        raise ValueError(f"{len(series)} series, at most {FORECAST_BATCH_MAX_SERIES} can be forecast at once.")
+
+    results: Dict[Any, pandas.DataFrame] = dict()
+    statuses: Dict[Any, str] = dict()
+    futures = {}
+    reused = 0
+    for name, history in series.items():
+        if len(history) < 2:
+            statuses[name] = "too few data points"
+            continue
+        key = model_key(history, params, model)
+        fitted = _cached_model(key)
+        if fitted is not None:
+            results[name] = fitted.predict(periods)
+            reused += 1
+        elif model in FAST_MODELS:
+            # Milliseconds per series, cheaper than shipping it to another process
+            _, prediction, status, _ = _forecast_series(name, history, params, key, periods, None, model)
+            if prediction is not None:
+                results[name] = prediction
+            else:
+                statuses[name] = status
+        else:
+            futures[name] = _get_batch_executor().submit(
+                _forecast_series, name, history, params, key, periods, FORECAST_SERIES_TIMEOUT, model
+            )
+
+    for name, future in futures.items():
+        try:
+            # The worker enforces the timeout itself; this only guards against a stuck process
+            _, prediction, status, _ = future.result(timeout=FORECAST_SERIES_TIMEOUT + 30)
+        except FutureTimeoutError:
+            future.cancel()
+            prediction, status = None, "timeout"
+        except Exception as e:
+            prediction, status = None, f"error: {e}"
+        if prediction is not None:
+            results[name] = prediction
+        else:
+            statuses[name] = status
+
+    frames = []
+    for name, prediction in results.items():
+        if not include_history:
+            prediction = prediction.tail(periods)
+        frames.append(prediction.assign(**{group_column: name}))
+    columns = [group_column, *FORECAST_COLUMNS]
+    result = pandas.concat(frames, ignore_index=True)[columns] if frames else pandas.DataFrame(columns=columns)
+
+    seconds = time.perf_counter() - start
+    stats = {
+        "series": len(series),
+        "forecast": len(results),
+        "model": model,
+        "reused": reused,
+        "failed": {str(name): status for name, status in statuses.items()},
+        "seconds": round(seconds, 3),
+        "series_per_second": round(len(series) / seconds, 2) if seconds > 0 else None,
+    }
+    logger.info(
+        f"Batch forecast of {len(series)} series by {group_column!r}: {len(results)} forecast, "
+        f"{len(statuses)} failed, {seconds:.2f}s ({stats['series_per_second']} series/s)"
+    )
+    return result, stats
@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+from typing import List, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+
+from utils.tokens import count_tokens, truncate_text
+
+logger = logging.getLogger("kinaxis-agent")
+
+# Token budget for the conversation history sent to the LLM (system prompt not included)
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 6000))
+# Tool outputs from previous turns longer than this are elided to a short reference
+HISTORY_TOOL_OUTPUT_TOKENS = int(os.getenv("HISTORY_TOOL_OUTPUT_TOKENS", 200))
+# Characters of an elided tool output that are kept as a preview
+ELIDED_PREVIEW_CHARS = 300
+# Characters per question/answer kept in the summary of dropped turns
+SUMMARY_CHARS = 200
+# Dropped turns listed in the summary (older ones are only counted)
+SUMMARY_MAX_TURNS = 20
+
+
+def with_system_prompt(system_prompt: str, messages: List[BaseMessage]) -> List[BaseMessage]:
+    """
+    Build the LLM input: exactly one, up-to-date system block followed by the
+    conversation. The system prompt is never written into the checkpointed
+    message log; system messages persisted there by older versions are skipped.
+    """
+    return [SystemMessage(system_prompt)] + [
+        m for m in messages if not isinstance(m, SystemMessage)
+    ]
+
+
+def message_text(message: BaseMessage) -> str:
+    """Plain text of a message, whether its content is a string or a list of parts."""
+    content = message.content
+    if isinstance(content, str):
+        return content
+    return "\n".join(
+        part.get("text", "") if isinstance(part, dict) else str(part) for part in content
+    )
+
+
+def message_tokens(message: BaseMessage) -> int:
+    tokens = count_tokens(message_text(message))
+    for tc in getattr(message, "tool_calls", None) or []:
+        tokens += count_tokens(json.dumps(tc.get("args", {})))
+    return tokens
+
+
+class HistoryManager:
+    """
+    Compacts the checkpointed conversation before it is sent to the LLM.
+
+    - tool outputs from previous turns are elided to a short reference,
+    - the oldest turns are dropped (and summarized in one line each) until the
+      history fits in the token budget.
+
+    The current turn is never touched. The stored conversation isn't modified,
+    only the LLM input.
+    """
+
+    def __init__(
+        self,
+        token_budget: int = HISTORY_TOKEN_BUDGET,
+        tool_output_tokens: int = HISTORY_TOOL_OUTPUT_TOKENS,
+    ):
+        self.token_budget = token_budget
+        self.tool_output_tokens = tool_output_tokens
+        self.last_stats = {}
+        self.turn_tokens_saved = 0
+
+    def reset_turn(self):
+        self.turn_tokens_saved = 0
+
+    def compact(self, messages: List[BaseMessage]) -> Tuple[List[BaseMessage], str]:
+        """
+        Returns the compacted history and a summary of dropped turns (empty if
+        nothing was dropped) meant to be appended to the system prompt.
+        """
+        turns = _split_turns([m for m in messages if not isinstance(m, SystemMessage)])
+        tokens_before = sum(message_tokens(m) for turn in turns for m in turn)
+
+        elided = 0
+        for i, turn in enumerate(turns[:-1]):
+            compacted = []
+            for message in turn:
+                if isinstance(message, ToolMessage) and message_tokens(message) > self.tool_output_tokens:
+                    message = _elide_tool_output(message)
+                    elided += 1
+                compacted.append(message)
+            turns[i] = compacted
+
+        turn_tokens = [sum(message_tokens(m) for m in turn) for turn in turns]
+        dropped = []
+        while len(turns) > 1 and sum(turn_tokens) > self.token_budget:
+            dropped.append(turns.pop(0))
+            turn_tokens.pop(0)
+
+        summary = _summarize(dropped)
+        tokens_after = sum(turn_tokens) + count_tokens(summary)
+        self.last_stats = {
+            "tokens_before": tokens_before,
+            "tokens_after": tokens_after,
+            "tokens_saved": tokens_before - tokens_after,
+            "tool_outputs_elided": elided,
+            "turns_dropped": len(dropped),
+        }
+        self.turn_tokens_saved += self.last_stats["tokens_saved"]
+        if self.last_stats["tokens_saved"] > 0:
+            logger.info(f"History compacted: {self.last_stats}")
+        return [m for turn in turns for m in turn], summary
+
+
+def _split_turns(messages: List[BaseMessage]) -> List[List[BaseMessage]]:
+    turns = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _elide_tool_output(message: ToolMessage) -> ToolMessage:
+    text = message_text(message)
+    preview = truncate_text(text, ELIDED_PREVIEW_CHARS)
+    return message.model_copy(
+        update={
+            "content": f"{preview}\n[output elided: {message_tokens(message)} tokens, "
+            f"tool call {message.tool_call_id}; re-run the tool if you need it again]"
+        }
+    )
+
+
+def _summarize(dropped: List[List[BaseMessage]]) -> str:
+    if not dropped:
+        return ""
+    lines = ["\nSummary of earlier parts of this conversation (older messages were removed):"]
+    if len(dropped) > SUMMARY_MAX_TURNS:
+        lines.append(f"- ... {len(dropped) - SUMMARY_MAX_TURNS} earlier questions omitted")
+    for turn in dropped[-SUMMARY_MAX_TURNS:]:
+        question = message_text(turn[0]) if isinstance(turn[0], HumanMessage) else ""
+        answer = ""
+        for message in reversed(turn):
+            if isinstance(message, AIMessage) and not message.tool_calls:
+                answer = message_text(message)
+                break
+        lines.append(
+            f"- User: {truncate_text(question, SUMMARY_CHARS)} / "
+            f"Assistant: {truncate_text(answer, SUMMARY_CHARS)}"
+        )
+    return "\n".join(lines)
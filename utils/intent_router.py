@@ -0,0 +1,290 @@
+import logging
+import os
+import re
+import threading
+from collections import Counter, deque
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy
+import pandas
+
+from utils.prefetch import load_preview, load_row_counts, load_schema
+
+logger = logging.getLogger("kinaxis-agent")
+
+# Questions are only answered without the LLM when the router is on
+INTENT_ROUTER_ENABLED = os.getenv("INTENT_ROUTER_ENABLED", "1") == "1"
+# Rows shown when a question asks for rows without saying how many
+DEFAULT_ROWS = 10
+# Upper bound of rows returned by a routed answer
+MAX_ROWS = 500
+# Latencies kept for the percentiles in router_stats()
+LATENCY_WINDOW = 1000
+
+AGGREGATIONS = {
+    "sum": "sum", "total": "sum", "average": "mean", "avg": "mean", "mean": "mean",
+    "min": "min", "minimum": "min", "max": "max", "maximum": "max",
+}
+_CUBE_AGGREGATIONS = {"sum": "sum", "mean": "avg", "min": "min", "max": "max"}
+
+# Polite openings that don't change what is asked
+_FILLER = re.compile(
+    r"^(?:please\s+)?(?:(?:can|could|would)\s+you\s+(?:please\s+)?)?(?:(?:show|give|tell)\s+me\s+|what\s+(?:is|are)\s+|what's\s+)?"
+)
+_DATA = r"(?:the\s+)?(?:data|dataset|data\s+set|table|file|csv|dataframe)"
+_ROWS = r"(?:rows|records|lines|entries)"
+
+# (intent, pattern) in order of precedence; {col}/{col2}/{table} are replaced by the known names.
+# A pattern has to match the whole (normalized) question, so anything more specific goes to the LLM.
+CSV_GRAMMAR = [
+    ("head", rf"(?:show|display|print|list|preview|get)?\s*(?:the\s+)?(?:first|top)\s+(?P<n>\d+)?\s*{_ROWS}(?:\s+(?:of|in|from)\s+{_DATA})?"),
+    ("head", rf"(?:show|display|print|preview)\s+(?:the\s+|me\s+the\s+)?{_DATA}|head(?:\s+(?P<n>\d+))?|preview"),
+    ("tail", rf"(?:show|display|print|list|get)?\s*(?:the\s+)?(?:last|bottom)\s+(?P<n>\d+)?\s*{_ROWS}(?:\s+(?:of|in|from)\s+{_DATA})?|tail(?:\s+(?P<n__2>\d+))?"),
+    ("shape", rf"how\s+many\s+(?:{_ROWS}|columns)(?:\s+and\s+(?:{_ROWS}|columns))?(?:\s+(?:are\s+there|does\s+it\s+have|do\s+we\s+have))?(?:\s+(?:in|does)\s+{_DATA}(?:\s+have)?)?"),
+    ("shape", rf"(?:the\s+)?(?:shape|size|dimensions)(?:\s+of\s+{_DATA})?"),
+    ("columns", rf"(?:(?:what|which)\s+(?:are\s+)?(?:the\s+)?columns(?:\s+(?:are\s+there|do\s+we\s+have))?|(?:list|show|display)\s+(?:all\s+)?(?:the\s+)?columns|(?:the\s+)?(?:column\s+names|columns))(?:\s+(?:in|of)\s+{_DATA})?"),
+    ("describe", rf"(?:describe|summarize|summarise)(?:\s+{_DATA})?|(?:the\s+)?(?:summary\s+)?(?:statistics|stats)(?:\s+(?:of|for)\s+{_DATA})?"),
+    ("describe", r"(?:describe|summarize|summarise)\s+(?:the\s+)?(?:column\s+)?{col}|(?:the\s+)?(?:summary\s+)?(?:statistics|stats)\s+(?:of|for)\s+(?:the\s+)?(?:column\s+)?{col}"),
+    ("nunique", r"how\s+many\s+(?:unique|distinct|different)\s+{col}(?:\s+values)?(?:\s+(?:are\s+there|do\s+we\s+have))?"),
+    ("value_counts", rf"(?:the\s+)?(?:value\s+counts|counts?|frequenc(?:y|ies)|number\s+of\s+{_ROWS})\s+(?:of|for|per|by)\s+(?:each\s+)?{{col}}|how\s+many\s+{_ROWS}\s+(?:per|for\s+each|by|in\s+each)\s+{{col}}"),
+    ("aggregate", r"(?:the\s+)?(?P<agg>sum|total|average|avg|mean|min|minimum|max|maximum)\s+(?:of\s+)?(?:the\s+)?{col}(?:\s+(?:by|per|for\s+each|grouped\s+by|in\s+each)\s+(?:the\s+)?{col2})?"),
+]
+
+SQL_GRAMMAR = [
+    ("tables", r"(?:(?:what|which)\s+tables(?:\s+(?:are\s+there|do\s+we\s+have|exist))?|(?:list|show|display)\s+(?:all\s+)?(?:the\s+)?tables|tables)(?:\s+in\s+(?:the\s+)?(?:database|db))?"),
+    ("head", rf"(?:show|display|print|list|preview|get)?\s*(?:the\s+)?(?:(?:first|top)\s+(?P<n>\d+)?\s*{_ROWS}\s+(?:of|in|from)\s+(?:the\s+)?(?:table\s+)?{{table}}|(?:table\s+)?{{table}}(?:\s+table)?)|preview\s+(?:the\s+)?(?:table\s+)?{{table}}"),
+    ("count", rf"how\s+many\s+{_ROWS}\s+(?:are\s+)?(?:in|does)\s+(?:the\s+)?(?:table\s+)?{{table}}(?:\s+(?:table|have))?|(?:the\s+)?(?:row\s+count|number\s+of\s+{_ROWS})\s+(?:of|in)\s+(?:the\s+)?(?:table\s+)?{{table}}"),
+    ("columns", r"(?:(?:what|which)\s+(?:are\s+)?(?:the\s+)?columns\s+(?:are\s+)?(?:in|of|does)|(?:list|show|describe)\s+(?:the\s+)?(?:columns\s+(?:in|of)|schema\s+of)|(?:the\s+)?(?:columns|schema)\s+(?:of|in))\s+(?:the\s+)?(?:table\s+)?{table}(?:\s+(?:table|have))?|describe\s+(?:table\s+)?{table}"),
+]
+
+# Labeled questions the grammar must get right; router_stats() reports the accuracy on them
+EXAMPLES: List[Tuple[str, Optional[str]]] = [
+    ("show me the first 5 rows", "head"),
+    ("Show the data", "head"),
+    ("last 20 rows of the dataset", "tail"),
+    ("how many rows are there?", "shape"),
+    ("How many rows and columns does the data have?", "shape"),
+    ("what are the columns", "columns"),
+    ("describe the dataset", "describe"),
+    ("how many unique factory values are there", "nunique"),
+    ("value counts of factory", "value_counts"),
+    ("how many rows per factory", "value_counts"),
+    ("total qty by factory", "aggregate"),
+    ("what is the average qty per factory?", "aggregate"),
+    ("sum of qty", "aggregate"),
+    ("show a bar chart of qty by factory", None),
+    ("show the rows where qty is above 10", None),
+    ("which factory has the highest qty", None),
+    ("forecast qty for the next month", None),
+    ("why did qty drop in march", None),
+    ("show the top 5 factories by qty", None),
+]
+EXAMPLE_COLUMNS = ["factory", "qty", "date"]
+
+
+class Intent:
+    """A question the router can answer itself: its kind and the parsed arguments"""
+
+    def __init__(self, name: str, params: Dict[str, Any]):
+        self.name = name
+        self.params = params
+
+    def __repr__(self):
+        return f"Intent({self.name!r}, {self.params!r})"
+
+
+def normalize(question: str) -> str:
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    question = question.rstrip("?.! ")
+    return _FILLER.sub("", question, count=1).strip()
+
+
+def _names_pattern(names: Sequence[str], group: str) -> str:
+    # Longest names first so "order date" wins over "order"; names may be quoted
+    alternatives = "|".join(re.escape(str(n).lower()) for n in sorted(names, key=lambda n: -len(str(n))))
+    return rf"[\"'`\[]?(?P<{group}>{alternatives})[\"'`\]]?"
+
+
+@lru_cache(maxsize=32)
+def _compile(grammar: str, names: Tuple[str, ...]):
+    placeholder = "col" if grammar == "csv" else "table"
+    compiled = []
+    for name, pattern in (CSV_GRAMMAR if grammar == "csv" else SQL_GRAMMAR):
+        if "{" in pattern:
+            if not names:
+                continue
+            # A name can appear in several alternatives of a pattern; each gets its own group ("table__1")
+            occurrences = Counter()
+
+            def group(match):
+                key = match.group(1)
+                occurrences[key] += 1
+                suffix = f"__{occurrences[key]}" if occurrences[key] > 1 else ""
+                return _names_pattern(names, key + suffix)
+
+            pattern = re.sub(r"\{(" + placeholder + r"|col2)\}", group, pattern)
+        compiled.append((name, re.compile(rf"(?:{pattern})")))
+    return compiled
+
+
+def _match(grammar: str, question: str, names: Sequence[str]) -> Optional[Intent]:
+    text = normalize(question)
+    lookup = {str(n).lower(): n for n in names}
+    for name, pattern in _compile(grammar, tuple(lookup)):
+        match = pattern.fullmatch(text)
+        if match is None:
+            continue
+        params = dict()
+        for key, value in match.groupdict().items():
+            if value is not None:
+                params[key.split("__")[0]] = lookup.get(value, value)
+        if "n" in params:
+            params["n"] = min(int(params["n"]), MAX_ROWS)
+        return Intent(name, params)
+    return None
+
+
+def route_csv(question: str, columns: Sequence[str]) -> Optional[Intent]:
+    """The intent of a question about an uploaded dataset, None if the LLM should answer it"""
+    if not INTENT_ROUTER_ENABLED:
+        return None
+    return _match("csv", question, [str(c) for c in columns])
+
+
+def route_sql(question: str, tables: Sequence[str]) -> Optional[Intent]:
+    """The intent of a question about the connected database, None if the LLM should answer it"""
+    if not INTENT_ROUTER_ENABLED:
+        return None
+    return _match("sql", question, list(tables or []))
+
+
+def answer_csv(intent: Intent, df: pandas.DataFrame, cubes=None) -> Optional[Tuple[str, Optional[pandas.DataFrame]]]:
+    """
+    Answer text and an optional result table for a routed question, computed
+    with vectorized pandas (or the precomputed cubes). None if the intent
+    doesn't apply to this data after all (e.g. the sum of a text column).
+    """
+    p = intent.params
+    if intent.name in ("head", "tail"):
+        n = min(p.get("n", DEFAULT_ROWS), len(df))
+        rows = df.head(n) if intent.name == "head" else df.tail(n)
+        return f"Here are the {'first' if intent.name == 'head' else 'last'} {n} rows of the data:", rows
+    if intent.name == "shape":
+        return f"The data has {len(df):,} rows and {len(df.columns)} columns.", None
+    if intent.name == "columns":
+        table = pandas.DataFrame({"column": [str(c) for c in df.columns], "type": [str(t) for t in df.dtypes]})
+        return f"The data has {len(df.columns)} columns:", table
+    if intent.name == "describe":
+        data = df[[p["col"]]] if "col" in p else df
+        table = data.describe(include="all").T.reset_index(names="column")
+        return "Summary statistics:", table
+    if intent.name == "nunique":
+        return f"There are {df[p['col']].nunique():,} distinct values of {p['col']}.", None
+    if intent.name == "value_counts":
+        counts = df[p["col"]].value_counts(dropna=False)
+        table = counts.head(MAX_ROWS).rename_axis(p["col"]).reset_index(name="count")
+        note = f" (top {MAX_ROWS} of {len(counts)})" if len(counts) > MAX_ROWS else ""
+        return f"Number of rows per {p['col']}{note}:", table
+    if intent.name == "aggregate":
+        measure, agg = p["col"], AGGREGATIONS[p["agg"]]
+        if not pandas.api.types.is_numeric_dtype(df[measure]):
+            return None
+        if "col2" not in p:
+            value = getattr(df[measure], agg)()
+            return f"The {p['agg']} of {measure} is {_format(value)}.", None
+        by = p["col2"]
+        table = cubes.lookup([str(by)], str(measure), _CUBE_AGGREGATIONS[agg]) if cubes is not None else None
+        if table is None:
+            table = df.groupby(by, dropna=False)[measure].agg(agg).reset_index()
+        note = f" (first {MAX_ROWS} of {len(table)} groups)" if len(table) > MAX_ROWS else ""
+        return f"The {p['agg']} of {measure} by {by}{note}:", table.head(MAX_ROWS)
+    return None
+
+
+def answer_sql(intent: Intent, mcp_client, cache, tables: Sequence[str]) -> Optional[Tuple[str, Optional[pandas.DataFrame]]]:
+    """
+    Answer a routed database question from the connection caches or with a
+    templated query. None if it can't be answered that way (the LLM takes over).
+    """
+    p = intent.params
+    if intent.name == "tables":
+        return f"The database has {len(tables)} tables:", pandas.DataFrame({"table": list(tables)})
+    table = p.get("table")
+    if intent.name == "head":
+        n = p.get("n", DEFAULT_ROWS)
+        if n <= DEFAULT_ROWS:
+            rows, error = load_preview(mcp_client, cache, table)
+            rows = rows.head(n) if rows is not None else None
+        else:
+            rows, error = mcp_client.execute_query(f"SELECT TOP {int(n)} * FROM [{table}]")
+        if error or not isinstance(rows, pandas.DataFrame):
+            return None
+        return f"Here are the first {len(rows)} rows of {table}:", rows
+    if intent.name == "count":
+        counts = load_row_counts(mcp_client, cache)
+        if table in counts:
+            return f"{table} has {counts[table]:,} rows.", None
+        result, error = mcp_client.execute_query(f"SELECT COUNT_BIG(*) AS total_rows FROM [{table}]")
+        if error or not isinstance(result, pandas.DataFrame) or result.empty:
+            return None
+        return f"{table} has {int(result.iloc[0, 0]):,} rows.", None
+    if intent.name == "columns":
+        schema, error = load_schema(mcp_client, cache, table)
+        if error or schema is None:
+            return None
+        return f"Columns of {table}:", schema
+    return None
+
+
+def _format(value) -> str:
+    if isinstance(value, (float, numpy.floating)):
+        return f"{value:,.4f}".rstrip("0").rstrip(".")
+    if isinstance(value, (int, numpy.integer)):
+        return f"{value:,}"
+    return str(value)
+
+
+_stats_lock = threading.Lock()
+_routed: Counter = Counter()
+_fallbacks = 0
+_latencies: deque = deque(maxlen=LATENCY_WINDOW)
+
+
+def record(intent: Optional[Intent], seconds: float):
+    """Count a routing decision; `seconds` is the latency of a routed answer"""
+    global _fallbacks
+    with _stats_lock:
+        if intent is None:
+            _fallbacks += 1
+        else:
+            _routed[intent.name] += 1
+            _latencies.append(seconds)
+
+
+def evaluate(examples: Sequence[Tuple[str, Optional[str]]] = EXAMPLES, columns: Sequence[str] = EXAMPLE_COLUMNS) -> float:
+    """Share of labeled questions routed to the expected intent (None: left to the LLM)"""
+    hits = 0
+    for question, expected in examples:
+        intent = route_csv(question, columns)
+        hits += (intent.name if intent else None) == expected
+    return hits / len(examples) if examples else 1.0
+
+
+def router_stats() -> Dict[str, Any]:
+    with _stats_lock:
+        routed = dict(_routed)
+        fallbacks = _fallbacks
+        latencies = numpy.array(_latencies) * 1000
+    total = sum(routed.values()) + fallbacks
+    return {
+        "routed": routed,
+        "fallbacks": fallbacks,
+        "routed_share": round(sum(routed.values()) / total, 4) if total else None,
+        "latency_ms": {
+            "p50": round(float(numpy.percentile(latencies, 50)), 3),
+            "p95": round(float(numpy.percentile(latencies, 95)), 3),
+            "max": round(float(latencies.max()), 3),
+        } if len(latencies) else None,
+        "accuracy_on_examples": evaluate(),
+    }
@@ -0,0 +1,164 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from utils.tracing import llm_usage
+
+logger = logging.getLogger("kinaxis-agent")
+
+# Sessions whose usage is kept (least recently active ones are dropped first)
+USAGE_MAX_SESSIONS = int(os.getenv("USAGE_MAX_SESSIONS", 1000))
+# Last turns kept per session for /llm_usage, to spot the question shapes that cost the most
+USAGE_RECENT_TURNS = int(os.getenv("USAGE_RECENT_TURNS", 50))
+# Characters of the question kept with each recent turn
+USAGE_QUESTION_CHARS = 120
+
+
+def _empty() -> Dict[str, Any]:
+    return {"turns": 0, "calls": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_s": 0.0}
+
+
+def _add(totals: Dict[str, Any], usage: Dict[str, Any]):
+    totals["turns"] += 1
+    for key in ("calls", "errors", "prompt_tokens", "completion_tokens", "latency_s"):
+        totals[key] += usage[key]
+
+
+def _summary(totals: Dict[str, Any]) -> Dict[str, Any]:
+    turns = totals["turns"] or 1
+    return {
+        **totals,
+        "latency_s": round(totals["latency_s"], 3),
+        "total_tokens": totals["prompt_tokens"] + totals["completion_tokens"],
+        "prompt_tokens_per_turn": round(totals["prompt_tokens"] / turns, 1),
+        "calls_per_turn": round(totals["calls"] / turns, 2),
+    }
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """
+    Counts the LLM calls of one agent turn: prompt and completion tokens from
+    each AzureChatOpenAI response and the time spent waiting for the model.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started: Dict[UUID, float] = dict()
+        self.calls = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency = 0.0
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        with self._lock:
+            self._started[run_id] = time.perf_counter()
+
+    def _finish(self, run_id: UUID):
+        started = self._started.pop(run_id, None)
+        self.calls += 1
+        if started is not None:
+            self.latency += time.perf_counter() - started
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        usage = llm_usage(response)
+        with self._lock:
+            self._finish(run_id)
+            self.prompt_tokens += usage.get("tokens.input", 0)
+            self.completion_tokens += usage.get("tokens.output", 0)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            self._finish(run_id)
+            self.errors += 1
+
+    def usage(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "latency_s": round(self.latency, 3),
+            }
+
+
+class _Ledger:
+    """
+    Usage of finished turns: anonymous totals over all sessions and per agent,
+    and per session its own totals, datasets and recent turns (which hold
+    question text and connection names, so they are only shown to that session)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = _empty()
+        self.agents: Dict[str, Dict[str, Any]] = dict()
+        self.sessions: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+
+    def _session(self, session_id: str) -> Dict[str, Any]:
+        if session_id in self.sessions:
+            self.sessions.move_to_end(session_id)
+        else:
+            self.sessions[session_id] = {
+                "totals": _empty(),
+                "datasets": dict(),
+                "recent": deque(maxlen=USAGE_RECENT_TURNS),
+            }
+            if len(self.sessions) > USAGE_MAX_SESSIONS:
+                self.sessions.popitem(last=False)
+        return self.sessions[session_id]
+
+    def record(self, usage: Dict[str, Any], agent: str, dataset: str, session_id: str, question: str):
+        turn = {
+            "time": time.time(),
+            "agent": agent,
+            "dataset": dataset,
+            "question": question[:USAGE_QUESTION_CHARS],
+            "question_chars": len(question),
+            **usage,
+        }
+        with self._lock:
+            _add(self.totals, usage)
+            _add(self.agents.setdefault(agent, _empty()), usage)
+            own = self._session(session_id)
+            _add(own["totals"], usage)
+            _add(own["datasets"].setdefault(dataset, _empty()), usage)
+            own["recent"].append(turn)
+        return turn
+
+    def stats(self, session_id: Optional[str] = None) -> Dict[str, Any]:
+        with self._lock:
+            own = self.sessions.get(session_id) if session_id else None
+            return {
+                "totals": _summary(self.totals),
+                "agents": {name: _summary(totals) for name, totals in self.agents.items()},
+                "sessions": len(self.sessions),
+                "session": _summary(own["totals"] if own else _empty()),
+                "datasets": {name: _summary(totals) for name, totals in own["datasets"].items()} if own else {},
+                "recent_turns": list(own["recent"]) if own else [],
+            }
+
+
+_ledger = _Ledger()
+
+
+def record_turn(handler: UsageCallbackHandler, agent: str, dataset: str, session_id: str, question: str):
+    """Add the usage of a finished turn to the ledger and log it"""
+    turn = _ledger.record(handler.usage(), agent, dataset, session_id, question)
+    logger.info(
+        f"LLM usage ({agent}, {dataset}): {turn['calls']} calls, {turn['prompt_tokens']} prompt + "
+        f"{turn['completion_tokens']} completion tokens, {turn['latency_s']}s in the model"
+    )
+    return turn
+
+
+def usage_stats(session_id: Optional[str] = None) -> Dict[str, Any]:
+    """Token usage totals overall and per agent, plus the given session's totals, datasets and recent turns"""
+    return _ledger.stats(session_id)
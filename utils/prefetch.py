@@ -0,0 +1,178 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import pandas
+
+from utils.connection_cache import ConnectionCache
+
+logger = logging.getLogger("kinaxis-sql-agent")
+
+# Number of tables whose schema and preview are warmed after connecting
+PREFETCH_TABLES = int(os.getenv("PREFETCH_TABLES", 8))
+# Concurrent MCP requests made by one prefetcher
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", 2))
+# Comma separated name fragments of tables users usually look at first
+PREFETCH_TABLE_HINTS = [
+    hint.strip() for hint in os.getenv("PREFETCH_TABLE_HINTS", "").split(",") if hint.strip()
+]
+PREVIEW_ROWS = 10
+
+ROW_COUNTS_QUERY = """
+SELECT t.name AS table_name, SUM(p.rows) AS row_count
+FROM sys.tables t
+JOIN sys.partitions p ON p.object_id = t.object_id AND p.index_id IN (0, 1)
+GROUP BY t.name
+"""
+
+
+def load_schema(mcp_client, cache: ConnectionCache, table: str) -> Tuple[Optional[pandas.DataFrame], Optional[str]]:
+    """Return the (cached) schema DataFrame for a table and an error, if any"""
+    schema_df = cache.schemas.get(table)
+    if schema_df is None:
+        schema_df, error = mcp_client.get_table_schema(table)
+        if error:
+            return None, error
+        cache.set_schema(table, schema_df)
+    return schema_df, None
+
+
+def load_preview(mcp_client, cache: ConnectionCache, table: str) -> Tuple[Optional[pandas.DataFrame], Optional[str]]:
+    """Return the (cached) first rows of a table and an error, if any"""
+    preview_df = cache.get_preview(table)
+    if preview_df is None:
+        result, error = mcp_client.execute_query(f"SELECT TOP {PREVIEW_ROWS} * FROM [{table}]")
+        if error:
+            return None, error
+        if not isinstance(result, pandas.DataFrame):
+            # execute_query reports failures as a message in place of the result
+            return None, str(result)
+        preview_df = result
+        cache.set_preview(table, preview_df)
+    return preview_df, None
+
+
+async def aload_preview(mcp_client, cache: ConnectionCache, table: str) -> Tuple[Optional[pandas.DataFrame], Optional[str]]:
+    """Async version of load_preview (ASGI serving mode)"""
+    preview_df = cache.get_preview(table)
+    if preview_df is None:
+        result, error = await mcp_client.aexecute_query(f"SELECT TOP {PREVIEW_ROWS} * FROM [{table}]")
+        if error:
+            return None, error
+        if not isinstance(result, pandas.DataFrame):
+            return None, str(result)
+        preview_df = result
+        cache.set_preview(table, preview_df)
+    return preview_df, None
+
+
+def load_row_counts(mcp_client, cache: ConnectionCache) -> Dict[str, int]:
+    """Row count per table, read once per connection from sys.partitions (empty if unavailable)"""
+    if cache.row_counts is None:
+        result, error = mcp_client.execute_query(ROW_COUNTS_QUERY)
+        if error or not isinstance(result, pandas.DataFrame) or result.empty:
+            logger.info("Row counts unavailable")
+            return dict()
+        counts = pandas.to_numeric(result["row_count"], errors="coerce").fillna(0).astype(int)
+        cache.row_counts = dict(zip(result["table_name"], counts))
+    return cache.row_counts
+
+
+class TablePrefetcher:
+    """
+    Warms the schema and preview caches of the tables a user is most likely to
+    open right after connecting: the most used ones first, then the ones
+    matching PREFETCH_TABLE_HINTS, then the largest ones.
+
+    Runs in the background with bounded concurrency; cancel() stops it before
+    the next table is fetched.
+    """
+
+    def __init__(self, mcp_client, cache: ConnectionCache, tables: List[str]):
+        self.mcp_client = mcp_client
+        self.cache = cache
+        self.tables = list(tables)
+        self._cancelled = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=PREFETCH_CONCURRENCY, thread_name_prefix="prefetch")
+
+    def start(self):
+        threading.Thread(target=self._run, name="prefetch-planner", daemon=True).start()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            tables = self.pick_tables()
+        except Exception as e:
+            logger.warning(f"Prefetch: could not choose tables: {e}")
+            return
+        logger.info(f"Prefetching {len(tables)} tables: {tables}")
+        try:
+            warmed = sum(self._executor.map(self._warm, tables))
+        except (CancelledError, RuntimeError):
+            # Executor was shut down by cancel()
+            logger.info("Prefetch cancelled")
+            return
+        self._executor.shutdown(wait=False)
+        logger.info(f"Prefetch done: {warmed}/{len(tables)} tables warm in {time.perf_counter() - start:.2f}s")
+
+    def pick_tables(self) -> List[str]:
+        usage = self.cache.usage
+        hints = [hint.lower() for hint in PREFETCH_TABLE_HINTS]
+        row_counts = self._row_counts()
+
+        def score(table):
+            name = table.lower()
+            return (
+                usage.get(table, 0),
+                any(hint in name for hint in hints),
+                row_counts.get(table, 0),
+            )
+
+        return sorted(self.tables, key=score, reverse=True)[:PREFETCH_TABLES]
+
+    def _row_counts(self) -> Dict[str, int]:
+        if self.cancelled:
+            return dict()
+        return load_row_counts(self.mcp_client, self.cache)
+
+    def _warm(self, table: str) -> bool:
+        try:
+            if self.cancelled:
+                return False
+            _, schema_error = load_schema(self.mcp_client, self.cache, table)
+            if self.cancelled:
+                return False
+            _, preview_error = load_preview(self.mcp_client, self.cache, table)
+            if schema_error or preview_error:
+                logger.info(f"Prefetch of {table} incomplete: {schema_error or preview_error}")
+                return False
+            return True
+        except Exception as e:
+            logger.warning(f"Prefetch of {table} failed: {e}")
+            return False
+
+
+def start_prefetch(mcp_client, cache: ConnectionCache, tables: List[str]) -> TablePrefetcher:
+    """Start warming caches for a new connection, replacing any running prefetcher"""
+    cancel_prefetch(cache)
+    prefetcher = TablePrefetcher(mcp_client, cache, tables)
+    cache.prefetcher = prefetcher
+    prefetcher.start()
+    return prefetcher
+
+
+def cancel_prefetch(cache: ConnectionCache):
+    if cache.prefetcher is not None:
+        cache.prefetcher.cancel()
+        cache.prefetcher = None
@@ -0,0 +1,245 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Sequence, Tuple
+
+import joblib
+import numpy
+import pandas
+from sklearn.linear_model import LinearRegression
+from sklearn.model_selection import KFold, cross_validate
+
+from utils.datasets import dataset_version, looks_like_dates
+
+logger = logging.getLogger("kinaxis-agent")
+
+# Where fitted models are persisted (one file per dataset version, target and feature set)
+REGRESSION_MODEL_DIR = os.getenv("REGRESSION_MODEL_DIR", "models")
+# Folds of the cross-validation
+REGRESSION_FOLDS = int(os.getenv("REGRESSION_FOLDS", 5))
+# Processes running the folds (joblib n_jobs; -1 is one per CPU)
+REGRESSION_N_JOBS = int(os.getenv("REGRESSION_N_JOBS", -1))
+# Text columns keep their most frequent levels as one-hot columns; the rest share an "other" column
+MAX_CATEGORIES = int(os.getenv("REGRESSION_MAX_CATEGORIES", 50))
+# How many datasets' feature matrices and fitted models are kept in memory
+FEATURE_CACHE_SIZE = 8
+MODEL_CACHE_SIZE = 32
+OTHER_LEVEL = "__other__"
+
+
+class FeatureMatrix:
+    """
+    Numeric encoding of a dataset's columns for regression, computed once per
+    column and dataset version: numbers with missing values filled by the
+    median, dates as days since the epoch, text and categoricals one-hot
+    encoded over their most frequent levels. Any feature set is a horizontal
+    stack of the encoded columns, no refitting of encoders needed.
+    """
+
+    def __init__(self, df: pandas.DataFrame, version: str):
+        self.df = df
+        self.version = version
+        self._lock = threading.Lock()
+        # column -> (encoded block, feature names, encoder state for new rows)
+        self._blocks: Dict[str, Tuple[numpy.ndarray, List[str], Dict[str, Any]]] = dict()
+
+    def _encode(self, column: str):
+        with self._lock:
+            block = self._blocks.get(column)
+        if block is not None:
+            return block
+        if column not in self.df.columns:
+            raise ValueError(f"Column '{column}' does not exist in the dataframe.")
+        series = self.df[column]
+        if pandas.api.types.is_bool_dtype(series) or (
+            pandas.api.types.is_numeric_dtype(series) and not isinstance(series.dtype, pandas.CategoricalDtype)
+        ):
+            values = series.astype(float)
+            state = {"kind": "numeric", "fill": float(values.median()) if values.notna().any() else 0.0}
+        elif pandas.api.types.is_datetime64_any_dtype(series) or (
+            series.dtype == object and looks_like_dates(series)
+        ):
+            values = _days(series)
+            state = {"kind": "datetime", "fill": float(values.median()) if values.notna().any() else 0.0}
+        else:
+            levels = series.astype(str).value_counts().index[:MAX_CATEGORIES].tolist()
+            state = {"kind": "categorical", "levels": levels}
+        block, names = _apply(series, column, state)
+        with self._lock:
+            self._blocks[column] = (block, names, state)
+        return block, names, state
+
+    def matrix(self, columns: Sequence[str]) -> Tuple[numpy.ndarray, List[str]]:
+        """Feature matrix of the given columns and the names of its columns"""
+        blocks, names = [], []
+        for column in columns:
+            block, block_names, _ = self._encode(column)
+            blocks.append(block)
+            names.extend(block_names)
+        return numpy.hstack(blocks), names
+
+    def encoders(self, columns: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+        """Encoder state (levels, fill values) of the given columns, to encode new rows the same way"""
+        return {column: self._encode(column)[2] for column in columns}
+
+
+def _days(series: pandas.Series) -> pandas.Series:
+    dates = series if pandas.api.types.is_datetime64_any_dtype(series) else pandas.to_datetime(
+        series, errors="coerce", format="mixed"
+    )
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_localize(None)
+    return (dates - pandas.Timestamp(0)) / pandas.Timedelta(days=1)
+
+
+def _apply(series: pandas.Series, column: str, state: Dict[str, Any]) -> Tuple[numpy.ndarray, List[str]]:
+    if state["kind"] == "numeric":
+        values = pandas.to_numeric(series, errors="coerce").astype(float).fillna(state["fill"])
+        return values.to_numpy().reshape(-1, 1), [column]
+    if state["kind"] == "datetime":
+        return _days(series).fillna(state["fill"]).to_numpy().reshape(-1, 1), [column]
+    levels = state["levels"]
+    codes = pandas.Categorical(series.astype(str), categories=levels).codes
+    # One column per level plus "other"; codes of -1 (unseen or rare levels) go to "other"
+    block = numpy.zeros((len(series), len(levels) + 1))
+    block[numpy.arange(len(series)), numpy.where(codes < 0, len(levels), codes)] = 1.0
+    return block, [f"{column}={level}" for level in levels] + [f"{column}={OTHER_LEVEL}"]
+
+
+class RegressionModel:
+    """
+    A linear regression fitted on a feature set of one dataset version, with
+    its CV scores and the encoders of its features (saved together).
+    """
+
+    def __init__(
+        self,
+        model: LinearRegression,
+        features: List[str],
+        target: str,
+        encoders: Dict[str, Dict[str, Any]],
+        summary: Dict[str, Any],
+    ):
+        self.model = model
+        self.features = features
+        self.target = target
+        self.encoders = encoders
+        self.summary = summary
+
+    def predict(self, rows: pandas.DataFrame) -> numpy.ndarray:
+        """Predictions for new rows, encoded exactly like the training data"""
+        blocks = []
+        for column in self.features:
+            if column not in rows.columns:
+                raise ValueError(f"Column '{column}' is missing from the rows to predict.")
+            blocks.append(_apply(rows[column], column, self.encoders[column])[0])
+        return self.model.predict(numpy.hstack(blocks))
+
+
+def model_id(version: str, features: Sequence[str], target: str) -> str:
+    key = repr((version, list(features), target, REGRESSION_FOLDS, MAX_CATEGORIES))
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def _fit(matrix: FeatureMatrix, features: List[str], target: str) -> RegressionModel:
+    start = time.perf_counter()
+    if target in features:
+        raise ValueError("The target column can't also be a feature.")
+    if target not in matrix.df.columns:
+        raise ValueError(f"Column '{target}' does not exist in the dataframe.")
+    y = pandas.to_numeric(matrix.df[target], errors="coerce").to_numpy(dtype=float)
+    X, names = matrix.matrix(features)
+    known = ~numpy.isnan(y)
+    X, y = X[known], y[known]
+    folds = min(REGRESSION_FOLDS, len(y))
+    if folds < 2:
+        raise ValueError("Not enough rows with a numeric target to fit a regression.")
+
+    # Folds are fitted in parallel by joblib (same estimator, different training rows)
+    scores = cross_validate(
+        LinearRegression(),
+        X,
+        y,
+        cv=KFold(n_splits=folds, shuffle=True, random_state=42),
+        scoring=("neg_mean_squared_error", "r2"),
+        n_jobs=min(folds, REGRESSION_N_JOBS) if REGRESSION_N_JOBS > 0 else REGRESSION_N_JOBS,
+    )
+    model = LinearRegression().fit(X, y)
+    mse = -scores["test_neg_mean_squared_error"]
+    summary = {
+        "target": target,
+        "features": features,
+        "n_rows": int(len(y)),
+        "folds": folds,
+        "mse": float(mse.mean()),
+        "mse_std": float(mse.std()),
+        "r2": float(numpy.nanmean(scores["test_r2"])),
+        "intercept": float(model.intercept_),
+        "coefficients": dict(zip(names, map(float, model.coef_))),
+    }
+    logger.info(
+        f"Fitted regression of {target} on {features} ({len(y)} rows, {folds}-fold CV, "
+        f"MSE {summary['mse']:.4g}, R2 {summary['r2']:.3f}) in {time.perf_counter() - start:.2f}s"
+    )
+    return RegressionModel(model, features, target, matrix.encoders(features), summary)
+
+
+_matrix_cache: "OrderedDict[str, FeatureMatrix]" = OrderedDict()
+_model_cache: "OrderedDict[str, RegressionModel]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def get_feature_matrix(df: pandas.DataFrame, version: str | None = None) -> FeatureMatrix:
+    """Return the feature matrix of this dataset version, creating it once."""
+    version = version or dataset_version(df)
+    with _cache_lock:
+        matrix = _matrix_cache.get(version)
+        if matrix is not None:
+            _matrix_cache.move_to_end(version)
+            return matrix
+        matrix = _matrix_cache[version] = FeatureMatrix(df, version)
+        while len(_matrix_cache) > FEATURE_CACHE_SIZE:
+            _matrix_cache.popitem(last=False)
+    return matrix
+
+
+def get_regression(
+    df: pandas.DataFrame, features: Sequence[str], target: str, version: str | None = None
+) -> RegressionModel:
+    """
+    The regression of `target` on `features`, fitted and cross-validated once
+    per dataset version and feature set: from memory, else from its file in
+    REGRESSION_MODEL_DIR, else fitted now and saved. Raises ValueError for
+    unknown columns or too little data.
+    """
+    matrix = get_feature_matrix(df, version)
+    features = list(features)
+    key = model_id(matrix.version, features, target)
+    with _cache_lock:
+        model = _model_cache.get(key)
+        if model is not None:
+            _model_cache.move_to_end(key)
+            return model
+
+    path = os.path.join(REGRESSION_MODEL_DIR, f"{key}.joblib")
+    model = None
+    if os.path.exists(path):
+        try:
+            model = joblib.load(path)
+        except Exception as e:
+            logger.info(f"Couldn't load regression model {path}: {e}")
+    if model is None:
+        model = _fit(matrix, features, target)
+        os.makedirs(REGRESSION_MODEL_DIR, exist_ok=True)
+        # Written under a temporary name so a concurrent request never loads a half-written file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        joblib.dump(model, tmp_path)
+        os.replace(tmp_path, path)
+    with _cache_lock:
+        _model_cache[key] = model
+        while len(_model_cache) > MODEL_CACHE_SIZE:
+            _model_cache.popitem(last=False)
+    return model
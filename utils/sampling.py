@@ -0,0 +1,173 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy
+import pandas
+
+from utils.datasets import dataset_version
+
+logger = logging.getLogger("kinaxis-agent")
+
+# Datasets with fewer rows are always answered exactly
+APPROX_MIN_ROWS = int(os.getenv("APPROX_MIN_ROWS", 200000))
+# Target size of the sample kept per dataset
+APPROX_SAMPLE_ROWS = int(os.getenv("APPROX_SAMPLE_ROWS", 50000))
+# Every stratum keeps at least this many rows (or all of them), so small groups still get estimates
+APPROX_MIN_PER_STRATUM = int(os.getenv("APPROX_MIN_PER_STRATUM", 200))
+# Columns with more distinct values than this aren't used as strata
+APPROX_MAX_STRATA = 50
+# z-score of the reported confidence intervals (95%)
+CONFIDENCE_Z = 1.96
+SAMPLE_CACHE_SIZE = 8
+
+WEIGHT_COLUMN = "_weight"
+STRATUM_COLUMN = "_stratum"
+
+
+class DatasetSample:
+    """
+    Stratified random sample of a large dataset, built once per dataset
+    version. Rows carry their sampling weight (rows represented in the full
+    dataset), so counts and sums scale up, and `estimate` reports totals and
+    means with confidence intervals.
+    """
+
+    def __init__(self, frame: pandas.DataFrame, version: str, n_population: int, strata: pandas.DataFrame, stratified_by):
+        self.frame = frame
+        self.version = version
+        self.n_population = n_population
+        # per stratum: population size N and sample size n
+        self.strata = strata
+        self.stratified_by = stratified_by
+
+    @classmethod
+    def from_dataframe(cls, df: pandas.DataFrame, version: str, seed: int = 0) -> "DatasetSample":
+        start = time.perf_counter()
+        column = _stratum_column(df)
+        if column is None:
+            stratum = pandas.Series(0, index=df.index)
+        else:
+            stratum = df[column].astype("category").cat.codes
+        population = stratum.value_counts()
+
+        # Proportional allocation with a floor per stratum; Bernoulli draws keep it vectorized
+        fraction = APPROX_SAMPLE_ROWS / len(df)
+        wanted = numpy.maximum((population * fraction).round(), numpy.minimum(population, APPROX_MIN_PER_STRATUM))
+        probability = (wanted / population).clip(upper=1.0)
+        rng = numpy.random.default_rng(seed)
+        keep = rng.random(len(df)) < stratum.map(probability).to_numpy()
+
+        frame = df[keep].copy()
+        frame_strata = stratum[keep]
+        sampled = frame_strata.value_counts()
+        strata = pandas.DataFrame({"N": population, "n": sampled}).fillna(0)
+        frame[STRATUM_COLUMN] = frame_strata.to_numpy()
+        frame[WEIGHT_COLUMN] = frame_strata.map(strata["N"] / strata["n"]).to_numpy()
+        logger.info(
+            f"Sampled {len(frame)} of {len(df)} rows of dataset {version} "
+            f"(stratified by {column!r}) in {time.perf_counter() - start:.2f}s"
+        )
+        return cls(frame, f"{version}-sample", len(df), strata[strata["n"] > 0], column)
+
+    def estimate(self, column: Optional[str] = None, agg: str = "mean", by: Optional[List[str] | str] = None) -> pandas.DataFrame:
+        """
+        Estimate of the full-dataset `agg` ("count", "sum" or "mean") of
+        `column` (not needed for "count"), optionally per group of `by`, with a
+        95% confidence interval.
+        """
+        agg = agg.lower()
+        if agg not in ("count", "sum", "mean"):
+            raise ValueError("agg must be one of count, sum, mean")
+        frame = self.frame
+        if agg == "count":
+            y = pandas.Series(1.0, index=frame.index)
+        else:
+            y = frame[column].astype(float)
+        valid = y.notna()
+        by = [by] if isinstance(by, str) else list(by or [])
+        keys = [frame.loc[valid, STRATUM_COLUMN]] + [frame.loc[valid, b] for b in by]
+        y = y[valid]
+
+        cells = pandas.DataFrame({"y": y, "y2": y * y, "x": 1.0}).groupby(keys, observed=True).sum()
+        cells = cells.join(self.strata, on=STRATUM_COLUMN)
+        # Variance factor of a stratified total: N_h^2 (1 - f_h) / n_h, divided by (n_h - 1) for s^2
+        n = cells["n"]
+        factor = cells["N"] ** 2 * (1 - n / cells["N"]) / n / (n - 1).clip(lower=1)
+        weight = cells["N"] / n
+        group_levels = list(range(1, len(keys))) if by else None
+
+        def total(values):
+            return values.groupby(level=group_levels).sum() if by else pandas.Series([values.sum()])
+
+        if agg == "mean":
+            t_y = total(cells["y"] * weight)
+            t_x = total(cells["x"] * weight)
+            ratio = t_y / t_x
+            r = ratio.reindex(cells.index.droplevel(0)).to_numpy() if by else ratio.iloc[0]
+            # Linearized residuals e = y - R for the ratio estimator
+            sum_e = cells["y"] - r * cells["x"]
+            sum_e2 = cells["y2"] - 2 * r * cells["y"] + r * r * cells["x"]
+            variance = total(factor * (sum_e2 - sum_e ** 2 / n)) / t_x ** 2
+            value = ratio
+        else:
+            value = total(cells["y"] * weight)
+            variance = total(factor * (cells["y2"] - cells["y"] ** 2 / n))
+
+        margin = CONFIDENCE_Z * numpy.sqrt(variance.clip(lower=0))
+        result = pandas.DataFrame({
+            "estimate": value,
+            "ci_low": value - margin,
+            "ci_high": value + margin,
+            "relative_error": (margin / value.abs()).replace(numpy.inf, numpy.nan),
+        })
+        if by:
+            return result.reset_index(names=by)
+        return result.reset_index(drop=True)
+
+    def describe(self) -> str:
+        return (
+            f"{len(self.frame)} of {self.n_population} rows"
+            + (f", stratified by \"{self.stratified_by}\"" if self.stratified_by is not None else "")
+        )
+
+
+def _stratum_column(df: pandas.DataFrame):
+    """The categorical column with the most (but at most APPROX_MAX_STRATA) groups."""
+    best, best_distinct = None, 1
+    for column in df.columns:
+        series = df[column]
+        if series.dtype == object or isinstance(series.dtype, pandas.CategoricalDtype) or pandas.api.types.is_bool_dtype(series):
+            distinct = series.nunique()
+            if best_distinct < distinct <= APPROX_MAX_STRATA:
+                best, best_distinct = column, distinct
+    return best
+
+
+_sample_cache: "OrderedDict[str, DatasetSample]" = OrderedDict()
+_sample_cache_lock = threading.Lock()
+
+
+def get_stratified_sample(df: pandas.DataFrame, version: str | None = None) -> Optional[DatasetSample]:
+    """
+    Return the sample of this dataset version, building it once. None when the
+    dataset is small enough to always be answered exactly.
+    """
+    if len(df) < APPROX_MIN_ROWS:
+        return None
+    version = version or dataset_version(df)
+    with _sample_cache_lock:
+        sample = _sample_cache.get(version)
+        if sample is not None:
+            _sample_cache.move_to_end(version)
+            return sample
+
+    sample = DatasetSample.from_dataframe(df, version)
+    with _sample_cache_lock:
+        _sample_cache[version] = sample
+        while len(_sample_cache) > SAMPLE_CACHE_SIZE:
+            _sample_cache.popitem(last=False)
+    return sample
@@ -0,0 +1,120 @@
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+import pandas
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Table name tokens are repeated in the document so they outweigh column names
+TABLE_NAME_WEIGHT = 3
+# Optional schema columns holding free-text column descriptions
+COMMENT_COLUMNS = ("COLUMN_COMMENT", "DESCRIPTION", "MS_DESCRIPTION")
+
+_CAMEL_CASE = re.compile(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])|(?<=[a-zA-Z])(?=[0-9])")
+_NON_WORD = re.compile(r"[^0-9a-zA-Z]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Split identifiers and prose into lowercase terms (camelCase and snake_case aware)."""
+    tokens = []
+    for word in _NON_WORD.split(_CAMEL_CASE.sub(" ", str(text))):
+        if not word:
+            continue
+        word = word.lower()
+        # Very light stemming, so "orders" matches "Order"
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+class SchemaIndex:
+    """
+    Local BM25 index over table names, column names/types, foreign keys and
+    column comments, used to pick the tables relevant to a question.
+
+    Tables start out indexed by name only; columns are added as their schemas
+    get loaded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs: Dict[str, Counter] = dict()
+        self._doc_len: Dict[str, int] = dict()
+        self._df: Counter = Counter()
+        self._total_len = 0
+        self.with_schema = set()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def set_tables(self, tables: Iterable[str]):
+        """Synchronize the index with the current table list."""
+        tables = list(tables)
+        with self._lock:
+            for table in set(self._docs) - set(tables):
+                self._remove(table)
+                self.with_schema.discard(table)
+            for table in tables:
+                if table not in self._docs:
+                    self._add(table, self._table_terms(table))
+
+    def add_schema(self, table: str, schema_df: pandas.DataFrame):
+        """(Re)index a table including its columns."""
+        terms = self._table_terms(table)
+        if schema_df is not None and not schema_df.empty:
+            for _, row in schema_df.iterrows():
+                for col in ("COLUMN_NAME", "DATA_TYPE", "FOREIGN_KEY_INFO") + COMMENT_COLUMNS:
+                    value = row.get(col)
+                    if isinstance(value, str) and value:
+                        terms += tokenize(value)
+        with self._lock:
+            self._remove(table)
+            self._add(table, terms)
+            self.with_schema.add(table)
+
+    def rank(self, question: str, k: int, boost: Iterable[str] = ()) -> List[Tuple[str, float]]:
+        """Return up to `k` (table, score) pairs with a positive score, best first."""
+        terms = set(tokenize(question))
+        boost = set(boost)
+        with self._lock:
+            n_docs = len(self._docs)
+            avg_len = (self._total_len / n_docs if n_docs else 0) or 1.0
+            scores = []
+            for table, doc in self._docs.items():
+                score = 0.0
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._doc_len[table] / avg_len)
+                for term in terms:
+                    tf = doc.get(term)
+                    if not tf:
+                        continue
+                    idf = math.log(1 + (n_docs - self._df[term] + 0.5) / (self._df[term] + 0.5))
+                    score += idf * tf * (BM25_K1 + 1) / (tf + norm)
+                if table in boost:
+                    # Tables already used in this conversation stay relevant
+                    score = score * 1.5 + 1.0
+                if score > 0:
+                    scores.append((table, score))
+        scores.sort(key=lambda pair: pair[1], reverse=True)
+        return scores[:k]
+
+    def _table_terms(self, table: str) -> List[str]:
+        return tokenize(table) * TABLE_NAME_WEIGHT
+
+    def _add(self, table: str, terms: List[str]):
+        doc = Counter(terms)
+        self._docs[table] = doc
+        self._doc_len[table] = len(terms)
+        self._df.update(doc.keys())
+        self._total_len += len(terms)
+
+    def _remove(self, table: str):
+        doc = self._docs.pop(table, None)
+        if doc is None:
+            return
+        self._df.subtract(doc.keys())
+        self._total_len -= self._doc_len.pop(table)
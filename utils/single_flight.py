@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+
+logger = logging.getLogger("kinaxis-sql-agent")
+
+_groups: List["SingleFlight"] = []
+_groups_lock = threading.Lock()
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: while a call for a key is running,
+    further calls with the same key wait for it and get its result (or its
+    exception) instead of running again. Nothing is cached; the next call
+    after it finished runs again.
+
+    `do` is for threads and `ado` for coroutines. Both share one in-flight
+    table of concurrent.futures.Future, so an async call can join a call
+    started by a thread or by a coroutine on another event loop (gunicorn
+    runs every async view on its own loop).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Hashable, Future] = dict()
+        self.calls = 0
+        self.collapsed = 0
+        with _groups_lock:
+            _groups.append(self)
+
+    def _join(self, key: Hashable):
+        with self._lock:
+            self.calls += 1
+            in_flight = self._in_flight.get(key)
+            if in_flight is not None:
+                self.collapsed += 1
+                return in_flight, False
+            in_flight = self._in_flight[key] = Future()
+            return in_flight, True
+
+    def _finish(self, key: Hashable, in_flight: Future, result=None, error: BaseException | None = None):
+        with self._lock:
+            del self._in_flight[key]
+        if error is not None:
+            in_flight.set_exception(error)
+        else:
+            in_flight.set_result(result)
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        in_flight, owner = self._join(key)
+        if not owner:
+            return in_flight.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, in_flight, error=e)
+            raise
+        self._finish(key, in_flight, result)
+        return result
+
+    async def ado(self, key: Hashable, fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        in_flight, owner = self._join(key)
+        if not owner:
+            # shield: a cancelled follower must not cancel the shared call
+            return await asyncio.shield(asyncio.wrap_future(in_flight))
+        try:
+            result = await fn(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, in_flight, error=e)
+            raise
+        self._finish(key, in_flight, result)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "executed": self.calls - self.collapsed,
+                "collapsed": self.collapsed,
+                "in_flight": len(self._in_flight),
+            }
+
+
+def single_flight_stats() -> Dict[str, Dict[str, Any]]:
+    """Calls, executed calls and collapsed calls of every single-flight group"""
+    with _groups_lock:
+        groups = list(_groups)
+    return {group.name: group.stats() for group in groups}
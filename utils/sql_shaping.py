@@ -0,0 +1,230 @@
+import os
+import re
+from typing import List, Optional, Tuple
+
+# Rows of a query result fetched for the agent when the query has no limit of its own
+SQL_RESULT_ROW_LIMIT = int(os.getenv("SQL_RESULT_ROW_LIMIT", 1000))
+# Upper bound of rows fetched when a complete result is needed (charts)
+SQL_FULL_FETCH_MAX_ROWS = int(os.getenv("SQL_FULL_FETCH_MAX_ROWS", 100000))
+
+AGGREGATIONS = {"sum": "SUM", "avg": "AVG", "average": "AVG", "mean": "AVG", "min": "MIN", "max": "MAX", "count": "COUNT"}
+
+_LEADING_SELECT = re.compile(r"\s*SELECT\s+((?:DISTINCT|ALL)\s+)?", re.IGNORECASE)
+# Matched on the original text right after SELECT [DISTINCT|ALL]: masking would hide "TOP(10)"
+_TOP = re.compile(r"TOP\b", re.IGNORECASE)
+# TOP with a literal row count (not PERCENT, not a variable), which can be lowered
+_TOP_COUNT = re.compile(r"TOP\s*(?:\(\s*(\d+)\s*\)|(\d+)\b)(?!\s*PERCENT\b)", re.IGNORECASE)
+_WITH = re.compile(r"\s*WITH\b", re.IGNORECASE)
+_SELECT = re.compile(r"\bSELECT\b", re.IGNORECASE)
+_HAS_FETCH = re.compile(r"\bFETCH\s+(?:NEXT|FIRST)\b", re.IGNORECASE)
+_OFFSET_ROWS = re.compile(r"\bOFFSET\s+[^;]*?\bROWS?\b", re.IGNORECASE)
+_SET_OPERATOR = re.compile(r"\b(?:UNION|INTERSECT|EXCEPT)\b", re.IGNORECASE)
+_INTO = re.compile(r"\bINTO\b", re.IGNORECASE)
+_ORDER_BY = re.compile(r"\bORDER\s+BY\b", re.IGNORECASE)
+# Clauses that end a statement and must stay outside a derived table
+_TRAILING_CLAUSE = re.compile(r"\b(?:OPTION|FOR\s+(?:XML|JSON|BROWSE))\b", re.IGNORECASE)
+_FROM_OR_JOIN = re.compile(r"\b(?:FROM|JOIN)\s+", re.IGNORECASE)
+_TABLE_REFERENCE = re.compile(r"(?:\[[^\]]+\]|\w+)(?:\s*\.\s*(?:\[[^\]]+\]|\w+))*")
+_ALIAS = re.compile(r"\s+(?:AS\s+)?(\[[^\]]+\]|\w+)", re.IGNORECASE)
+_WRITE_KEYWORD = re.compile(
+    r"\b(?:INSERT|UPDATE|DELETE|MERGE|EXEC|EXECUTE|DROP|ALTER|CREATE|TRUNCATE|GRANT|REVOKE|DENY)\b", re.IGNORECASE
+)
+# Words that can follow a table reference and are not an alias
+_NOT_ALIAS = {
+    "where", "group", "order", "having", "join", "inner", "left", "right", "full", "cross", "outer",
+    "on", "union", "except", "intersect", "option", "with", "tablesample", "for", "pivot", "unpivot",
+}
+
+
+def _mask(query: str) -> str:
+    """
+    Same-length copy of a T-SQL statement where string literals, quoted
+    identifiers and everything inside parentheses are blanked out (and
+    comments turned into spaces), so keywords can be searched at the top level
+    of the statement only.
+    """
+    out = []
+    depth = 0
+    i = 0
+    n = len(query)
+    while i < n:
+        c = query[i]
+        if c == "'" or c == "[" or c == '"':
+            close = "]" if c == "[" else c
+            j = i + 1
+            while j < n:
+                if query[j] == close:
+                    # '' and ]] are escapes inside literals/identifiers
+                    if j + 1 < n and query[j + 1] == close:
+                        j += 2
+                        continue
+                    break
+                j += 1
+            out.append("_" * (min(j, n - 1) - i + 1))
+            i = j + 1
+        elif query.startswith("--", i):
+            j = query.find("\n", i)
+            j = n if j == -1 else j
+            out.append(" " * (j - i))
+            i = j
+        elif query.startswith("/*", i):
+            j = query.find("*/", i + 2)
+            j = n if j == -1 else j + 2
+            out.append(" " * (j - i))
+            i = j
+        else:
+            if c == "(":
+                depth += 1
+            out.append(c if depth == 0 else "_")
+            if c == ")":
+                depth = max(depth - 1, 0)
+            i += 1
+    return "".join(out)
+
+
+def _strip_statement(query: str) -> str:
+    return query.strip().rstrip(";").strip()
+
+
+def _without_order_by(query: str) -> str:
+    """The statement without its top-level ORDER BY (not allowed in a derived table)"""
+    matches = list(_ORDER_BY.finditer(_mask(query)))
+    return query[: matches[-1].start()].rstrip() if matches else query
+
+
+def limit_query(query: str, limit: int) -> Tuple[str, bool]:
+    """
+    Cap the rows a single SELECT statement (optionally with a CTE) returns at
+    `limit`: add `TOP <limit>`, or lower a literal `TOP n` above it; add
+    `FETCH NEXT <limit> ROWS ONLY` to an OFFSET without FETCH (SQL Server
+    rejects TOP next to OFFSET); limit set operations (UNION/EXCEPT/INTERSECT)
+    as a whole. Returns the query to run and whether a limit was injected.
+    Anything else (FETCH already present, TOP PERCENT or TOP @n, SELECT INTO,
+    several statements, DML) is returned unchanged.
+    """
+    statement = _strip_statement(query)
+    masked = _mask(statement)
+    if ";" in masked or _INTO.search(masked):
+        return query, False
+    start = 0
+    if _WITH.match(masked):
+        # The CTE definitions are parenthesized (masked), so the first top-level
+        # SELECT is the main query, unless that is a DML statement
+        main = _SELECT.search(masked)
+        if main is None or _WRITE_KEYWORD.search(masked, 0, main.start()):
+            return query, False
+        start = main.start()
+    if not _LEADING_SELECT.match(masked, start):
+        return query, False
+    limited = _limit_select(statement[start:], masked[start:], limit)
+    return (statement[:start] + limited, True) if limited is not None else (query, False)
+
+
+def _limit_select(statement: str, masked: str, limit: int) -> Optional[str]:
+    if _HAS_FETCH.search(masked):
+        return None
+    offset = _OFFSET_ROWS.search(masked)
+    if offset is not None:
+        return f"{statement[:offset.end()]} FETCH NEXT {limit} ROWS ONLY{statement[offset.end():]}"
+    if _SET_OPERATOR.search(masked):
+        return _limit_set_operation(statement, masked, limit)
+    position = _LEADING_SELECT.match(masked).end()
+    top = _TOP_COUNT.match(statement, position)
+    if top is not None:
+        if int(top.group(1) or top.group(2)) <= limit:
+            return None
+        return f"{statement[:position]}TOP {limit}{statement[top.end():]}"
+    if _TOP.match(statement, position):
+        return None
+    return f"{statement[:position]}TOP {limit} {statement[position:]}"
+
+
+def _limit_set_operation(statement: str, masked: str, limit: int) -> str:
+    """
+    A top-level ORDER BY applies to the whole set operation, so it takes
+    `OFFSET 0 ROWS FETCH NEXT <limit> ROWS ONLY`; without one the set
+    operation becomes a derived table under `SELECT TOP <limit> *`.
+    """
+    orders = list(_ORDER_BY.finditer(masked))
+    trailing = _TRAILING_CLAUSE.search(masked, orders[-1].end() if orders else 0)
+    # End of the code before the trailing clause, ahead of any comment (blank in the mask)
+    end = len(masked[: trailing.start() if trailing else len(masked)].rstrip())
+    body, tail = statement[:end], statement[end:]
+    if orders:
+        return f"{body} OFFSET 0 ROWS FETCH NEXT {limit} ROWS ONLY{tail}"
+    return f"SELECT TOP {limit} * FROM ({body}) AS limited_q{tail}"
+
+
+def count_query(query: str) -> str:
+    """COUNT_BIG over the rows of a SELECT statement"""
+    # The newline keeps a trailing -- comment from swallowing the closing parenthesis
+    return f"SELECT COUNT_BIG(*) AS total_rows FROM ({_without_order_by(_strip_statement(query))}\n) AS shaped_q"
+
+
+def aggregate_query(query: str, x_column: str, y_columns: List[str], aggregation: str) -> Optional[str]:
+    """
+    Group the result of a SELECT statement by `x_column` on the server, so a
+    chart only needs one row per x value. None if the aggregation is unknown.
+    """
+    function = AGGREGATIONS.get(aggregation.lower())
+    if function is None:
+        return None
+    x = _quote(x_column)
+    aggregates = ", ".join(f"{function}({_quote(y)}) AS {_quote(y)}" for y in y_columns)
+    return (
+        f"SELECT {x}, {aggregates} FROM ({_without_order_by(_strip_statement(query))}\n) AS shaped_q "
+        f"GROUP BY {x} ORDER BY {x}"
+    )
+
+
+def _quote(identifier: str) -> str:
+    return "[" + identifier.replace("]", "]]") + "]"
+
+
+def sample_query(query: str, table: str, percent: float) -> Tuple[str, bool]:
+    """
+    Add `TABLESAMPLE SYSTEM (<percent> PERCENT)` to the top-level references
+    of `table` (FROM/JOIN, not inside subqueries). Returns the query and
+    whether anything was sampled.
+    """
+    statement = _strip_statement(query)
+    masked = _mask(statement)
+    target = _table_name(table)
+    inserts = []
+    for keyword in _FROM_OR_JOIN.finditer(masked):
+        reference = _TABLE_REFERENCE.match(statement, keyword.end())
+        if reference is None or masked[keyword.end()] == "(" or _table_name(reference.group()) != target:
+            continue
+        end = reference.end()
+        alias = _ALIAS.match(statement, end)
+        if alias and alias.group(1).strip("[]").lower() not in _NOT_ALIAS:
+            end = alias.end()
+        if re.match(r"\s+TABLESAMPLE\b", statement[end:], re.IGNORECASE):
+            continue
+        inserts.append(end)
+    for end in reversed(inserts):
+        statement = f"{statement[:end]} TABLESAMPLE SYSTEM ({percent:g} PERCENT){statement[end:]}"
+    return (statement, True) if inserts else (query, False)
+
+
+def is_read_only(query: str) -> bool:
+    """True for a single SELECT statement (optionally with a CTE) that writes nothing"""
+    masked = _mask(_strip_statement(query))
+    if ";" in masked or _INTO.search(masked) or _WRITE_KEYWORD.search(masked):
+        return False
+    return bool(re.match(r"\s*(?:SELECT|WITH)\b", masked, re.IGNORECASE))
+
+
+def referenced_tables(query: str) -> List[str]:
+    """Unqualified lower-case names of the tables a query reads (FROM/JOIN, any depth)"""
+    names = []
+    for keyword in _FROM_OR_JOIN.finditer(query):
+        reference = _TABLE_REFERENCE.match(query, keyword.end())
+        if reference is not None:
+            names.append(_table_name(reference.group()))
+    return names
+
+
+def _table_name(reference: str) -> str:
+    """Unqualified, unquoted, lower-case name of a table reference"""
+    return re.split(r"\s*\.\s*", reference.strip())[-1].strip("[]").lower()
@@ -0,0 +1,41 @@
+import logging
+import os
+from functools import lru_cache
+
+logger = logging.getLogger("kinaxis-agent")
+
+# Encoding used by the gpt-4o family deployments we talk to
+TOKEN_ENCODING = os.getenv("TOKEN_ENCODING", "o200k_base")
+# Rough chars-per-token ratio used when tiktoken (or its encoding files) is unavailable
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=1)
+def _get_encoder():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(TOKEN_ENCODING)
+    except Exception as e:
+        # tiktoken downloads encodings on first use, which fails on offline hosts.
+        logger.warning(f"tiktoken unavailable, falling back to estimates: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Count (or estimate, if tiktoken is unavailable) tokens in `text`."""
+    if not text:
+        return 0
+    encoder = _get_encoder()
+    if encoder is None:
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def truncate_text(text: str, max_chars: int, marker: str = "…") -> str:
+    """Shorten `text` to at most `max_chars` characters, marking the cut."""
+    if max_chars <= 0:
+        return ""
+    if len(text) <= max_chars:
+        return text
+    return text[: max(0, max_chars - len(marker))] + marker
@@ -0,0 +1,102 @@
+import itertools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from typing import Iterable, List, Tuple
+
+from langchain_core.messages import ToolMessage
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import BaseTool
+from langgraph.graph import MessagesState
+
+logger = logging.getLogger("kinaxis-agent")
+
+# Upper bound of tool calls running at the same time (shared by all agents in the process)
+TOOL_MAX_WORKERS = int(os.getenv("TOOL_MAX_WORKERS", 4))
+
+_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+_batches = itertools.count()
+_call_order: ContextVar[Tuple[int, int]] = ContextVar("tool_call_order", default=(0, 0))
+
+
+def current_call_order() -> Tuple[int, int]:
+    """
+    (batch, position) of the tool call being executed. Tools that keep "the
+    latest result" around use it so concurrent calls resolve in the order the
+    LLM asked for them, not in the order they happened to finish.
+    """
+    return _call_order.get()
+
+
+class ParallelToolNode:
+    """
+    Graph node executing the tool calls of the last AI message.
+
+    Consecutive calls to tools listed in `parallel_safe` (read-only tools that
+    don't touch shared state) run concurrently on a bounded thread pool. Any
+    other call is a barrier and runs on its own, in order. Results are returned
+    in the order of the tool calls.
+    """
+
+    def __init__(self, tools: List[BaseTool], parallel_safe: Iterable[str] = ()):
+        self.tools_by_name = {tool.name: tool for tool in tools}
+        self.parallel_safe = set(parallel_safe)
+
+    def __call__(self, state: MessagesState, config: RunnableConfig):
+        tool_calls = state["messages"][-1].tool_calls
+        batch = next(_batches)
+        results: List[ToolMessage | None] = [None] * len(tool_calls)
+
+        pending = []
+        for position, call in enumerate(tool_calls):
+            if call["name"] in self.parallel_safe:
+                pending.append(position)
+                continue
+            self._run_concurrently(pending, tool_calls, batch, config, results)
+            pending = []
+            results[position] = self._run_one(call, (batch, position), config)
+        self._run_concurrently(pending, tool_calls, batch, config, results)
+
+        return {"messages": results}
+
+    def _run_concurrently(self, positions, tool_calls, batch, config, results):
+        if not positions:
+            return
+        if len(positions) == 1:
+            position = positions[0]
+            results[position] = self._run_one(tool_calls[position], (batch, position), config)
+            return
+        logger.info(f"Running {len(positions)} tool calls concurrently")
+        futures = [
+            (
+                position,
+                _executor.submit(
+                    copy_context().run, self._run_one, tool_calls[position], (batch, position), config
+                ),
+            )
+            for position in positions
+        ]
+        for position, future in futures:
+            results[position] = future.result()
+
+    def _run_one(self, call, order: Tuple[int, int], config: RunnableConfig) -> ToolMessage:
+        _call_order.set(order)
+        tool = self.tools_by_name.get(call["name"])
+        if tool is None:
+            return ToolMessage(
+                content=f"Error: {call['name']} is not a valid tool, try one of [{', '.join(self.tools_by_name)}].",
+                name=call["name"],
+                tool_call_id=call["id"],
+                status="error",
+            )
+        try:
+            return tool.invoke({**call, "type": "tool_call"}, config)
+        except Exception as e:
+            logger.error(f"Tool <{call['name']}> failed: {e}")
+            return ToolMessage(
+                content=f"Error: {repr(e)}\n Please fix your mistakes.",
+                name=call["name"],
+                tool_call_id=call["id"],
+                status="error",
+            )
@@ -0,0 +1,283 @@
+import bisect
+import contextvars
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+logger = logging.getLogger("kinaxis-agent")
+
+# JSON lines file finished spans are appended to (OTLP/JSON span field names, so a
+# collector's file receiver can pick them up); empty turns the export off
+TRACE_LOG = os.getenv("TRACE_LOG", "traces.jsonl")
+# The trace file is rotated to "<TRACE_LOG>.1" once it grows past this size
+TRACE_LOG_MAX_BYTES = int(os.getenv("TRACE_LOG_MAX_BYTES", 50 * 1024 * 1024))
+SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "ai-analysis-tool")
+# Upper bounds (seconds) of the latency histogram buckets served by /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    One timed operation of a trace. Spans started with `span()` become the
+    parent of spans started inside them (also in threads started with a
+    copied context); `start_span` takes the parent explicitly.
+    """
+
+    def __init__(self, name: str, parent: Optional["Span"] = None, attributes: Dict[str, Any] | None = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent is not None else ""
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self._start = time.perf_counter()
+        self.error: Optional[str] = None
+        self.ended = False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def fail(self, error: BaseException | str):
+        self.error = str(error) or type(error).__name__
+
+    def end(self):
+        if self.ended:
+            return
+        self.ended = True
+        duration = time.perf_counter() - self._start
+        _metrics.observe(self.name, self.attributes.get("http.route"), duration, self.error is not None)
+        _exporter.export(self, duration)
+
+
+def start_span(name: str, parent: Optional[Span] = None, **attributes) -> Span:
+    """Start a span under `parent` (the current span if not given); end it with .end()"""
+    return Span(name, parent if parent is not None else _current_span.get(), attributes)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time the enclosed block as a child of the current span"""
+    current = start_span(name, **attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.fail(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end()
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def activate(current: Span):
+    """Make a span started with start_span the current one; returns the token for deactivate"""
+    return _current_span.set(current)
+
+
+def deactivate(token):
+    _current_span.reset(token)
+
+
+class _Exporter:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def export(self, finished: Span, duration: float):
+        if not self.path:
+            return
+        record = {
+            "traceId": finished.trace_id,
+            "spanId": finished.span_id,
+            "parentSpanId": finished.parent_id,
+            "name": finished.name,
+            "startTimeUnixNano": finished.start_ns,
+            "endTimeUnixNano": finished.start_ns + int(duration * 1e9),
+            "attributes": finished.attributes,
+            "status": {"code": "STATUS_CODE_ERROR", "message": finished.error}
+            if finished.error is not None else {"code": "STATUS_CODE_OK"},
+            "resource": {"service.name": SERVICE_NAME},
+        }
+        line = json.dumps(record, default=str) + "\n"
+        try:
+            with self._lock:
+                if self._file is None:
+                    self._file = open(self.path, "a", encoding="utf-8")
+                self._file.write(line)
+                self._file.flush()
+                if self._file.tell() > TRACE_LOG_MAX_BYTES:
+                    self._file.close()
+                    os.replace(self.path, f"{self.path}.1")
+                    self._file = None
+        except OSError as e:
+            logger.error(f"Couldn't write trace span: {e}")
+
+
+class _Metrics:
+    """Latency histograms and error counts per span name (and HTTP route)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (span name, route) -> [bucket counts..., +Inf count], sum, errors
+        self._histograms: Dict[tuple, List] = dict()
+
+    def observe(self, name: str, route: Optional[str], seconds: float, failed: bool):
+        key = (name, route or "")
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += failed
+
+    def exposition(self) -> str:
+        """Prometheus text format (version 0.0.4)"""
+        with self._lock:
+            histograms = {key: (list(counts), total, errors) for key, (counts, total, errors) in self._histograms.items()}
+        lines = [
+            "# HELP span_duration_seconds Duration of traced operations",
+            "# TYPE span_duration_seconds histogram",
+        ]
+        errors_lines = [
+            "# HELP span_errors_total Traced operations that failed",
+            "# TYPE span_errors_total counter",
+        ]
+        for (name, route), (counts, total, errors) in sorted(histograms.items()):
+            labels = f'span="{_label(name)}"' + (f',route="{_label(route)}"' if route else "")
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, counts):
+                cumulative += count
+                lines.append(f'span_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'span_duration_seconds_bucket{{{labels},le="+Inf"}} {cumulative}')
+            lines.append(f"span_duration_seconds_sum{{{labels}}} {total:.6f}")
+            lines.append(f"span_duration_seconds_count{{{labels}}} {cumulative}")
+            errors_lines.append(f"span_errors_total{{{labels}}} {errors}")
+        return "\n".join(lines + errors_lines) + "\n"
+
+
+def _label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_exporter = _Exporter(TRACE_LOG)
+_metrics = _Metrics()
+
+
+def metrics_text() -> str:
+    return _metrics.exposition()
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    LangChain callback turning an agent's graph run into spans under the span
+    current when the handler is created: one per graph node, LLM call (with
+    its token usage) and tool call. Other runnables inside a node are not
+    traced; their children are attached to the nearest traced parent.
+    """
+
+    def __init__(self, agent: str):
+        self.agent = agent
+        self.root = current_span()
+        self._spans: Dict[UUID, Optional[Span]] = dict()
+        self._parents: Dict[UUID, Optional[UUID]] = dict()
+        self._graph_run: Optional[UUID] = None
+        self._lock = threading.Lock()
+
+    def _parent(self, parent_run_id: Optional[UUID]) -> Optional[Span]:
+        with self._lock:
+            while parent_run_id is not None:
+                found = self._spans.get(parent_run_id)
+                if found is not None:
+                    return found
+                parent_run_id = self._parents.get(parent_run_id)
+        return self.root
+
+    def _start(self, run_id: UUID, parent_run_id: Optional[UUID], name: Optional[str], **attributes):
+        started = start_span(name, self._parent(parent_run_id), **attributes) if name else None
+        with self._lock:
+            self._spans[run_id] = started
+            self._parents[run_id] = parent_run_id
+
+    def _end(self, run_id: UUID, error: BaseException | None = None, **attributes) -> Optional[Span]:
+        with self._lock:
+            ended = self._spans.pop(run_id, None)
+            self._parents.pop(run_id, None)
+        if ended is not None:
+            ended.set(**attributes)
+            if error is not None:
+                ended.fail(error)
+            ended.end()
+        return ended
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        if parent_run_id is None:
+            self._graph_run = run_id
+            self._start(run_id, None, "agent.graph", agent=self.agent)
+        elif node is not None and parent_run_id == self._graph_run:
+            self._start(run_id, parent_run_id, "agent.node", agent=self.agent, node=node)
+        else:
+            self._start(run_id, parent_run_id, None)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, "llm.call", agent=self.agent, messages=sum(len(m) for m in messages))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._end(run_id, **llm_usage(response))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs):
+        name = kwargs.get("name") or (serialized or {}).get("name")
+        self._start(run_id, parent_run_id, "agent.tool", agent=self.agent, tool=name)
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+
+def llm_usage(response) -> Dict[str, int]:
+    """Prompt and completion tokens of an LLMResult (usage_metadata of the message, else llm_output)"""
+    usage = None
+    for generations in response.generations or []:
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            usage = getattr(message, "usage_metadata", None) or usage
+    if usage:
+        return {
+            "tokens.input": int(usage.get("input_tokens", 0)),
+            "tokens.output": int(usage.get("output_tokens", 0)),
+        }
+    token_usage = (response.llm_output or {}).get("token_usage") or {}
+    if token_usage:
+        return {
+            "tokens.input": int(token_usage.get("prompt_tokens", 0)),
+            "tokens.output": int(token_usage.get("completion_tokens", 0)),
+        }
+    return {}